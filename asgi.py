@@ -0,0 +1,169 @@
+import asyncio
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from twilio.twiml.messaging_response import MessagingResponse
+
+from utils.helpers import normalize
+from utils.chart import CHART_KEY_RE, CHART_MAX_AGE, chart_path, wait_for_chart, is_chart_pending
+from utils.jobs import start_workers
+from utils.router import Command
+from utils.metrics import METRICS_CONTENT_TYPE, MongoCommandTimer, render_metrics, span
+from models.data import STORAGE_BACKEND, claim_message, store_message_response, release_message, ensure_indexes, check_health
+from models.mongodb import (
+    MONGODB_URI, MONGODB_DB, MONGODB_OPTIONS, pool_stats,
+    SESSION_PROJECTION, session_from_doc, remember_identity
+)
+from models.context import DataContext
+from handlers import respond
+import tasks  # noqa: F401  registers the job handlers
+
+# Async entry point: the lookups every message needs are fetched concurrently
+# with motor, then the same handlers as the Flask app run on a worker thread.
+#   uvicorn asgi:app --workers 4
+
+# Created by the startup hook, so each worker process opens its own client
+# after any fork. With the embedded store the lookups are local and the
+# handlers load them lazily, so both stay None
+mongo = None
+db = None
+
+def _group_candidates(cmd):
+    # Group names this message could refer to in any state; fetching a few
+    # extra is cheaper than waiting for the session to say which one is meant
+    names = set()
+    first = cmd.parts[0].lower() if cmd.parts else ""
+    if first == "add" and len(cmd.parts) >= 2:
+        names.add(cmd.parts[1])
+    if first in ("view", "pay") and len(cmd.parts) >= 3:
+        names.add(cmd.parts[2])
+    if cmd.text and len(cmd.parts) == 1:
+        # A bare word may be the name offered while creating a group
+        names.add(cmd.text)
+    return names
+
+async def _fetch_identity(phone):
+    return await db.user_mappings.find_one(
+        {"phone_numbers": phone},
+        {"_id": 0, "user_id": 1, "phone_numbers": 1}
+    )
+
+async def _fetch_session(phone):
+    return await db.sessions.find_one({"user": phone}, SESSION_PROJECTION)
+
+async def _fetch_groups(names):
+    if not names:
+        return []
+    return await db.groups.find({"name": {"$in": list(names)}}, {"_id": 0}).to_list(None)
+
+async def prefetch(ctx, cmd):
+    phone = normalize(ctx.user)
+    names = _group_candidates(cmd)
+    with span("prefetch"):
+        mapping, session_doc, groups = await asyncio.gather(
+            _fetch_identity(phone), _fetch_session(phone), _fetch_groups(names)
+        )
+
+    found = {group["name"]: group for group in groups}
+    ctx.prefill(
+        user_id=remember_identity(mapping)["user_id"] if mapping else None,
+        session=session_from_doc(session_doc),
+        # Groups still in the embedded layout are left for the sync lookup to migrate
+        groups={
+            name: found.get(name)
+            for name in names
+            if name not in found or "expenses" not in found[name]
+        }
+    )
+
+async def handle_message(values, base_url):
+    start = time.perf_counter()
+    ctx = DataContext(values.get("From"), base_url=base_url)
+    cmd = Command(values.get("Body", ""))
+    if db is not None:
+        await prefetch(ctx, cmd)
+    return await run_in_threadpool(respond, ctx, cmd, start)
+
+def _twiml(body):
+    return Response(body, media_type="application/xml")
+
+async def webhook(request):
+    values = {**request.query_params, **(await request.form())}
+    base_url = str(request.base_url)
+    message_sid = values.get("MessageSid")
+    if not message_sid:
+        return _twiml(await handle_message(values, base_url))
+
+    claimed, response = await run_in_threadpool(claim_message, message_sid)
+    if not claimed:
+        return _twiml(response if response is not None else str(MessagingResponse()))
+
+    try:
+        response = await handle_message(values, base_url)
+    except Exception:
+        await run_in_threadpool(release_message, message_sid)
+        raise
+    await run_in_threadpool(store_message_response, message_sid, response)
+    return _twiml(response)
+
+def _etag_matches(header, etag):
+    # If-None-Match may list several tags, weak ones included, or be '*'
+    tags = [tag.strip() for tag in header.split(",") if tag.strip()]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+async def serve_chart(request):
+    key = request.path_params["key"]
+    if not CHART_KEY_RE.fullmatch(key):
+        return PlainTextResponse("Not found", status_code=404)
+    if not await run_in_threadpool(wait_for_chart, key):
+        if is_chart_pending(key):
+            return PlainTextResponse("Chart is still rendering", status_code=503, headers={"Retry-After": "2"})
+        return PlainTextResponse("Not found", status_code=404)
+    # Keys are content hashes, so a chart never changes once rendered
+    headers = {
+        "ETag": f'"{key}"',
+        "Cache-Control": f"public, max-age={CHART_MAX_AGE}, immutable",
+    }
+    if _etag_matches(request.headers.get("if-none-match", ""), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(chart_path(key), media_type="image/png", headers=headers)
+
+async def healthz(request):
+    health = await run_in_threadpool(check_health)
+    return JSONResponse(health, status_code=200 if health["ok"] else 503)
+
+async def metrics(request):
+    return Response(render_metrics(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+async def startup():
+    global mongo, db
+    if STORAGE_BACKEND == 'mongo':
+        mongo = AsyncIOMotorClient(
+            MONGODB_URI,
+            event_listeners=[MongoCommandTimer(), pool_stats],
+            **MONGODB_OPTIONS
+        )
+        db = mongo[MONGODB_DB]
+    await run_in_threadpool(ensure_indexes)
+    start_workers()
+
+async def shutdown():
+    global mongo, db
+    if mongo is not None:
+        mongo.close()
+    mongo = db = None
+
+app = Starlette(
+    routes=[
+        Route("/webhook", webhook, methods=["POST"]),
+        Route("/chart/{key}", serve_chart),
+        Route("/healthz", healthz),
+        Route("/metrics", metrics),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
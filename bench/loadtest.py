@@ -0,0 +1,423 @@
+import argparse
+import json
+import math
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Replies are recorded instead of sent and slow commands only get queued, so
+# the numbers reflect the webhook alone
+os.environ.setdefault('MESSENGER', 'fake')
+os.environ.setdefault('JOB_WORKERS', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+CATEGORIES = ['food', 'transport', 'shopping', 'bills', 'entertainment', 'health', 'rent', 'other']
+DESCRIPTIONS = ['lunch', 'dinner', 'cab', 'metro', 'groceries', 'movie', 'recharge', 'medicine', 'coffee', 'shoes']
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+SEED_BATCH_SIZE = 5000
+
+def phone(i):
+    return f"+919{i:09d}"
+
+def group_name(i):
+    return f"bench{i}"
+
+# --- Synthetic data ---
+
+def seed(expenses, users, groups, group_size, months=6, group_share=0.2, rng=None):
+    # Goes through the storage interface so every backend is seeded the same way
+    from models import data as db
+    from utils.helpers import normalize
+
+    rng = rng or random.Random(42)
+    now = datetime.utcnow()
+    start = now - timedelta(days=30 * months)
+    span_seconds = int((now - start).total_seconds())
+
+    def created_at():
+        return start + timedelta(seconds=rng.randrange(span_seconds))
+
+    db.ensure_indexes(force=True)
+    identities = db.resolve_many([phone(i) for i in range(users)])
+
+    def import_batch(batch):
+        by_user = {}
+        for expense in batch:
+            by_user.setdefault(expense['user'], []).append(expense)
+        for user, rows in by_user.items():
+            db.import_expenses(identities[normalize(user)]['user_id'], rows)
+
+    members = {
+        g: [phone((g * group_size + k) % users) for k in range(group_size)]
+        for g in range(groups)
+    }
+    group_count = int(expenses * group_share) if groups else 0
+    personal_count = expenses - group_count
+
+    batch = []
+    for _ in range(personal_count):
+        batch.append({
+            'user': f"whatsapp:{phone(rng.randrange(users))}",
+            'amount': float(rng.randrange(20, 5000)),
+            'desc': rng.choice(DESCRIPTIONS),
+            'category': rng.choice(CATEGORIES),
+            'created_at': created_at(),
+        })
+        if len(batch) == SEED_BATCH_SIZE:
+            import_batch(batch)
+            batch = []
+    import_batch(batch)
+
+    per_group = {g: [] for g in range(groups)}
+    for _ in range(group_count):
+        per_group[rng.randrange(groups)].append(None)
+    for g, slots in per_group.items():
+        name = group_name(g)
+        docs = []
+        for _ in slots:
+            docs.append({
+                'added_by': f"whatsapp:{rng.choice(members[g])}",
+                'paid_by': rng.choice(members[g]),
+                'amount': float(rng.randrange(100, 8000)),
+                'desc': rng.choice(DESCRIPTIONS),
+                'category': rng.choice(CATEGORIES),
+                'created_at': created_at(),
+            })
+        db.add_group({'name': name, 'members': members[g], 'created_at': start, 'expenses': docs})
+
+    return {'personal_expenses': personal_count, 'group_expenses': group_count, 'users': users, 'groups': groups}
+
+# --- Traffic ---
+
+def conversation(user_index, groups, group_size, users):
+    # Walks every state and command once, the way a WhatsApp user would
+    g = user_index // group_size if user_index < groups * group_size else None
+    steps = [
+        ('greet', 'hi'),
+        ('choose_personal', 'personal'),
+        ('personal_add', f"add {random.randrange(20, 900)} snack food"),
+        ('personal_add_batch', f"add\n{random.randrange(20, 900)} tea food\n{random.randrange(20, 900)} auto transport"),
+        ('personal_view_all', 'view all'),
+        ('personal_more', 'more'),
+        ('personal_chart', 'view chart'),
+        ('monthly_review', 'monthly review'),
+        ('start_budget', 'set budget'),
+        ('save_budget', 'food 5000 transport 2000'),
+        ('view_budget', 'view budget'),
+        ('view_trend', 'view trend'),
+        ('personal_help', 'what'),
+        ('back_to_main', 'back'),
+        ('greet', 'hi'),
+        ('choose_group', 'group'),
+        ('view_groups', 'view groups'),
+    ]
+    if g is not None:
+        name = group_name(g)
+        payer = phone((g * group_size + random.randrange(group_size)) % users)
+        steps += [
+            ('group_add', f"add {name} {random.randrange(100, 3000)} dinner food {payer}"),
+            ('group_add_batch', f"add {name}\n{random.randrange(100, 3000)} snacks food {payer}\n"
+                                f"{random.randrange(100, 3000)} taxi transport {payer}"),
+            ('view_balances', f"view balances {name}"),
+            ('group_expenses', f"view expenses {name}"),
+            ('group_more', 'more'),
+            ('group_chart', f"view chart {name}"),
+            ('pay_share', f"pay share {name}"),
+        ]
+    steps += [
+        ('create_group', 'create group'),
+        ('name_group', f"adhoc-{uuid.uuid4().hex[:8]}"),
+        ('add_group_members', f"{phone(user_index)} {phone((user_index + 1) % users)}"),
+        ('group_help', 'what'),
+        ('back_to_main', 'back'),
+    ]
+    return steps
+
+def twilio_form(user, body):
+    # The fields Twilio posts for an inbound WhatsApp message
+    number = user.lstrip('+')
+    sid = 'SM' + uuid.uuid4().hex
+    return {
+        'SmsMessageSid': sid,
+        'MessageSid': sid,
+        'SmsSid': sid,
+        'AccountSid': 'AC' + '0' * 32,
+        'MessagingServiceSid': 'MG' + '0' * 32,
+        'From': f"whatsapp:{user}",
+        'To': 'whatsapp:+14155238886',
+        'Body': body,
+        'NumMedia': '0',
+        'NumSegments': '1',
+        'ProfileName': f"Bench {number[-4:]}",
+        'WaId': number,
+        'SmsStatus': 'received',
+        'ApiVersion': '2010-04-01',
+    }
+
+class InProcessClient:
+    def __init__(self):
+        import app as appmod
+        self._app = appmod.app
+        self._local = threading.local()
+
+    def post(self, form):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        return client.post('/webhook', data=form).status_code
+
+    def metrics(self):
+        from utils.metrics import render_metrics
+        return render_metrics()
+
+class HttpClient:
+    def __init__(self, url):
+        import requests
+        self._url = url.rstrip('/')
+        self._requests = requests
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        return session
+
+    def post(self, form):
+        return self._session().post(f"{self._url}/webhook", data=form, timeout=30).status_code
+
+    def metrics(self):
+        response = self._session().get(f"{self._url}/metrics", timeout=30)
+        return response.text if response.ok else ''
+
+DB_COUNT_RE = re.compile(r'^expensebot_stage_seconds_count\{stage="(?:mongo|sqlite)_[^"]*",command="[^"]*",state="([^"]*)"\} (\d+)', re.M)
+
+def webhook_db_ops(metrics_text):
+    # Job workers label their spans state="job"; only webhook work counts here
+    return sum(int(count) for state, count in DB_COUNT_RE.findall(metrics_text) if state != 'job')
+
+def use_mongomock():
+    import mongomock
+    import pymongo
+
+    # mongomock re-reads the document with the original filter after an
+    # update, so a filter on a field the update changes (the group version)
+    # finds nothing; pin the filter to the _id first
+    find_one_and_update = mongomock.collection.Collection.find_one_and_update
+
+    def pinned_find_one_and_update(self, filter, update, *args, upsert=False, **kwargs):
+        if not upsert:
+            doc = self.find_one(filter, {'_id': 1}, sort=kwargs.get('sort'))
+            if doc is None:
+                return None
+            filter = {'_id': doc['_id']}
+        return find_one_and_update(self, filter, update, *args, upsert=upsert, **kwargs)
+
+    mongomock.collection.Collection.find_one_and_update = pinned_find_one_and_update
+    pymongo.MongoClient = mongomock.MongoClient
+    count_mongomock_ops()
+
+def count_mongomock_ops():
+    # mongomock does not emit command events, so time its collection methods
+    # and report them through the same histogram the CommandListener feeds
+    import mongomock
+    from utils.metrics import observe_stage
+
+    def wrap(name, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                observe_stage(f"mongo_{name}", time.perf_counter() - start)
+        return wrapper
+
+    for name in ('find', 'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many',
+                 'replace_one', 'delete_one', 'delete_many', 'find_one_and_update',
+                 'bulk_write', 'aggregate', 'count_documents', 'create_index'):
+        setattr(mongomock.collection.Collection, name, wrap(name, getattr(mongomock.collection.Collection, name)))
+
+def percentile(values, pct):
+    if not values:
+        return None
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def summarize(samples):
+    return {
+        'requests': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3) if samples else None,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3) if samples else None,
+        'p95_ms': round(percentile(samples, 95) * 1000, 3) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 3) if samples else None,
+    }
+
+def run(client, users, groups, group_size, concurrency, rounds, warmup):
+    latencies, per_step, errors = [], {}, [0]
+    lock = threading.Lock()
+
+    def play(user_index, record=True):
+        user = phone(user_index)
+        for step, body in conversation(user_index, groups, group_size, users):
+            start = time.perf_counter()
+            try:
+                status = client.post(twilio_form(user, body))
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - start
+            if not record:
+                continue
+            with lock:
+                if status != 200:
+                    errors[0] += 1
+                latencies.append(elapsed)
+                per_step.setdefault(step, []).append(elapsed)
+
+    for i in range(min(warmup, users)):
+        play(i, record=False)
+
+    ops_before = webhook_db_ops(client.metrics())
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(rounds):
+            list(pool.map(play, range(users)))
+    wall = time.perf_counter() - started
+    ops = webhook_db_ops(client.metrics()) - ops_before
+
+    return {
+        'overall': {
+            **summarize(latencies),
+            'errors': errors[0],
+            'wall_seconds': round(wall, 3),
+            'requests_per_second': round(len(latencies) / wall, 2) if wall else None,
+            'db_ops_per_request': round(ops / len(latencies), 2) if latencies and ops else None,
+        },
+        'per_command': {step: summarize(samples) for step, samples in sorted(per_step.items())},
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline_path, current_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    regressions = 0
+    print(f"{'command':24} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18}")
+    rows = [('overall', baseline['overall'], current['overall'])] + [
+        (step, baseline['per_command'][step], stats)
+        for step, stats in current['per_command'].items() if step in baseline['per_command']
+    ]
+    for step, old, new in rows:
+        cells = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            change = (new[key] - old[key]) / old[key] if old[key] else 0
+            if change > threshold:
+                regressions += 1
+            cells.append(f"{old[key]:>7.2f}→{new[key]:<7.2f}{'!' if change > threshold else ' '}")
+        print(f"{step:24} " + " ".join(f"{c:>18}" for c in cells))
+    old_rps, new_rps = baseline['overall']['requests_per_second'], current['overall']['requests_per_second']
+    print(f"requests/sec: {old_rps} → {new_rps}")
+    # Results saved before the SQLite backend existed call this mongo_ops_per_request
+    old_ops = baseline['overall'].get('db_ops_per_request', baseline['overall'].get('mongo_ops_per_request'))
+    print(f"db ops/request: {old_ops} → {current['overall'].get('db_ops_per_request')}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed synthetic data and replay WhatsApp webhook traffic")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help="seed (optionally) and replay traffic")
+    run_parser.add_argument('--url', help="benchmark a running server instead of the app in-process")
+    run_parser.add_argument('--mongomock', action='store_true', help="in-memory database instead of MONGODB_URI")
+    run_parser.add_argument('--expenses', type=int, default=10000)
+    run_parser.add_argument('--users', type=int, default=200)
+    run_parser.add_argument('--groups', type=int, default=20)
+    run_parser.add_argument('--group-size', type=int, default=4)
+    run_parser.add_argument('--no-seed', action='store_true', help="reuse data seeded by an earlier run")
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--rounds', type=int, default=1)
+    run_parser.add_argument('--warmup', type=int, default=5, help="users replayed before measuring")
+    run_parser.add_argument('--out', help="where to write the JSON result (default bench/results/)")
+
+    seed_parser = sub.add_parser('seed', help="only load synthetic data into the configured database")
+    for arg, default in (('--expenses', 10000), ('--users', 200), ('--groups', 20), ('--group-size', 4)):
+        seed_parser.add_argument(arg, type=int, default=default)
+
+    compare_parser = sub.add_parser('compare', help="diff two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.10, help="relative slowdown reported as a regression")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        return 1 if compare(args.baseline, args.current, args.threshold) else 0
+
+    # Read here rather than from models.data, which must not be imported before use_mongomock()
+    backend = os.getenv('STORAGE_BACKEND', 'mongo').lower()
+    if getattr(args, 'mongomock', False):
+        if args.url:
+            parser.error("--mongomock only applies to in-process runs")
+        if backend != 'mongo':
+            parser.error("--mongomock only applies to STORAGE_BACKEND=mongo")
+        use_mongomock()
+
+    if args.group_size > args.users:
+        parser.error("--group-size cannot exceed --users")
+
+    if args.command == 'seed':
+        print(json.dumps(seed(args.expenses, args.users, args.groups, args.group_size), indent=2))
+        return 0
+
+    dataset = None
+    if not args.no_seed:
+        setting = 'SQLITE_PATH' if backend == 'sqlite' else 'MONGODB_URI'
+        if args.url and not os.getenv(setting):
+            parser.error(f"seeding for --url needs {setting} pointing at the server's database (or pass --no-seed)")
+        started = time.perf_counter()
+        dataset = seed(args.expenses, args.users, args.groups, args.group_size)
+        dataset['seed_seconds'] = round(time.perf_counter() - started, 2)
+
+    client = HttpClient(args.url) if args.url else InProcessClient()
+    result = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'mode': 'http' if args.url else 'in-process',
+        'database': 'mongomock' if args.mongomock else {'mongo': 'mongodb'}.get(backend, backend),
+        'concurrency': args.concurrency,
+        'rounds': args.rounds,
+        'dataset': dataset,
+        **run(client, args.users, args.groups, args.group_size, args.concurrency, args.rounds, args.warmup),
+    }
+
+    out = args.out
+    if not out:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f"{datetime.utcnow():%Y%m%d-%H%M%S}-{result['commit'] or 'nogit'}.json")
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    overall = result['overall']
+    print(f"{overall['requests']} requests, {overall['errors']} errors, {overall['requests_per_second']} req/s")
+    print(f"p50 {overall['p50_ms']} ms, p95 {overall['p95_ms']} ms, p99 {overall['p99_ms']} ms, "
+          f"{overall['db_ops_per_request']} db ops/request")
+    print(f"Saved {out}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
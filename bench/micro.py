@@ -0,0 +1,521 @@
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from bench.loadtest import CATEGORIES, DESCRIPTIONS, phone, use_mongomock
+
+# Component benchmarks: each one times the current code path next to the one
+# it replaced, on the same data, so the speedup can be read off one table
+
+os.environ.setdefault('MESSENGER', 'fake')
+os.environ.setdefault('JOB_WORKERS', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+def timed(func, repeat):
+    # Median wall time of `repeat` calls, in milliseconds
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+def print_table(headers, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *rows)]
+    for row in [headers] + rows:
+        print("  ".join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+
+def speedup(before, after):
+    return f"{before / after:.1f}x" if after else "-"
+
+# --- Group balances: running ledger vs walking every expense ---
+
+def bench_ledger(sizes, members, repeat):
+    from models import data as db
+    from utils.balance import calculate_group_balances
+
+    rng = random.Random(42)
+    db.ensure_indexes(force=True)
+    member_phones = [phone(i) for i in range(members)]
+    start = datetime.utcnow() - timedelta(days=180)
+    rows = []
+    for size in sizes:
+        name = f"ledger-{size}-{uuid.uuid4().hex[:6]}"
+        db.add_group({'name': name, 'members': member_phones, 'created_at': start, 'expenses': [
+            {
+                'added_by': f"whatsapp:{rng.choice(member_phones)}",
+                'paid_by': rng.choice(member_phones),
+                'amount': float(rng.randrange(100, 8000)),
+                'desc': rng.choice(DESCRIPTIONS),
+                'category': rng.choice(CATEGORIES),
+                'created_at': start + timedelta(minutes=i),
+            }
+            for i in range(size)
+        ]})
+
+        def walk():
+            # What "view balances" did before the ledger: load every expense and sum them
+            group = {k: v for k, v in db.get_group_by_name(name).items() if k != 'ledger'}
+            group['expenses'] = db.get_group_expenses(name)
+            return calculate_group_balances(group)
+
+        def ledger():
+            return calculate_group_balances(db.get_group_by_name(name))
+
+        walked, read = walk(), ledger()
+        # The ledger splits in whole paise, so each expense can move a share by one paisa
+        assert all(abs(walked[m] - read[m]) <= 0.01 * size for m in walked), "ledger drifted from the expenses"
+        before, after = timed(walk, repeat), timed(ledger, repeat)
+        rows.append([size, f"{before:.2f}", f"{after:.3f}", speedup(before, after)])
+    print_table(['expenses', 'walk ms', 'ledger ms', 'speedup'], rows)
+
+# --- Settlement plan: heap greedy vs the old debtor x creditor loop ---
+
+def nested_loop_plan(balances, members):
+    # The plan "view balances" built before utils/settlement.py, as it was
+    from utils.helpers import normalize
+
+    out = ""
+    debtors = {m: b for m, b in balances.items() if b < 0}
+    creditors = {m: b for m, b in balances.items() if b > 0}
+    for debtor, debt in debtors.items():
+        original_debtor = next(m for m in members if normalize(m) == debtor)
+        remaining_debt = abs(debt)
+        for creditor, credit in creditors.items():
+            if remaining_debt <= 0 or credit <= 0:
+                continue
+            original_creditor = next(m for m in members if normalize(m) == creditor)
+            payment = min(remaining_debt, credit)
+            out += f"- {original_debtor} should pay ₹{payment:.2f} to {original_creditor}\n"
+            remaining_debt -= payment
+            creditors[creditor] -= payment
+    return out
+
+def heap_plan(balances, members, exact=False):
+    from utils.helpers import normalize
+    from utils.settlement import plan_settlements
+
+    out = ""
+    display = {normalize(m): m for m in members}
+    for debtor, creditor, paise in plan_settlements(balances, exact=exact):
+        out += f"- {display[debtor]} should pay ₹{paise / 100:.2f} to {display[creditor]}\n"
+    return out
+
+def random_balances(members, rng):
+    # Net balances of a group with equal splits: they sum to zero, to the paisa
+    from utils.helpers import normalize
+
+    paise = [rng.randrange(-500000, 500000) for _ in members[:-1]]
+    paise.append(-sum(paise))
+    return {normalize(m): p / 100 for m, p in zip(members, paise)}
+
+def bench_settle(sizes, repeat):
+    from utils.settlement import MAX_EXACT_MEMBERS
+
+    rng = random.Random(7)
+    rows = []
+    for size in sizes:
+        # Members are stored as typed, so normalize() has real work to do
+        members = [f"+91 90000 {i:05d}" for i in range(size)]
+        balances = random_balances(members, rng)
+        loop = nested_loop_plan(dict(balances), members)
+        heap = heap_plan(balances, members)
+        before = timed(lambda: nested_loop_plan(dict(balances), members), repeat)
+        after = timed(lambda: heap_plan(balances, members), repeat)
+        exact = "-"
+        if size <= MAX_EXACT_MEMBERS:
+            exact = f"{timed(lambda: heap_plan(balances, members, exact=True), repeat):.3f}"
+        rows.append([
+            size, f"{before:.2f}", loop.count("\n"), f"{after:.3f}", heap.count("\n"), exact, speedup(before, after)
+        ])
+    print_table(['members', 'loop ms', 'transfers', 'heap ms', 'transfers', 'exact ms', 'speedup'], rows)
+
+# --- Charts: process pool vs rendering inside the request ---
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What importing app.py cost when utils/chart.py imported pyplot at the top
+EAGER_PYPLOT = "import matplotlib; matplotlib.use('Agg'); import matplotlib.pyplot; "
+
+def import_seconds(code, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, stderr=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+def bench_chart(renders, repeat):
+    import tempfile
+    from utils import chart
+
+    chart.CHART_DIR = tempfile.mkdtemp(prefix='chart-bench-')
+    rng = random.Random(3)
+
+    def totals():
+        # Fresh numbers every time so no render is served from the cache
+        return {category: float(rng.randrange(100, 9000)) for category in CATEGORIES}
+
+    cold_before = import_seconds(EAGER_PYPLOT + "import app", repeat)
+    cold_after = import_seconds("import app", repeat)
+
+    # The old webhook drew the chart itself before answering
+    inline = []
+    chart._render(['food'], [1.0], 'warm up', os.path.join(chart.CHART_DIR, 'warm.png'))
+    for i in range(renders):
+        data = totals()
+        start = time.perf_counter()
+        chart._render(list(data), list(data.values()), 'Spending', os.path.join(chart.CHART_DIR, f'inline{i}.png'))
+        inline.append(time.perf_counter() - start)
+
+    # Now the request only submits it; the image is ready once the pool finishes
+    chart.wait_for_chart(chart.submit_chart({'food': 1.0}, 'warm up'))
+    submitted, ready = [], []
+    for _ in range(renders):
+        start = time.perf_counter()
+        key = chart.submit_chart(totals(), 'Spending')
+        submitted.append(time.perf_counter() - start)
+        assert chart.wait_for_chart(key), "chart render failed"
+        ready.append(time.perf_counter() - start)
+
+    def ms(samples):
+        return f"{statistics.median(samples) * 1000:.2f}"
+
+    print_table(['', 'before ms', 'after ms'], [
+        ['cold start (import app)', f"{cold_before:.0f}", f"{cold_after:.0f}"],
+        ['chart time in the request', ms(inline), ms(submitted)],
+        ['until the image exists', ms(inline), ms(ready)],
+    ])
+
+# --- Category totals: database-side sums vs summing documents in Python ---
+
+def python_totals(expenses):
+    totals = {}
+    for expense in expenses:
+        category = expense.get("category", "other")
+        totals[category] = totals.get(category, 0) + expense["amount"]
+    return totals
+
+def bench_totals(expenses, months, repeat):
+    from models import data as db
+
+    rng = random.Random(11)
+    db.ensure_indexes(force=True)
+    user = f"whatsapp:{phone(rng.randrange(10 ** 8))}"
+    user_id = db.get_user_id(user)
+    now = datetime.utcnow()
+    first = now - timedelta(days=30 * months)
+    span_seconds = int((now - first).total_seconds())
+    for offset in range(0, expenses, 5000):
+        db.import_expenses(user_id, [
+            {
+                'user': user,
+                'amount': float(rng.randrange(20, 5000)),
+                'desc': rng.choice(DESCRIPTIONS),
+                'category': rng.choice(CATEGORIES),
+                'created_at': first + timedelta(seconds=rng.randrange(span_seconds)),
+            }
+            for _ in range(min(5000, expenses - offset))
+        ])
+
+    month = now.strftime('%Y-%m')
+    start, end = db.month_bounds(month)
+
+    def all_history():
+        # Monthly review before: every expense the user ever had, filtered in Python
+        return python_totals(e for e in db.get_user_expenses(user)
+                             if isinstance(e.get('created_at'), datetime) and start <= e['created_at'] < end)
+
+    def month_documents():
+        # Budget usage before: the month's documents, summed in Python
+        return python_totals(db.iter_user_expenses(user, start, end))
+
+    def aggregate():
+        return db.get_category_totals(user_id, start, end)
+
+    def rollup():
+        return db.get_monthly_rollup(user_id, month)
+
+    expected = {category: round(total, 2) for category, total in all_history().items()}
+    for func in (month_documents, aggregate, rollup):
+        assert {c: round(t, 2) for c, t in func().items()} == expected, f"{func.__name__} totals differ"
+
+    rows = [
+        ['all history, Python sum', f"{timed(all_history, repeat):.2f}"],
+        ['month documents, Python sum', f"{timed(month_documents, repeat):.2f}"],
+        ['aggregation ($match + $group)', f"{timed(aggregate, repeat):.2f}"],
+        ['monthly rollup', f"{timed(rollup, repeat):.3f}"],
+    ]
+    print(f"{expenses} expenses over {months} months, current month's category totals:")
+    print_table(['', 'ms'], rows)
+
+# --- Dispatch: command router vs the webhook's if/elif ladder ---
+
+# One message per route and fallback, with the state it is sent in
+DISPATCH_MESSAGES = [
+    (None, 'hi'),
+    ('awaiting_scope', 'personal'),
+    ('awaiting_scope', 'group'),
+    ('awaiting_scope', 'what'),
+    ('personal_menu', 'add 120 lunch food'),
+    ('personal_menu', 'add\n120 tea food\n80 auto transport'),
+    ('personal_menu', 'view all'),
+    ('personal_menu', 'more'),
+    ('personal_menu', 'view chart'),
+    ('personal_menu', 'monthly review'),
+    ('personal_menu', 'set budget'),
+    ('personal_menu', 'view budget'),
+    ('personal_menu', 'view trend'),
+    ('personal_menu', 'back'),
+    ('personal_menu', 'what'),
+    ('setting_budget', 'food 5000 transport 2000'),
+    ('setting_budget', 'back'),
+    ('group_menu', 'create group'),
+    ('group_menu', 'view groups'),
+    ('group_menu', 'pay share trip'),
+    ('group_menu', 'view balances trip'),
+    ('group_menu', 'view chart trip'),
+    ('group_menu', 'view expenses trip'),
+    ('group_menu', 'add trip 300 dinner food +911111111111'),
+    ('group_menu', 'add trip\n300 dinner food +911111111111\n120 cab transport +912222222222'),
+    ('group_menu', 'more'),
+    ('group_menu', 'back'),
+    ('group_menu', 'what'),
+    ('creating_group_name', 'trip'),
+    ('creating_group_members', '+911111111111 +912222222222'),
+]
+
+def ladder_dispatch(state, body):
+    # The branch tests webhook() ran before the router, up to the point where
+    # it knew which command it had, including its per-branch re-splits
+    text = body.strip()
+    txt_l = text.lower()
+    if state is None:
+        return 'greet'
+    if state == "awaiting_scope":
+        if txt_l == "personal":
+            return 'choose_personal'
+        elif txt_l == "group":
+            return 'choose_group'
+        return 'scope_help'
+    if state == "personal_menu":
+        if txt_l.startswith("add"):
+            parts = text.split()
+            return 'personal_add' if len(parts) >= 4 else 'personal_add_usage'
+        elif txt_l == "view all":
+            return 'personal_view_all'
+        elif txt_l in ("more", "next"):
+            return 'personal_more'
+        elif txt_l == "view chart":
+            return 'personal_chart'
+        elif txt_l == "monthly review":
+            return 'monthly_review'
+        elif txt_l == "set budget":
+            return 'start_budget'
+        elif txt_l == "view budget":
+            return 'view_budget'
+        elif txt_l == "view trend":
+            return 'view_trend'
+        elif txt_l == "back":
+            return 'back_to_main'
+        return 'personal_help'
+    if state == "setting_budget":
+        if txt_l == "back":
+            return 'back_to_personal'
+        parts = text.split()
+        return 'save_budget' if len(parts) % 2 == 0 else 'budget_usage'
+    if state == "group_menu":
+        if txt_l == "create group":
+            return 'create_group'
+        elif txt_l == "view groups":
+            return 'view_groups'
+        elif txt_l.startswith("pay share"):
+            parts = text.split()
+            return 'pay_share' if len(parts) >= 3 else 'pay_share_usage'
+        elif txt_l.startswith("view balances"):
+            parts = text.split()
+            return 'view_balances' if len(parts) >= 3 else 'view_balances_usage'
+        elif txt_l.startswith("view chart"):
+            parts = text.split()
+            return 'group_chart' if len(parts) >= 3 else 'group_chart_usage'
+        elif txt_l.startswith("view expenses"):
+            parts = text.split()
+            return 'group_expenses' if len(parts) >= 3 else 'group_expenses_usage'
+        elif txt_l.startswith("add"):
+            parts = text.split()
+            return 'group_add' if len(parts) >= 6 else 'group_add_usage'
+        elif txt_l in ("more", "next"):
+            return 'group_more'
+        elif txt_l == "back":
+            return 'back_to_main'
+        return 'group_help'
+    if state == "creating_group_name":
+        return 'name_group'
+    if state == "creating_group_members":
+        members = text.split()
+        return 'add_group_members' if all(m.startswith("+") for m in members) else 'members_usage'
+
+def bench_dispatch(iterations, repeat):
+    from handlers import router
+    from utils.router import Command
+
+    def per_call_ns(func):
+        return timed(lambda: [func() for _ in range(iterations)], repeat) * 1e6 / iterations
+
+    rows, total_before, total_after = [], 0, 0
+    for state, body in DISPATCH_MESSAGES:
+        handler = router.resolve(state, Command(body))
+        before = per_call_ns(lambda: ladder_dispatch(state, body))
+        after = per_call_ns(lambda: router.resolve(state, Command(body)))
+        total_before, total_after = total_before + before, total_after + after
+        rows.append([state or '-', body.split('\n')[0][:24], handler.__name__, f"{before:.0f}", f"{after:.0f}"])
+    count = len(DISPATCH_MESSAGES)
+    rows.append(['', '', 'mean', f"{total_before / count:.0f}", f"{total_after / count:.0f}"])
+    print_table(['state', 'message', 'handler', 'ladder ns', 'router ns'], rows)
+
+# --- Export: streaming /export vs building the whole file first ---
+
+EXPORT_USER = f"whatsapp:{phone(999999999)}"
+EXPORT_MODES = ['materialized', 'csv', 'ndjson']
+
+def seed_export(rows):
+    from models import data as db
+
+    rng = random.Random(5)
+    db.ensure_indexes(force=True)
+    user_id = db.get_user_id(EXPORT_USER)
+    first = datetime.utcnow() - timedelta(days=730)
+    for offset in range(0, rows, 5000):
+        db.import_expenses(user_id, [
+            {
+                'user': EXPORT_USER,
+                'amount': float(rng.randrange(20, 5000)),
+                'desc': rng.choice(DESCRIPTIONS),
+                'category': rng.choice(CATEGORIES),
+                'created_at': first + timedelta(seconds=offset + i),
+            }
+            for i in range(min(5000, rows - offset))
+        ])
+
+def measure_export(mode):
+    # Runs in its own process so ru_maxrss is this mode's peak alone
+    import json
+    import resource
+
+    os.environ['DATA_API_TOKEN'] = 'bench'
+    import app as appmod
+    from utils.export import export_rows, render
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == 'materialized':
+        # Every row in a list, then the whole file in one string
+        body = "".join(render(list(export_rows(EXPORT_USER, scope='personal')), 'csv'))
+        size, lines = len(body.encode()), body.count("\n")
+    else:
+        response = appmod.app.test_client().get(
+            "/export", query_string={'user': EXPORT_USER, 'format': mode, 'scope': 'personal'},
+            headers={'Authorization': 'Bearer bench'}, buffered=False
+        )
+        assert response.status_code == 200, response.status_code
+        size = lines = 0
+        for chunk in response.response:
+            chunk = chunk if isinstance(chunk, bytes) else chunk.encode()
+            size += len(chunk)
+            lines += chunk.count(b"\n")
+        response.close()
+    elapsed = time.perf_counter() - start
+    rows = lines - 1 if mode != 'ndjson' else lines
+    print(json.dumps({
+        'rows': rows, 'seconds': elapsed, 'bytes': size,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'baseline_rss_mb': baseline_kb / 1024,
+    }))
+
+def bench_export(rows, seed):
+    import json
+
+    if seed:
+        started = time.perf_counter()
+        seed_export(rows)
+        print(f"Seeded {rows} expenses in {time.perf_counter() - started:.0f}s")
+
+    table = []
+    for mode in EXPORT_MODES:
+        output = subprocess.run(
+            [sys.executable, '-m', 'bench.micro', 'export', '--measure', mode],
+            cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        table.append([
+            mode, result['rows'], f"{result['seconds']:.1f}", f"{result['rows'] / result['seconds']:.0f}",
+            f"{result['peak_rss_mb']:.0f}", f"{result['peak_rss_mb'] - result['baseline_rss_mb']:.0f}",
+        ])
+    print_table(['mode', 'rows', 'seconds', 'rows/sec', 'peak RSS MB', 'growth MB'], table)
+
+def sizes(value):
+    return [int(size) for size in value.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time components against the implementations they replaced")
+    parser.add_argument('--mongomock', action='store_true', help="in-memory database instead of MONGODB_URI")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement; the median is reported")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    ledger_parser = sub.add_parser('ledger', help="group balances from the ledger vs from every expense")
+    ledger_parser.add_argument('--sizes', type=sizes, default=[10000, 30000, 100000], help="expenses per group")
+    ledger_parser.add_argument('--members', type=int, default=10)
+
+    settle_parser = sub.add_parser('settle', help="settlement plan vs the old nested loop")
+    settle_parser.add_argument('--sizes', type=sizes, default=[10, 30, 100, 300, 1000], help="members per group")
+
+    chart_parser = sub.add_parser('chart', help="app cold start and chart latency in the request")
+    chart_parser.add_argument('--renders', type=int, default=20)
+
+    totals_parser = sub.add_parser('totals', help="monthly category totals for one user with a long history")
+    totals_parser.add_argument('--expenses', type=int, default=100000)
+    totals_parser.add_argument('--months', type=int, default=24)
+
+    dispatch_parser = sub.add_parser('dispatch', help="cost of picking the handler for every command")
+    dispatch_parser.add_argument('--iterations', type=int, default=20000)
+
+    export_parser = sub.add_parser('export', help="export throughput and peak memory (needs a persistent database)")
+    export_parser.add_argument('--rows', type=int, default=1000000)
+    export_parser.add_argument('--no-seed', action='store_true', help="reuse rows seeded by an earlier run")
+    export_parser.add_argument('--measure', choices=EXPORT_MODES, help=argparse.SUPPRESS)
+
+    args = parser.parse_args(argv)
+
+    # Read here rather than from models.data, which must not be imported before use_mongomock()
+    if args.mongomock:
+        if os.getenv('STORAGE_BACKEND', 'mongo').lower() != 'mongo':
+            parser.error("--mongomock only applies to STORAGE_BACKEND=mongo")
+        use_mongomock()
+
+    if args.command == 'ledger':
+        bench_ledger(args.sizes, args.members, args.repeat)
+    if args.command == 'settle':
+        bench_settle(args.sizes, args.repeat)
+    if args.command == 'chart':
+        bench_chart(args.renders, args.repeat)
+    if args.command == 'totals':
+        bench_totals(args.expenses, args.months, args.repeat)
+    if args.command == 'dispatch':
+        bench_dispatch(args.iterations, args.repeat)
+    if args.command == 'export':
+        if args.mongomock:
+            parser.error("export measures each mode in its own process, which cannot share mongomock")
+        if args.measure:
+            measure_export(args.measure)
+        else:
+            bench_export(args.rows, not args.no_seed)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
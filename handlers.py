@@ -0,0 +1,644 @@
+import math
+import time
+
+from utils.helpers import normalize
+from utils.router import Router, Reply
+from utils.log import get_logger, fields
+from utils.metrics import REQUEST_SECONDS, labelled, span
+from utils.balance import calculate_group_balances, group_total
+from utils.settlement import plan_settlements
+from utils.razorpay_integration import process_expense_payment
+from utils.jobs import enqueue
+from models.data import (
+    add_expense, add_expenses, add_group, add_group_expense, add_group_expenses,
+    get_group_expenses, get_group_expenses_page,
+    get_user_expenses_page,
+    get_user_groups, get_user_budget, set_user_budget,
+    get_user_budget_usage, get_monthly_trend
+)
+
+EXPENSES_PAGE_SIZE = 20
+# Most expense lines accepted in one batch add
+MAX_BATCH_LINES = 50
+
+router = Router()
+log = get_logger('webhook')
+
+def respond(ctx, cmd, start=None):
+    # Runs one message through its handler and returns the TwiML reply
+    start = start or time.perf_counter()
+    reply = Reply()
+
+    # The session has to be loaded before the command is known, so its load
+    # time is the one span recorded without a command label
+    state = ctx.session["state"]
+    handler = router.resolve(state, cmd)
+    command, state_label = handler.__name__, state or "start"
+    with labelled(command, state_label):
+        handler(ctx, cmd, reply)
+        ctx.save_session()
+        with span("twiml"):
+            response = reply.to_twiml()
+    elapsed = time.perf_counter() - start
+    REQUEST_SECONDS.observe(elapsed, command=command, state=state_label)
+
+    log.info("handled message", extra=fields(
+        user=ctx.user, command=command, state=state_label,
+        ms=round(elapsed * 1000, 2), reply_bytes=len(response)
+    ))
+    log.debug("message body", extra=fields(user=ctx.user, body=cmd.text))
+    return response
+
+def reset(ctx):
+    ctx.session["state"] = None
+    ctx.session["temp"] = {}
+
+def page_lines(ctx, page):
+    # Renders one page and keeps the cursor for 'more' in the session
+    sess = ctx.session
+    offset = page.get("offset", 0)
+    if page["kind"] == "personal":
+        expenses, after = get_user_expenses_page(ctx.user, page.get("after"), EXPENSES_PAGE_SIZE)
+        lines = [
+            f"{offset + i}. ₹{e['amount']} | {e['desc']} | {e['category'].title()}"
+            for i, e in enumerate(expenses, 1)
+        ]
+    else:
+        expenses, after = get_group_expenses_page(page["group"], page.get("after", 0), EXPENSES_PAGE_SIZE)
+        lines = [
+            f"{offset + i}. ₹{e['amount']} | {e['desc']} | {e['category'].title()} "
+            f"(by {e['added_by']}, paid by {e.get('paid_by', e['added_by'])})"
+            for i, e in enumerate(expenses, 1)
+        ]
+
+    if after is None:
+        sess["temp"].pop("page", None)
+    else:
+        sess["temp"]["page"] = {**page, "after": after, "offset": offset + len(expenses)}
+        lines.append("➡️ Reply 'more' for the next page.")
+    return lines
+
+def show_more(ctx, reply, kind):
+    page = ctx.session["temp"].get("page")
+    if not page or page["kind"] != kind:
+        reply.body("📭 Nothing more to show.")
+    else:
+        reply.lines(page_lines(ctx, page))
+
+def member_group(ctx, reply, name):
+    # The named group if the sender belongs to it, otherwise None with the reason sent
+    group = ctx.group(name)
+    if not group:
+        reply.body(f"❌ No group named '{name}'.")
+        return None
+    if normalize(ctx.user) not in [normalize(m) for m in group["members"]]:
+        reply.body("❌ You're not a member of that group.")
+        return None
+    return group
+
+def parse_amount(text):
+    try:
+        amount = float(text)
+    except ValueError:
+        return None
+    return amount if math.isfinite(amount) and amount > 0 else None
+
+def batch_lines(cmd, lead):
+    # (line number, words) for each expense line of a multi-line add; a line
+    # may repeat the leading words of the first one, e.g. 'add' or 'add <group>'
+    rows = []
+    for number, line in enumerate(cmd.text.splitlines(), 1):
+        parts = line.split()
+        for word in lead:
+            if parts and parts[0].lower() == word.lower():
+                parts = parts[1:]
+        if parts:
+            rows.append((number, parts))
+    return rows
+
+def batch_errors(reply, rows, errors):
+    # True if the batch cannot be added, with the reasons sent
+    if not rows:
+        errors = ["No expenses found."]
+    elif len(rows) > MAX_BATCH_LINES:
+        errors = [f"At most {MAX_BATCH_LINES} expenses per message."]
+    if not errors:
+        return False
+    reply.lines(["❌ Nothing was added. Fix these and send the batch again:"] + errors)
+    return True
+
+# --- Start ---
+
+@router.fallback(None)
+def greet(ctx, cmd, reply):
+    reply.body(
+        "👋 Hello! Manage 'personal' or 'group' expenses?\n"
+        "Reply personal / group."
+    )
+    ctx.session["state"] = "awaiting_scope"
+    ctx.session["temp"] = {}
+
+@router.default
+def start_over(ctx, cmd, reply):
+    reset(ctx)
+    reply.body("🔄 Let's start over. personal / group?")
+
+@router.route("awaiting_scope", r"personal")
+def choose_personal(ctx, cmd, reply):
+    reply.body(
+        "🧑 Personal mode:\n"
+        "• add <amount> <desc> <category>\n"
+        "• view all\n"
+        "• view chart\n"
+        "Reply or 'back'."
+    )
+    ctx.session["state"] = "personal_menu"
+
+@router.route("awaiting_scope", r"group")
+def choose_group(ctx, cmd, reply):
+    reply.body(
+        "👥 Group mode:\n"
+        "• create group\n"
+        "• view groups\n"
+        "Reply or 'back'."
+    )
+    ctx.session["state"] = "group_menu"
+
+@router.fallback("awaiting_scope")
+def scope_help(ctx, cmd, reply):
+    reply.body("❓ Please reply 'personal' or 'group'.")
+
+@router.route("personal_menu", r"back")
+@router.route("group_menu", r"back")
+def back_to_main(ctx, cmd, reply):
+    reset(ctx)
+    reply.body("🔙 Back to main menu.")
+
+# --- Personal ---
+
+@router.route("personal_menu", r"add[^\n]*\n.*")
+def personal_add_batch(ctx, cmd, reply):
+    rows = batch_lines(cmd, ["add"])
+    expenses, errors = [], []
+    for number, parts in rows:
+        amt = parse_amount(parts[0])
+        if len(parts) < 3:
+            errors.append(f"Line {number}: use <amount> <desc> <category>")
+        elif amt is None:
+            errors.append(f"Line {number}: '{parts[0]}' is not an amount")
+        else:
+            expenses.append({"user": ctx.user, "amount": amt, "desc": parts[1], "category": parts[2]})
+    if batch_errors(reply, rows, errors):
+        return
+
+    for expense in expenses:
+        if not process_expense_payment(expense, ctx.user_id):
+            reply.body(f"❌ Failed to process payment for ₹{expense['amount']}. Nothing was added, please try again.")
+            return
+    add_expenses(expenses)
+
+    total = sum(e["amount"] for e in expenses)
+    reply.lines(
+        [f"✅ Added {len(expenses)} expenses:"]
+        + [f"• ₹{e['amount']} | {e['desc']} | {e['category'].title()}" for e in expenses]
+        + ["", f"Payment processed: ₹{total:.2f} deducted from your account."]
+    )
+
+@router.route("personal_menu", r"add(\s.*)?")
+def personal_add(ctx, cmd, reply):
+    if len(cmd.parts) < 4:
+        reply.body("❌ Invalid format. Use: add <amount> <desc> <category>")
+        return
+    amt = parse_amount(cmd.parts[1])
+    if amt is None:
+        reply.body("❌ Invalid amount. Use: add <amount> <desc> <category>")
+        return
+    desc, category = cmd.parts[2], cmd.parts[3]
+    expense = {
+        "user": ctx.user,
+        "amount": amt,
+        "desc": desc,
+        "category": category
+    }
+
+    # Process payment for the expense (just logging, no actual payment)
+    payment = process_expense_payment(expense, ctx.user_id)
+
+    if payment:
+        add_expense(expense)
+        reply.body(f"✅ Added ₹{amt} under {category.title()} for '{desc}'.\nPayment processed: ₹{amt} deducted from your account.")
+    else:
+        reply.body(f"❌ Failed to process payment for ₹{amt}. Please try again.")
+
+@router.route("personal_menu", r"view all")
+def personal_view_all(ctx, cmd, reply):
+    lines = page_lines(ctx, {"kind": "personal"})
+    if not lines:
+        reply.body("📭 No personal expenses yet.")
+    else:
+        reply.lines(["📋 Your Personal Expenses:"] + lines)
+
+@router.route("personal_menu", r"more|next")
+def personal_more(ctx, cmd, reply):
+    show_more(ctx, reply, "personal")
+
+@router.route("personal_menu", r"view chart")
+def personal_chart(ctx, cmd, reply):
+    enqueue(ctx.user, "personal_chart", base_url=ctx.base_url)
+    reply.body("📊 Preparing your spending chart, it will arrive in a moment...")
+
+@router.route("personal_menu", r"monthly review")
+def monthly_review(ctx, cmd, reply):
+    enqueue(ctx.user, "monthly_review")
+    reply.body("🤖 Generating AI-powered insights for your expenses...")
+
+@router.route("personal_menu", r"set budget")
+def start_budget(ctx, cmd, reply):
+    reply.body(
+        "💰 Set your monthly budget:\n"
+        "Format: category1 amount1 category2 amount2 ...\n"
+        "Example: food 5000 transport 2000 shopping 3000\n"
+        "Or 'back' to cancel."
+    )
+    ctx.session["state"] = "setting_budget"
+
+@router.route("personal_menu", r"view budget")
+def view_budget(ctx, cmd, reply):
+    budget = get_user_budget(ctx.user_id)
+    if not budget:
+        reply.body("📭 No budget set yet. Use 'set budget' to create one.")
+        return
+
+    usage = get_user_budget_usage(ctx.user_id)
+    out = "💰 Your Monthly Budget:\n\n"
+    total_budget = 0
+    total_spent = 0
+
+    for category, amount in budget.get("categories", {}).items():
+        spent = usage.get(category, 0)
+        remaining = amount - spent
+        total_budget += amount
+        total_spent += spent
+
+        out += f"{category.title()}: ₹{amount}\n"
+        out += f"Spent: ₹{spent}\n"
+        out += f"Remaining: ₹{remaining}\n\n"
+
+    out += f"Total Budget: ₹{total_budget}\n"
+    out += f"Total Spent: ₹{total_spent}\n"
+    out += f"Total Remaining: ₹{total_budget - total_spent}"
+
+    reply.body(out)
+
+@router.route("personal_menu", r"view trend")
+def view_trend(ctx, cmd, reply):
+    trend = get_monthly_trend(ctx.user_id)
+    if not trend:
+        reply.body("📭 No spending recorded in the last few months.")
+        return
+    out = "📈 Your Monthly Spending:\n\n"
+    for month, categories in trend.items():
+        top = max(categories, key=categories.get)
+        out += f"{month}: ₹{sum(categories.values()):.2f} (top: {top.title()})\n"
+    reply.body(out)
+
+@router.fallback("personal_menu")
+def personal_help(ctx, cmd, reply):
+    reply.body(
+        "❓ Personal options:\n"
+        "• add <amount> <desc> <category>\n"
+        "  (one per line after 'add' to add several)\n"
+        "• view all\n"
+        "• view chart\n"
+        "• get insights\n"
+        "• set budget\n"
+        "• view budget\n"
+        "• view trend\n"
+        "• back"
+    )
+
+@router.route("setting_budget", r"back")
+def cancel_budget(ctx, cmd, reply):
+    ctx.session["state"] = "personal_menu"
+    reply.body("🔙 Back to personal menu.")
+
+@router.fallback("setting_budget")
+def save_budget(ctx, cmd, reply):
+    try:
+        parts = cmd.parts
+        if len(parts) % 2 != 0:
+            raise ValueError("Invalid format")
+
+        budget_data = {"categories": {}}
+        for i in range(0, len(parts), 2):
+            category = parts[i].lower()
+            amount = float(parts[i + 1])
+            budget_data["categories"][category] = amount
+
+        set_user_budget(ctx.user_id, budget_data)
+
+        out = "✅ Budget set successfully:\n\n"
+        for category, amount in budget_data["categories"].items():
+            out += f"{category.title()}: ₹{amount}\n"
+
+        reply.body(out)
+        ctx.session["state"] = "personal_menu"
+    except (ValueError, IndexError):
+        reply.body(
+            "❌ Invalid format. Use:\n"
+            "category1 amount1 category2 amount2 ...\n"
+            "Example: food 5000 transport 2000 shopping 3000\n"
+            "Or 'back' to cancel."
+        )
+
+# --- Groups ---
+
+@router.route("group_menu", r"create group")
+def create_group(ctx, cmd, reply):
+    reply.body("➕ Enter new group name:")
+    ctx.session["state"] = "creating_group_name"
+
+@router.route("group_menu", r"view groups")
+def view_groups(ctx, cmd, reply):
+    mine = get_user_groups(ctx.user)
+    if not mine:
+        reply.body("📭 You're not in any groups.\nReply 'create group' or 'back'.")
+        return
+    out = "👥 Your Groups:\n"
+    for g in mine:
+        out += f"- {g['name']} (Members: {', '.join(g['members'])})\n"
+    out += (
+        "\nTo add expense:\n"
+        "add <group_name> <amount> <desc> <category> <paid_by>\n"
+        "To view expenses:\n"
+        "view expenses <group_name>\n"
+        "To view chart:\n"
+        "view chart <group_name>\n"
+        "To view balances:\n"
+        "view balances <group_name>\n"
+        "To pay your share:\n"
+        "pay share <group_name>\n"
+        "Or 'back'."
+    )
+    reply.body(out)
+
+@router.route("group_menu", r"pay share(\s.*)?")
+def pay_share(ctx, cmd, reply):
+    grp = cmd.arg(2)
+    if grp is None:
+        reply.body("❌ Invalid format. Use: pay share <group_name>")
+        return
+    if member_group(ctx, reply, grp):
+        enqueue(ctx.user, "pay_share", group_name=grp)
+        reply.body(f"💳 Working out your share in group '{grp}', you'll get a confirmation shortly...")
+
+@router.route("group_menu", r"view balances(\s.*)?")
+def view_balances(ctx, cmd, reply):
+    grp = cmd.arg(2)
+    if grp is None:
+        reply.body("❌ Invalid format. Use: view balances <group_name>")
+        return
+    group = member_group(ctx, reply, grp)
+    if not group:
+        return
+
+    balances = calculate_group_balances(group)
+    if not balances:
+        reply.body(f"📭 No expenses in group '{grp}' to calculate balances.")
+        return
+
+    out = f"💰 Balances in group '{grp}':\n\n"
+
+    out += "📊 Latest Expenses:\n"
+    expense_count = group.get("expense_count", 0)
+    recent = get_group_expenses(grp, after_seq=max(0, expense_count - EXPENSES_PAGE_SIZE), limit=EXPENSES_PAGE_SIZE)
+    for expense in recent:
+        out += f"- {expense.get('paid_by', expense.get('added_by'))} paid ₹{expense['amount']} for {expense['desc']}\n"
+    if expense_count > len(recent):
+        out += f"…and {expense_count - len(recent)} earlier (view expenses {grp})\n"
+
+    out += "\n💰 Net Balances:\n"
+    display = {normalize(m): m for m in group["members"]}
+    for member, balance in balances.items():
+        original_member = display[member]
+        if balance > 0:
+            out += f"- {original_member} is owed ₹{balance:.2f}\n"
+        elif balance < 0:
+            out += f"- {original_member} owes ₹{abs(balance):.2f}\n"
+        else:
+            out += f"- {original_member} is settled\n"
+
+    out += "\n🔄 Settlement Plan:\n"
+    for debtor, creditor, paise in plan_settlements(balances, exact=True):
+        out += f"- {display[debtor]} should pay ₹{paise / 100:.2f} to {display[creditor]}\n"
+
+    # Add option to pay your share
+    user_balance = balances.get(normalize(ctx.user), 0)
+    if user_balance < 0:
+        out += f"\n💳 To pay your share of ₹{abs(user_balance):.2f}, reply: pay share {grp}"
+
+    reply.body(out)
+
+@router.route("group_menu", r"view chart(\s.*)?")
+def group_chart(ctx, cmd, reply):
+    grp = cmd.arg(2)
+    if grp is None:
+        reply.body("❌ Invalid format. Use: view chart <group_name>")
+        return
+    group = member_group(ctx, reply, grp)
+    if not group:
+        return
+    if not group.get("expense_count"):
+        reply.body(f"📭 No expenses in group '{grp}' to chart.")
+    else:
+        enqueue(ctx.user, "group_chart", group_name=grp, base_url=ctx.base_url)
+        reply.body(f"📊 Preparing the chart for group '{grp}', it will arrive in a moment...")
+
+@router.route("group_menu", r"view expenses(\s.*)?")
+def group_expenses(ctx, cmd, reply):
+    grp = cmd.arg(2)
+    if grp is None:
+        reply.body("❌ Invalid format. Use: view expenses <group_name>")
+        return
+    group = member_group(ctx, reply, grp)
+    if not group:
+        return
+    if not group.get("expense_count"):
+        reply.body(f"📭 No expenses in group '{grp}' yet.")
+    else:
+        lines = page_lines(ctx, {"kind": "group", "group": grp})
+        reply.lines(
+            [f"📋 Expenses in group '{grp}':"]
+            + lines
+            + ["", f"💰 Total: ₹{group_total(group)}"]
+        )
+
+@router.route("group_menu", r"add[^\n]*\n.*")
+def group_add_batch(ctx, cmd, reply):
+    first = cmd.text.splitlines()[0].split()
+    if len(first) < 2:
+        reply.body("❌ Invalid format. Start with: add <group_name>, then one <amount> <desc> <category> <paid_by> per line")
+        return
+    grp = first[1]
+    group = member_group(ctx, reply, grp)
+    if not group:
+        return
+
+    members = [normalize(m) for m in group["members"]]
+    rows = batch_lines(cmd, ["add", grp])
+    expenses, errors = [], []
+    for number, parts in rows:
+        amt = parse_amount(parts[0])
+        if len(parts) < 4:
+            errors.append(f"Line {number}: use <amount> <desc> <category> <paid_by>")
+        elif amt is None:
+            errors.append(f"Line {number}: '{parts[0]}' is not an amount")
+        elif normalize(parts[3]) not in members:
+            errors.append(f"Line {number}: {parts[3]} is not a member of this group")
+        else:
+            expenses.append({
+                "added_by": ctx.user,
+                "amount": amt,
+                "desc": parts[1],
+                "category": parts[2],
+                "paid_by": parts[3]
+            })
+    if batch_errors(reply, rows, errors):
+        return
+
+    # Same payments as one add each: the full amount for what the sender
+    # paid, their share of what someone else paid
+    deducted = 0
+    for expense in expenses:
+        mine = normalize(expense["paid_by"]) == normalize(ctx.user)
+        amount = expense["amount"] if mine else expense["amount"] / len(members)
+        if not process_expense_payment({
+            "user": ctx.user,
+            "amount": amount,
+            "desc": f"{expense['desc']} in {grp}" if mine else f"Share of {expense['desc']} in {grp}",
+            "category": expense["category"]
+        }, ctx.user_id):
+            reply.body(f"❌ Failed to process payment for ₹{amount:.2f}. Nothing was added, please try again.")
+            return
+        if not mine:
+            deducted += amount
+
+    if not add_group_expenses(group, expenses):
+        reply.body("❌ Failed to log these expenses. Please try again.")
+        return
+
+    lines = [f"✅ Added {len(expenses)} expenses to '{grp}':"] + [
+        f"• ₹{e['amount']} | {e['desc']} | {e['category'].title()} (paid by "
+        f"{'you' if normalize(e['paid_by']) == normalize(ctx.user) else e['paid_by']})"
+        for e in expenses
+    ]
+    if deducted:
+        lines += ["", f"Your share of ₹{deducted:.2f} has been deducted from your account."]
+    reply.lines(lines)
+
+@router.route("group_menu", r"add(\s.*)?")
+def group_add(ctx, cmd, reply):
+    if len(cmd.parts) < 6:
+        reply.body("❌ Invalid format. Use: add <group_name> <amount> <desc> <category> <paid_by>")
+        return
+    grp, amt_s, desc, cat, paid_by = cmd.parts[1:6]
+    amt = parse_amount(amt_s)
+    if amt is None:
+        reply.body("❌ Invalid amount. Use: add <group_name> <amount> <desc> <category> <paid_by>")
+        return
+
+    group = member_group(ctx, reply, grp)
+    if not group:
+        return
+    if normalize(paid_by) not in [normalize(m) for m in group["members"]]:
+        reply.body("❌ The person who paid is not a member of this group.")
+        return
+
+    user = ctx.user
+    expense = {
+        "added_by": user,
+        "amount": amt,
+        "desc": desc,
+        "category": cat,
+        "paid_by": paid_by
+    }
+
+    # Calculate the user's share of the expense
+    num_members = len(group["members"])
+    user_share = amt / num_members
+
+    # Process payment for the user's share of the expense
+    # If the user is the one who paid, no need to deduct their share as they've already paid the full amount in real life
+    if normalize(user) == normalize(paid_by):
+        payment = process_expense_payment({
+            "user": user,
+            "amount": amt,
+            "desc": f"{desc} in {grp}",
+            "category": cat
+        }, ctx.user_id)
+
+        if payment and add_group_expense(group, expense):
+            reply.body(f"✅ Added ₹{amt} to '{grp}' under {cat.title()} for '{desc}' (paid by you).\nExpense logged successfully.")
+        else:
+            reply.body(f"❌ Failed to log expense for ₹{amt}. Please try again.")
+    else:
+        payment = process_expense_payment({
+            "user": user,
+            "amount": user_share,
+            "desc": f"Share of {desc} in {grp}",
+            "category": cat
+        }, ctx.user_id)
+
+        if payment and add_group_expense(group, expense):
+            reply.body(f"✅ Added ₹{amt} to '{grp}' under {cat.title()} for '{desc}' (paid by {paid_by}).\nYour share of ₹{user_share:.2f} has been deducted from your account.")
+        else:
+            reply.body(f"❌ Failed to process payment for your share of ₹{user_share:.2f}. Please try again.")
+
+@router.route("group_menu", r"more|next")
+def group_more(ctx, cmd, reply):
+    show_more(ctx, reply, "group")
+
+@router.fallback("group_menu")
+def group_help(ctx, cmd, reply):
+    reply.body(
+        "❓ Group options:\n"
+        "• create group\n"
+        "• add <group> <amount> <desc> <category> <paid_by>\n"
+        "  (one per line after 'add <group>' to add several)\n"
+        "• view groups\n"
+        "• back"
+    )
+
+@router.fallback("creating_group_name")
+def name_group(ctx, cmd, reply):
+    name = cmd.text
+    if ctx.group(name):
+        reply.body("❌ That name's taken. Enter another group name:")
+        return
+    ctx.session["temp"]["group_name"] = name
+    ctx.session["state"] = "creating_group_members"
+    reply.body(
+        "👥 Now enter members' phone numbers (E.164),\n"
+        "separated by spaces (include yourself)."
+    )
+
+@router.fallback("creating_group_members")
+def add_group_members(ctx, cmd, reply):
+    members = cmd.parts
+    if not all(m.startswith("+") for m in members):
+        reply.body(
+            "❌ Invalid format. Use E.164 (e.g. +123456789).\n"
+            "Try again:"
+        )
+        return
+    name = ctx.session["temp"]["group_name"]
+    group = {"name": name, "members": members}
+    add_group(group)
+    reply.body(
+        f"✅ Group '{name}' created with members {', '.join(members)}.\n"
+        "You can now add group expenses:\n"
+        "add <group_name> <amount> <desc> <category> <paid_by>\n"
+        "Or 'view groups', 'back'."
+    )
+    ctx.session["state"] = "group_menu"
+    ctx.session["temp"] = {}
@@ -0,0 +1,51 @@
+from utils.metrics import span
+from models.data import (
+    get_user_id, add_phone_to_user,
+    get_session, save_session,
+    get_group_by_name
+)
+
+class DataContext:
+    # Everything a single webhook call may need, loaded on first use and memoized
+    # for the rest of the request so each piece costs at most one round trip.
+
+    def __init__(self, user, base_url=None):
+        self.user = user
+        self.base_url = base_url
+        self._user_id = None
+        self._session = None
+        self._groups = {}
+
+    def prefill(self, user_id=None, session=None, groups=None):
+        # Seeds values that were fetched ahead of time, e.g. concurrently by
+        # the async app, so the handlers do not look them up again
+        if user_id is not None:
+            self._user_id = user_id
+        if session is not None:
+            self._session = session
+        self._groups.update(groups or {})
+
+    @property
+    def user_id(self):
+        if self._user_id is None:
+            with span('identity'):
+                self._user_id = get_user_id(self.user)
+                add_phone_to_user(self._user_id, self.user)
+        return self._user_id
+
+    @property
+    def session(self):
+        if self._session is None:
+            with span('session_load'):
+                self._session = get_session(self.user)
+        return self._session
+
+    def save_session(self):
+        if self._session is not None:
+            with span('session_save'):
+                save_session(self.user, self._session)
+
+    def group(self, name):
+        if name not in self._groups:
+            self._groups[name] = get_group_by_name(name)
+        return self._groups[name]
@@ -1,20 +1,41 @@
-from models.mongodb import (
-    load_expenses, save_expenses,
-    load_groups, save_groups,
-    load_sessions, save_sessions,
-    add_expense, add_group, update_group,
-    get_group_by_name, get_user_expenses,
-    get_user_groups, get_user_id, add_phone_to_user,
-    get_user_budget, set_user_budget, get_user_budget_usage
-)
+import importlib
+import os
+from dotenv import load_dotenv
 
-# Re-export the functions
+load_dotenv()
+
+# 'mongo' by default; 'sqlite' keeps everything in one local file (SQLITE_PATH)
+# for single-node deployments without a Mongo server
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongo').lower()
+
+# Both backends implement the same functions under the same names; these are
+# the ones the rest of the app uses
 __all__ = [
-    'load_expenses', 'save_expenses',
-    'load_groups', 'save_groups',
-    'load_sessions', 'save_sessions',
-    'add_expense', 'add_group', 'update_group',
-    'get_group_by_name', 'get_user_expenses',
+    'load_expenses', 'save_expenses', 'load_groups', 'save_groups', 'load_sessions', 'save_sessions',
+    'get_session', 'save_session', 'delete_session',
+    'add_expense', 'add_expenses', 'import_expenses', 'add_group', 'update_group',
+    'add_group_expense', 'add_group_expenses', 'get_group_expenses', 'get_group_expenses_page',
+    'get_group_category_totals', 'get_user_expenses_page',
+    'migrate_group_expenses', 'rebuild_group_ledger', 'verify_group_ledger',
+    'get_group_by_name', 'get_group_names', 'get_user_expenses',
+    'iter_user_expenses', 'iter_user_group_expenses',
     'get_user_groups', 'get_user_id', 'add_phone_to_user',
-    'get_user_budget', 'set_user_budget', 'get_user_budget_usage'
-] 
\ No newline at end of file
+    'resolve_identity', 'resolve_many', 'get_identity_by_user_id',
+    'identity_cache_stats',
+    'get_user_budget', 'set_user_budget', 'get_user_budget_usage',
+    'get_user_category_totals', 'get_category_totals', 'month_bounds',
+    'get_monthly_rollup', 'get_monthly_trend', 'get_expense_version',
+    'get_cached_insights', 'save_cached_insights',
+    'rebuild_monthly_rollups', 'check_monthly_rollups',
+    'record_payment', 'get_payment', 'claim_message', 'store_message_response', 'release_message',
+    'enqueue_job', 'claim_job', 'save_job_result', 'complete_job', 'fail_job',
+    'get_dead_jobs', 'requeue_dead_jobs',
+    'ensure_indexes', 'verify_query_plans', 'check_health'
+]
+
+BACKENDS = {'mongo': 'models.mongodb', 'sqlite': 'models.sqlite'}
+if STORAGE_BACKEND not in BACKENDS:
+    raise ValueError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', expected 'mongo' or 'sqlite'")
+
+_backend = importlib.import_module(BACKENDS[STORAGE_BACKEND])
+globals().update({name: getattr(_backend, name) for name in __all__})
@@ -0,0 +1,76 @@
+import argparse
+import sys
+
+from models.data import (
+    STORAGE_BACKEND,
+    ensure_indexes, verify_query_plans,
+    get_group_names, rebuild_group_ledger, verify_group_ledger, migrate_group_expenses,
+    rebuild_monthly_rollups, check_monthly_rollups,
+)
+
+COMMANDS = [
+    'ensure-indexes', 'verify-indexes',
+    'rebuild-ledgers', 'verify-ledgers',
+    'migrate-group-expenses',
+    'rebuild-rollups', 'check-rollups'
+]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=f"ExpenseBot database maintenance ({STORAGE_BACKEND} backend)")
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--group', help="limit ledger commands to one group")
+    parser.add_argument('--user-id', help="limit rollup commands to one user")
+    args = parser.parse_args(argv)
+
+    def group_names():
+        if args.group:
+            return [args.group]
+        return get_group_names()
+
+    if args.command == 'ensure-indexes':
+        failed = ensure_indexes(force=True)
+        print("Indexes ready." if not failed else f"{len(failed)} index(es) could not be created.")
+        return 1 if failed else 0
+
+    if args.command == 'verify-indexes':
+        scans = verify_query_plans()
+        for collection_name, query in scans:
+            print(f"Full scan: {collection_name} {query}")
+        print("All queries use an index." if not scans else f"{len(scans)} query shape(s) fall back to a full scan.")
+        return 1 if scans else 0
+
+    if args.command == 'rebuild-ledgers':
+        for name in group_names():
+            rebuild_group_ledger(name)
+            print(f"Rebuilt ledger for '{name}'.")
+
+    if args.command == 'verify-ledgers':
+        drifted = 0
+        for name in group_names():
+            drift = verify_group_ledger(name)
+            if drift:
+                drifted += 1
+                print(f"Ledger drift in '{name}': {drift}")
+        print("All ledgers match their expenses." if not drifted else f"{drifted} group(s) drifted.")
+        return 1 if drifted else 0
+
+    if args.command == 'migrate-group-expenses':
+        for name in group_names():
+            moved = migrate_group_expenses(name)
+            if moved:
+                print(f"Moved {moved} expense(s) out of '{name}'.")
+
+    if args.command == 'rebuild-rollups':
+        print(f"Rebuilt {rebuild_monthly_rollups(args.user_id)} rollup row(s).")
+
+    if args.command == 'check-rollups':
+        mismatches = check_monthly_rollups(args.user_id)
+        for mismatch in mismatches:
+            print(f"Rollup mismatch {mismatch['key']}: expected {mismatch['expected']}, stored {mismatch['stored']}")
+        print("Rollups match expenses." if not mismatches else f"{len(mismatches)} rollup(s) out of date.")
+        return 1 if mismatches else 0
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,57 +1,262 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, ReturnDocument, UpdateOne, ReadPreference
+from pymongo.errors import OperationFailure, BulkWriteError, DuplicateKeyError, PyMongoError
 from datetime import datetime, timedelta
 from bson import ObjectId
 import os
 from dotenv import load_dotenv
+import copy
 import re
+import threading
+import time
+
+from utils.cache import LRUCache
+from utils.helpers import normalize
+from utils.balance import ledger_increments, compute_group_ledger
+from utils.log import get_logger, fields
+from utils.metrics import MongoCommandTimer, PoolStats
+
+log = get_logger('db')
 
 # Load environment variables
 load_dotenv()
 
-# MongoDB connection
-client = MongoClient(os.getenv('MONGODB_URI', 'mongodb://localhost:27017/'))
-db = client[os.getenv('MONGODB_DB', 'expense_tracker')]
+# MongoDB connection settings
+MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
+MONGODB_DB = os.getenv('MONGODB_DB', 'expense_tracker')
+MONGODB_OPTIONS = {
+    'maxPoolSize': int(os.getenv('MONGODB_MAX_POOL_SIZE', 50)),
+    'minPoolSize': int(os.getenv('MONGODB_MIN_POOL_SIZE', 0)),
+    'connectTimeoutMS': int(os.getenv('MONGODB_CONNECT_TIMEOUT_MS', 5000)),
+    'socketTimeoutMS': int(os.getenv('MONGODB_SOCKET_TIMEOUT_MS', 10000)),
+    'serverSelectionTimeoutMS': int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+    'waitQueueTimeoutMS': int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', 2000)),
+    'retryWrites': os.getenv('MONGODB_RETRY_WRITES', 'true').lower() in ('1', 'true', 'yes'),
+    'readPreference': os.getenv('MONGODB_READ_PREFERENCE', 'primary'),
+}
+# Reads that can tolerate replication lag (charts, trends, exports) may go to
+# a secondary; anything read back right after a write stays on the primary
+SECONDARY_READS = os.getenv('MONGODB_SECONDARY_READS', '').lower() in ('1', 'true', 'yes')
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+pool_stats = PoolStats()
+
+def get_client():
+    # Created on first use and again in each forked worker, since a client's
+    # sockets and monitor threads must not be shared across a fork
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = MongoClient(
+                MONGODB_URI,
+                event_listeners=[MongoCommandTimer(), pool_stats],
+                **MONGODB_OPTIONS
+            )
+            _client_pid = os.getpid()
+        return _client
+
+def get_db():
+    return get_client()[MONGODB_DB]
+
+class _LazyCollection:
+    # Stands in for a pymongo Collection until the first call, then forwards to
+    # the current process's client
+
+    def __init__(self, name):
+        self.name = name
+        self._pid = None
+        self._collection = None
+        self._reader = None
+
+    def _current(self):
+        if self._pid != os.getpid():
+            collection = get_db()[self.name]
+            self._collection = collection
+            self._reader = collection.with_options(
+                read_preference=ReadPreference.SECONDARY_PREFERRED
+            ) if SECONDARY_READS else collection
+            self._pid = os.getpid()
+        return self._collection
+
+    def reader(self):
+        # For read-only queries that may be served by a secondary
+        self._current()
+        return self._reader
+
+    def __getattr__(self, attr):
+        return getattr(self._current(), attr)
 
 # Collections
-expenses_collection = db['expenses']
-groups_collection = db['groups']
-sessions_collection = db['sessions']
-user_mappings_collection = db['user_mappings']
-budgets_collection = db['budgets']
+expenses_collection = _LazyCollection('expenses')
+groups_collection = _LazyCollection('groups')
+group_expenses_collection = _LazyCollection('group_expenses')
+sessions_collection = _LazyCollection('sessions')
+user_mappings_collection = _LazyCollection('user_mappings')
+budgets_collection = _LazyCollection('budgets')
+monthly_rollups_collection = _LazyCollection('monthly_rollups')
+jobs_collection = _LazyCollection('jobs')
+payments_collection = _LazyCollection('payments')
+processed_messages_collection = _LazyCollection('processed_messages')
+insights_cache_collection = _LazyCollection('insights_cache')
 
-def get_user_id(phone_number):
-    normalized_phone = phone_number.strip().replace(" ", "").replace("-", "").replace("whatsapp:", "").lstrip("+")
-    
-    mapping = user_mappings_collection.find_one({"phone_numbers": normalized_phone})
-    
-    if mapping:
-        return mapping["user_id"]
-    
-    user_id = str(ObjectId())
-    user_mappings_collection.insert_one({
-        "user_id": user_id,
+# Sessions idle for longer than this are dropped (TTL index on updated_at)
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', 7 * 24 * 3600))
+
+# Optional in-process write-through cache, only safe with a single worker process
+_session_cache = LRUCache(
+    maxsize=int(os.getenv('SESSION_CACHE_SIZE', 10000)),
+    ttl=SESSION_TTL_SECONDS
+) if os.getenv('SESSION_CACHE_ENABLED', '').lower() in ('1', 'true', 'yes') else None
+
+# Twilio retries a webhook for a while after a slow response; remember
+# what we answered for long enough to replay it
+MESSAGE_DEDUP_TTL_SECONDS = int(os.getenv('MESSAGE_DEDUP_TTL_SECONDS', 24 * 3600))
+_message_cache = LRUCache(
+    maxsize=int(os.getenv('MESSAGE_DEDUP_CACHE_SIZE', 10000)),
+    ttl=MESSAGE_DEDUP_TTL_SECONDS
+)
+
+# Monthly reviews shared between worker processes (INSIGHTS_CACHE_SHARED)
+INSIGHTS_CACHE_TTL_SECONDS = int(os.getenv('INSIGHTS_CACHE_TTL_SECONDS', 31 * 24 * 3600))
+
+_indexes_ready = False
+
+# (collection, keys, options) for every index the queries below rely on
+INDEXES = [
+    ('user_mappings', [('phone_numbers', ASCENDING)], {}),
+    ('user_mappings', [('user_id', ASCENDING)], {'unique': True}),
+    ('expenses', [('user', ASCENDING), ('created_at', ASCENDING), ('_id', ASCENDING)], {}),
+    ('groups', [('name', ASCENDING)], {'unique': True}),
+    ('groups', [('members', ASCENDING)], {}),
+    ('group_expenses', [('group', ASCENDING), ('seq', ASCENDING)], {'unique': True}),
+    ('budgets', [('user_id', ASCENDING)], {'unique': True}),
+    ('monthly_rollups', [('user_id', ASCENDING), ('month', ASCENDING), ('category', ASCENDING)], {'unique': True}),
+    ('jobs', [('status', ASCENDING), ('available_at', ASCENDING), ('created_at', ASCENDING)], {}),
+    ('jobs', [('user', ASCENDING), ('status', ASCENDING), ('created_at', ASCENDING)], {}),
+    ('expenses', [('payment.payment_id', ASCENDING)], {'unique': True, 'partialFilterExpression': {'payment.payment_id': {'$exists': True}}}),
+    ('expenses', [('import_hash', ASCENDING)], {'unique': True, 'partialFilterExpression': {'import_hash': {'$exists': True}}}),
+    ('payments', [('payment_id', ASCENDING)], {'unique': True}),
+    ('processed_messages', [('created_at', ASCENDING)], {'expireAfterSeconds': MESSAGE_DEDUP_TTL_SECONDS}),
+    ('sessions', [('user', ASCENDING)], {'unique': True}),
+    ('sessions', [('updated_at', ASCENDING)], {'expireAfterSeconds': SESSION_TTL_SECONDS}),
+    ('insights_cache', [('created_at', ASCENDING)], {'expireAfterSeconds': INSIGHTS_CACHE_TTL_SECONDS}),
+]
+
+# Phone -> identity cache shared by every lookup in this process
+_identity_cache = LRUCache(
+    maxsize=int(os.getenv('IDENTITY_CACHE_SIZE', 10000)),
+    ttl=int(os.getenv('IDENTITY_CACHE_TTL', 300))
+)
+
+def remember_identity(mapping):
+    # For identities looked up elsewhere (e.g. by the async app) so later
+    # lookups in this process are served from the cache
+    return _cache_identity(mapping)
+
+def _cache_identity(mapping):
+    identity = {
+        "user_id": mapping["user_id"],
+        "phone_numbers": list(mapping.get("phone_numbers", []))
+    }
+    _identity_cache.set(("user", identity["user_id"]), identity)
+    for phone in identity["phone_numbers"]:
+        _identity_cache.set(("phone", phone), identity)
+    return identity
+
+def _forget_identity(identity):
+    _identity_cache.pop(("user", identity["user_id"]))
+    for phone in identity["phone_numbers"]:
+        _identity_cache.pop(("phone", phone))
+
+def _create_identity(normalized_phone):
+    mapping = {
+        "user_id": str(ObjectId()),
         "phone_numbers": [normalized_phone],
         "created_at": datetime.utcnow()
-    })
-    
-    return user_id
+    }
+    user_mappings_collection.insert_one(mapping)
+    return mapping
 
-def add_phone_to_user(user_id, phone_number):
-    normalized_phone = phone_number.strip().replace(" ", "").replace("-", "").replace("whatsapp:", "").lstrip("+")
-    
-    mapping = user_mappings_collection.find_one({
-        "user_id": user_id,
-        "phone_numbers": normalized_phone
-    })
-    
+def resolve_identity(phone_number, create=True):
+    normalized_phone = normalize(phone_number)
+
+    identity = _identity_cache.get(("phone", normalized_phone))
+    if identity is not None:
+        return identity
+
+    mapping = user_mappings_collection.find_one(
+        {"phone_numbers": normalized_phone},
+        {"_id": 0, "user_id": 1, "phone_numbers": 1}
+    )
     if not mapping:
-        user_mappings_collection.update_one(
-            {"user_id": user_id},
-            {"$addToSet": {"phone_numbers": normalized_phone}}
-        )
-        return True
-    
-    return False
+        if not create:
+            return None
+        mapping = _create_identity(normalized_phone)
+
+    return _cache_identity(mapping)
+
+def resolve_many(phone_numbers, create=True):
+    normalized = {normalize(phone) for phone in phone_numbers}
+
+    resolved = {}
+    missing = []
+    for phone in normalized:
+        identity = _identity_cache.get(("phone", phone))
+        if identity is not None:
+            resolved[phone] = identity
+        else:
+            missing.append(phone)
+
+    if missing:
+        for mapping in user_mappings_collection.find(
+            {"phone_numbers": {"$in": missing}},
+            {"_id": 0, "user_id": 1, "phone_numbers": 1}
+        ):
+            identity = _cache_identity(mapping)
+            for phone in identity["phone_numbers"]:
+                if phone in normalized:
+                    resolved[phone] = identity
+
+        if create:
+            for phone in missing:
+                if phone not in resolved:
+                    resolved[phone] = _cache_identity(_create_identity(phone))
+
+    return resolved
+
+def get_identity_by_user_id(user_id):
+    identity = _identity_cache.get(("user", user_id))
+    if identity is not None:
+        return identity
+
+    mapping = user_mappings_collection.find_one(
+        {"user_id": user_id},
+        {"_id": 0, "user_id": 1, "phone_numbers": 1}
+    )
+    return _cache_identity(mapping) if mapping else None
+
+def identity_cache_stats():
+    return _identity_cache.stats()
+
+def get_user_id(phone_number):
+    return resolve_identity(phone_number)["user_id"]
+
+def add_phone_to_user(user_id, phone_number):
+    normalized_phone = normalize(phone_number)
+
+    identity = get_identity_by_user_id(user_id)
+    if identity and normalized_phone in identity["phone_numbers"]:
+        return False
+
+    user_mappings_collection.update_one(
+        {"user_id": user_id},
+        {"$addToSet": {"phone_numbers": normalized_phone}}
+    )
+    if identity:
+        _forget_identity(identity)
+    _identity_cache.pop(("phone", normalized_phone))
+    return True
 
 def load_expenses():
     return list(expenses_collection.find({}, {'_id': 0}))
@@ -78,13 +283,295 @@ def save_sessions(sessions):
         session_docs = [{'user': user, 'data': data} for user, data in sessions.items()]
         sessions_collection.insert_many(session_docs)
 
+SESSION_PROJECTION = {'_id': 0, 'data': 1, 'updated_at': 1}
+
+def _new_session():
+    return {"state": None, "temp": {}}
+
+def get_session(phone_number):
+    key = normalize(phone_number)
+
+    if _session_cache is not None:
+        cached = _session_cache.get(key)
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+    doc = sessions_collection.find_one({'user': key}, SESSION_PROJECTION)
+    data = session_from_doc(doc)
+    if doc and _session_cache is not None:
+        _session_cache.set(key, copy.deepcopy(data))
+    return data
+
+def session_from_doc(doc):
+    if not doc:
+        return _new_session()
+
+    # The TTL monitor only runs periodically, so expire stale sessions on read too
+    updated_at = doc.get('updated_at')
+    if updated_at and datetime.utcnow() - updated_at > timedelta(seconds=SESSION_TTL_SECONDS):
+        return _new_session()
+
+    return doc.get('data') or _new_session()
+
+def save_session(phone_number, data):
+    key = normalize(phone_number)
+    sessions_collection.update_one(
+        {'user': key},
+        {'$set': {'data': data, 'updated_at': datetime.utcnow()}},
+        upsert=True
+    )
+    if _session_cache is not None:
+        _session_cache.set(key, copy.deepcopy(data))
+
+def delete_session(phone_number):
+    key = normalize(phone_number)
+    sessions_collection.delete_one({'user': key})
+    if _session_cache is not None:
+        _session_cache.pop(key)
+
+def _apply_rollups(user_id, expenses):
+    # One upsert per (month, category) touched, however many expenses there are
+    increments = {}
+    for expense in expenses:
+        key = (expense['created_at'].strftime("%Y-%m"), expense.get('category', 'other'))
+        total, count = increments.get(key, (0, 0))
+        increments[key] = (total + expense['amount'], count + 1)
+
+    if not increments:
+        return
+    monthly_rollups_collection.bulk_write([
+        UpdateOne(
+            {'user_id': user_id, 'month': month, 'category': category},
+            {'$inc': {'total': total, 'count': count}},
+            upsert=True
+        )
+        for (month, category), (total, count) in increments.items()
+    ], ordered=False)
+    _bump_expense_version({'user_id': user_id})
+
+def _bump_expense_version(match):
+    # Anything computed from a user's rollups is stale once this moves on
+    user_mappings_collection.update_many(match, {'$inc': {'expense_version': 1}})
+
+def get_expense_version(user_id):
+    mapping = user_mappings_collection.find_one({'user_id': user_id}, {'_id': 0, 'expense_version': 1})
+    return (mapping or {}).get('expense_version', 0)
+
 def add_expense(expense):
-    expense['created_at'] = datetime.utcnow()
-    expenses_collection.insert_one(expense)
+    add_expenses([expense])
+
+def add_expenses(expenses):
+    # One user's expenses from a single message: one insert, one rollup write
+    now = datetime.utcnow()
+    for expense in expenses:
+        expense['created_at'] = now
+    expenses_collection.insert_many(expenses)
+    for expense in expenses:
+        expense.pop('_id', None)
+    _apply_rollups(get_user_id(expenses[0]['user']), expenses)
+
+def import_expenses(user_id, expenses):
+    # Rows already imported are rejected by the import_hash index; the rest of
+    # the batch still goes in and only those rows reach the rollups
+    if not expenses:
+        return 0, 0
+    failed, duplicates, error = set(), 0, None
+    try:
+        expenses_collection.insert_many(expenses, ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details.get('writeErrors', []):
+            failed.add(write_error['index'])
+            if write_error.get('code') == 11000:
+                duplicates += 1
+            else:
+                error = e
+    inserted = [expense for i, expense in enumerate(expenses) if i not in failed]
+    _apply_rollups(user_id, inserted)
+    if error is not None:
+        raise error
+    return len(inserted), duplicates
 
 def add_group(group):
-    group['created_at'] = datetime.utcnow()
+    # Expenses that come with a new group are written in one batch; nobody
+    # else can be adding to a group that does not exist yet
+    expenses = group.pop('expenses', [])
+    now = datetime.utcnow()
+    for seq, expense in enumerate(expenses, 1):
+        expense['group'] = group['name']
+        expense['seq'] = seq
+        expense.setdefault('created_at', now)
+    group.setdefault('created_at', now)
+    group['ledger'] = compute_group_ledger(group['members'], expenses)
+    group['expense_count'] = len(expenses)
+    group['version'] = len(expenses)
     groups_collection.insert_one(group)
+    if expenses:
+        group_expenses_collection.insert_many(expenses, ordered=False)
+
+def _version_filter(name, version):
+    # Groups migrated from the embedded layout may not carry a version yet
+    return {'name': name, 'version': version if version else {'$in': [0, None]}}
+
+def _batch_increments(members, expenses):
+    increments = {}
+    for expense in expenses:
+        for key, value in ledger_increments(members, expense['amount'], expense['paid_by']).items():
+            increments[key] = increments.get(key, 0) + value
+    return increments
+
+def add_group_expense(group, expense, retries=3):
+    return add_group_expenses(group, [expense], retries)
+
+def _undo_group_expenses(name, increments, first, last):
+    # The ledger was bumped but the expenses did not all land: drop the ones
+    # that did and take their amounts back out. The version is left as is, so
+    # the seqs stay used and are never handed to a concurrent writer twice
+    try:
+        group_expenses_collection.delete_many({'group': name, 'seq': {'$gte': first, '$lte': last}})
+        groups_collection.update_one(
+            {'name': name},
+            {'$inc': {
+                **{key: -amount for key, amount in increments.items()},
+                'expense_count': -(last - first + 1)
+            }}
+        )
+    except PyMongoError as e:
+        log.error("could not undo a failed group expense insert, run rebuild-ledgers",
+                  extra=fields(group=name, first_seq=first, last_seq=last, error=str(e)))
+
+def add_group_expenses(group, expenses, retries=3):
+    name = group['name']
+    for _ in range(retries):
+        # Bump the version and the per-member totals together; a concurrent
+        # write moves the version on and makes this one retry with fresh members
+        increments = _batch_increments(group['members'], expenses)
+        updated = groups_collection.find_one_and_update(
+            _version_filter(name, group.get('version', 0)),
+            {'$inc': {
+                **increments,
+                'expense_count': len(expenses),
+                'version': len(expenses)
+            }},
+            projection={'_id': 0, 'version': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated:
+            # The batch owns the seqs between the old version and the new one
+            now = datetime.utcnow()
+            first = updated['version'] - len(expenses) + 1
+            for seq, expense in enumerate(expenses, first):
+                expense['group'] = name
+                expense['seq'] = seq
+                expense.setdefault('created_at', now)
+            try:
+                group_expenses_collection.insert_many(expenses)
+            except PyMongoError:
+                _undo_group_expenses(name, increments, first, updated['version'])
+                for expense in expenses:
+                    expense.pop('_id', None)
+                raise
+            for expense in expenses:
+                expense.pop('_id', None)
+            group['version'] = updated['version']
+            return True
+
+        group = groups_collection.find_one(
+            {'name': name},
+            {'_id': 0, 'name': 1, 'members': 1, 'version': 1}
+        )
+        if not group:
+            return False
+    return False
+
+def get_group_expenses(name, after_seq=0, limit=None):
+    cursor = group_expenses_collection.find(
+        {'group': name, 'seq': {'$gt': after_seq}},
+        {'_id': 0}
+    ).sort('seq', ASCENDING)
+    if limit:
+        cursor = cursor.limit(limit)
+    return list(cursor)
+
+def _category_totals(collection, match):
+    pipeline = [
+        {'$match': match},
+        {'$group': {'_id': {'$ifNull': ['$category', 'other']}, 'total': {'$sum': '$amount'}}}
+    ]
+    return {row['_id']: row['total'] for row in collection.aggregate(pipeline)}
+
+def get_group_expenses_page(name, after_seq=0, limit=20):
+    expenses = get_group_expenses(name, after_seq, limit + 1)
+    if len(expenses) > limit:
+        return expenses[:limit], expenses[limit - 1]['seq']
+    return expenses, None
+
+def get_group_category_totals(name):
+    return _category_totals(group_expenses_collection.reader(), {'group': name})
+
+def migrate_group_expenses(name):
+    group = groups_collection.find_one({'name': name, 'expenses': {'$exists': True}}, {'_id': 0})
+    if not group:
+        return 0
+
+    expenses = group['expenses']
+    for seq, expense in enumerate(expenses, 1):
+        expense['group'] = name
+        expense['seq'] = seq
+        expense.setdefault('created_at', group.get('created_at', datetime.utcnow()))
+    if expenses:
+        try:
+            group_expenses_collection.insert_many(expenses, ordered=False)
+        except BulkWriteError:
+            # Another process migrated some of these already; (group, seq) is unique
+            pass
+
+    groups_collection.update_one(
+        {'name': name, 'expenses': {'$exists': True}},
+        {
+            '$set': {
+                'ledger': compute_group_ledger(group['members'], expenses),
+                'expense_count': len(expenses),
+                'version': len(expenses)
+            },
+            '$unset': {'expenses': ''}
+        }
+    )
+    return len(expenses)
+
+def rebuild_group_ledger(name):
+    group = groups_collection.find_one({'name': name}, {'_id': 0, 'members': 1})
+    if not group:
+        return None
+    expenses = list(group_expenses_collection.find(
+        {'group': name},
+        {'_id': 0, 'amount': 1, 'paid_by': 1, 'added_by': 1}
+    ))
+    ledger = compute_group_ledger(group['members'], expenses)
+    groups_collection.update_one(
+        {'name': name},
+        {'$set': {'ledger': ledger, 'expense_count': len(expenses)}}
+    )
+    return ledger
+
+def verify_group_ledger(name):
+    group = groups_collection.find_one({'name': name}, {'_id': 0, 'members': 1, 'ledger': 1, 'expense_count': 1})
+    if not group:
+        return None
+    expenses = list(group_expenses_collection.find(
+        {'group': name},
+        {'_id': 0, 'amount': 1, 'paid_by': 1, 'added_by': 1}
+    ))
+    expected = compute_group_ledger(group['members'], expenses)
+    stored = group.get('ledger', {})
+    drift = {}
+    for member in set(expected) | set(stored):
+        want = expected.get(member, {"paid": 0, "owed": 0})
+        have = stored.get(member, {"paid": 0, "owed": 0})
+        if want.get("paid", 0) != have.get("paid", 0) or want.get("owed", 0) != have.get("owed", 0):
+            drift[member] = {"expected": want, "stored": have}
+    if group.get('expense_count', 0) != len(expenses):
+        drift['expense_count'] = {"expected": len(expenses), "stored": group.get('expense_count', 0)}
+    return drift
 
 def update_group(group_name, update_data):
     groups_collection.update_one(
@@ -92,30 +579,109 @@ def update_group(group_name, update_data):
         {'$set': update_data}
     )
 
+def get_group_names():
+    return [g['name'] for g in groups_collection.find({}, {'_id': 0, 'name': 1})]
+
 def get_group_by_name(name):
-    return groups_collection.find_one({'name': name}, {'_id': 0})
+    group = groups_collection.find_one({'name': name}, {'_id': 0})
+    if group and 'expenses' in group:
+        migrate_group_expenses(name)
+        group = groups_collection.find_one({'name': name}, {'_id': 0})
+    return group
 
 def get_user_expenses(user):
-    user_id = get_user_id(user)
-    
-    mapping = user_mappings_collection.find_one({"user_id": user_id})
-    if not mapping:
-        return []
+    identity = resolve_identity(user)
+
+    phone_numbers = [f"whatsapp:+{phone}" for phone in identity["phone_numbers"]]
+    return list(expenses_collection.reader().find({"user": {"$in": phone_numbers}}, {'_id': 0}))
+
+def get_user_expenses_page(user, after=None, limit=20):
+    identity = resolve_identity(user)
+
+    phone_numbers = [f"whatsapp:+{phone}" for phone in identity["phone_numbers"]]
+    query = {"user": {"$in": phone_numbers}}
+    if after:
+        # Rows saved before created_at existed sort first; page through them
+        # on _id alone (older cursors marked them with datetime.min)
+        created_at = datetime.fromisoformat(after["created_at"]) if after["created_at"] else datetime.min
+        if created_at == datetime.min:
+            query["$or"] = [
+                {"created_at": None, "_id": {"$gt": ObjectId(after["id"])}},
+                {"created_at": {"$ne": None}}
+            ]
+        else:
+            query["$or"] = [
+                {"created_at": {"$gt": created_at}},
+                {"created_at": created_at, "_id": {"$gt": ObjectId(after["id"])}}
+            ]
+
+    expenses = list(
+        expenses_collection.find(query)
+        .sort([("created_at", ASCENDING), ("_id", ASCENDING)])
+        .limit(limit + 1)
+    )
+
+    next_after = None
+    if len(expenses) > limit:
+        expenses = expenses[:limit]
+        last = expenses[-1]
+        next_after = {
+            "created_at": last["created_at"].isoformat() if last.get("created_at") else "",
+            "id": str(last["_id"])
+        }
+    for expense in expenses:
+        expense.pop("_id", None)
+    return expenses, next_after
 
-    phone_numbers = [f"whatsapp:+{phone}" for phone in mapping["phone_numbers"]]
-    return list(expenses_collection.find({"user": {"$in": phone_numbers}}, {'_id': 0}))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+def _export_filter(start=None, end=None, category=None):
+    query = {}
+    if start or end:
+        query['created_at'] = {}
+        if start:
+            query['created_at']['$gte'] = start
+        if end:
+            query['created_at']['$lt'] = end
+    if category:
+        # Categories are stored as typed, so match them case-insensitively
+        query['category'] = {'$regex': f"^{re.escape(category)}$", '$options': 'i'}
+    return query
+
+def iter_user_expenses(user, start=None, end=None, category=None, batch_size=EXPORT_BATCH_SIZE):
+    # Streams straight off the cursor, one batch in memory at a time
+    identity = resolve_identity(user, create=False)
+    if not identity:
+        return
+    phone_numbers = [f"whatsapp:+{phone}" for phone in identity["phone_numbers"]]
+    cursor = expenses_collection.reader().find(
+        {"user": {"$in": phone_numbers}, **_export_filter(start, end, category)},
+        {'_id': 0, 'amount': 1, 'desc': 1, 'category': 1, 'created_at': 1},
+        batch_size=batch_size
+    ).sort([("created_at", ASCENDING), ("_id", ASCENDING)])
+    yield from cursor
+
+def iter_user_group_expenses(user, start=None, end=None, category=None, batch_size=EXPORT_BATCH_SIZE):
+    for group in get_user_groups(user):
+        cursor = group_expenses_collection.reader().find(
+            {'group': group['name'], **_export_filter(start, end, category)},
+            {'_id': 0, 'group': 1, 'amount': 1, 'desc': 1, 'category': 1,
+             'created_at': 1, 'added_by': 1, 'paid_by': 1},
+            batch_size=batch_size
+        ).sort('seq', ASCENDING)
+        yield from cursor
 
 def get_user_groups(user):
-    user_mapping = user_mappings_collection.find_one({"phone_numbers": user})
-    if not user_mapping:
-        return []
-    
-    user_phone_numbers = user_mapping.get("phone_numbers", [])
+    # A sender whose identity has not been resolved yet can still be a member
+    identity = resolve_identity(user, create=False)
     
-    phone_patterns = [re.escape(phone) for phone in user_phone_numbers]
+    # Members are stored as entered (E.164 with '+'), mappings without it
+    user_phone_numbers = identity["phone_numbers"] if identity else [normalize(user)]
+    member_forms = user_phone_numbers + [f"+{phone}" for phone in user_phone_numbers]
     
     return list(groups_collection.find(
-        {"members": {"$in": user_phone_numbers}}
+        {"members": {"$in": member_forms}},
+        {"expenses": 0}
     ))
 
 def get_user_budget(user_id):
@@ -128,32 +694,352 @@ def set_user_budget(user_id, budget_data):
         upsert=True
     )
 
+def month_bounds(month):
+    start = datetime.strptime(f"{month}-01", "%Y-%m-%d")
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+def get_user_category_totals(user):
+    # All-time totals, including rows saved before created_at existed
+    identity = resolve_identity(user, create=False)
+    if not identity:
+        return {}
+
+    phone_numbers = [f"whatsapp:+{phone}" for phone in identity["phone_numbers"]]
+    return _category_totals(expenses_collection.reader(), {"user": {"$in": phone_numbers}})
+
+def get_category_totals(user_id, start, end):
+    identity = get_identity_by_user_id(user_id)
+    if not identity:
+        return {}
+
+    phone_numbers = [f"whatsapp:+{phone}" for phone in identity["phone_numbers"]]
+    return _category_totals(expenses_collection.reader(), {
+        "user": {"$in": phone_numbers},
+        "created_at": {"$gte": start, "$lt": end}
+    })
+
+def get_monthly_rollup(user_id, month):
+    return {
+        row['category']: row['total']
+        for row in monthly_rollups_collection.find(
+            {'user_id': user_id, 'month': month},
+            {'_id': 0, 'category': 1, 'total': 1}
+        )
+        if row['total']
+    }
+
+def get_monthly_trend(user_id, months=6):
+    first = datetime.utcnow().replace(day=1)
+    for _ in range(months - 1):
+        first = (first - timedelta(days=1)).replace(day=1)
+
+    trend = {}
+    for row in monthly_rollups_collection.reader().find(
+        {'user_id': user_id, 'month': {'$gte': first.strftime("%Y-%m")}},
+        {'_id': 0, 'month': 1, 'category': 1, 'total': 1}
+    ).sort('month', ASCENDING):
+        trend.setdefault(row['month'], {})[row['category']] = row['total']
+    return trend
+
 def get_user_budget_usage(user_id, month=None):
     if month is None:
         # Get current month's usage
-        from datetime import datetime
         month = datetime.utcnow().strftime("%Y-%m")
     
-    # Get user's phone numbers
-    mapping = user_mappings_collection.find_one({"user_id": user_id})
-    if not mapping:
-        return {}
-    
-    phone_numbers = [f"whatsapp:+{phone}" for phone in mapping["phone_numbers"]]
-    
-    # Get all expenses for the user in the specified month
-    expenses = list(expenses_collection.find({
-        "user": {"$in": phone_numbers},
-        "created_at": {
-            "$gte": datetime.strptime(f"{month}-01", "%Y-%m-%d"),
-            "$lt": datetime.strptime(f"{month}-01", "%Y-%m-%d").replace(day=28) + timedelta(days=4)
-        }
-    }))
-    
-    # Calculate usage by category
-    usage = {}
-    for expense in expenses:
-        category = expense.get("category", "other")
-        usage[category] = usage.get(category, 0) + expense["amount"]
-    
-    return usage 
\ No newline at end of file
+    return get_monthly_rollup(user_id, month)
+
+def _raw_rollups(user_id=None):
+    match = {'created_at': {'$type': 'date'}}
+    if user_id:
+        identity = get_identity_by_user_id(user_id)
+        if not identity:
+            return {}
+        match['user'] = {'$in': [f"whatsapp:+{phone}" for phone in identity["phone_numbers"]]}
+
+    rows = list(expenses_collection.aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': {
+                'user': '$user',
+                'month': {'$dateToString': {'format': '%Y-%m', 'date': '$created_at'}},
+                'category': {'$ifNull': ['$category', 'other']}
+            },
+            'total': {'$sum': '$amount'},
+            'count': {'$sum': 1}
+        }}
+    ], allowDiskUse=True))
+
+    # Checking must not write, so owners without a mapping are left out, not created
+    identities = resolve_many({row['_id']['user'] for row in rows}, create=False)
+    rollups = {}
+    for row in rows:
+        identity = identities.get(normalize(row['_id']['user']))
+        if identity is None:
+            log.warning("expenses without a user mapping left out of rollups", extra=fields(user=row['_id']['user']))
+            continue
+        key = (
+            identity['user_id'],
+            row['_id']['month'],
+            row['_id']['category']
+        )
+        total, count = rollups.get(key, (0, 0))
+        rollups[key] = (total + row['total'], count + row['count'])
+    return rollups
+
+def rebuild_monthly_rollups(user_id=None):
+    rollups = _raw_rollups(user_id)
+    monthly_rollups_collection.delete_many({'user_id': user_id} if user_id else {})
+    if rollups:
+        monthly_rollups_collection.insert_many([
+            {'user_id': uid, 'month': month, 'category': category, 'total': total, 'count': count}
+            for (uid, month, category), (total, count) in rollups.items()
+        ])
+    _bump_expense_version({'user_id': user_id} if user_id else {})
+    return len(rollups)
+
+def check_monthly_rollups(user_id=None):
+    expected = _raw_rollups(user_id)
+    stored = {
+        (row['user_id'], row['month'], row['category']): (row['total'], row['count'])
+        for row in monthly_rollups_collection.find({'user_id': user_id} if user_id else {}, {'_id': 0})
+    }
+
+    mismatches = []
+    for key in set(expected) | set(stored):
+        want = expected.get(key, (0, 0))
+        have = stored.get(key, (0, 0))
+        if abs(want[0] - have[0]) > 0.005 or want[1] != have[1]:
+            mismatches.append({'key': key, 'expected': want, 'stored': have})
+    return mismatches
+
+def get_cached_insights(key):
+    doc = insights_cache_collection.find_one({'_id': key}, {'_id': 0, 'text': 1})
+    return doc['text'] if doc else None
+
+def save_cached_insights(key, text):
+    insights_cache_collection.update_one(
+        {'_id': key},
+        {'$set': {'text': text, 'created_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+def record_payment(payment):
+    payments_collection.insert_one(dict(payment))
+
+def get_payment(payment_id):
+    return payments_collection.find_one({'payment_id': payment_id}, {'_id': 0})
+
+def claim_message(message_sid):
+    # Returns (True, None) if this call should process the message, otherwise
+    # (False, response) with the stored reply, or None while still in progress
+    cached = _message_cache.get(message_sid)
+    if cached is not None:
+        return False, cached
+
+    try:
+        processed_messages_collection.insert_one({
+            '_id': message_sid,
+            'status': 'pending',
+            'created_at': datetime.utcnow()
+        })
+        return True, None
+    except DuplicateKeyError:
+        doc = processed_messages_collection.find_one({'_id': message_sid}, {'response': 1})
+        response = doc.get('response') if doc else None
+        if response is not None:
+            _message_cache.set(message_sid, response)
+        return False, response
+
+def store_message_response(message_sid, response):
+    processed_messages_collection.update_one(
+        {'_id': message_sid},
+        {'$set': {'status': 'done', 'response': response}}
+    )
+    _message_cache.set(message_sid, response)
+
+def release_message(message_sid):
+    # Processing failed: let Twilio's retry run it again
+    processed_messages_collection.delete_one({'_id': message_sid, 'status': 'pending'})
+
+def enqueue_job(user, kind, payload):
+    now = datetime.utcnow()
+    job = {
+        'user': normalize(user),
+        'reply_to': user,
+        'kind': kind,
+        'payload': payload,
+        'status': 'queued',
+        'attempts': 0,
+        'created_at': now,
+        'available_at': now
+    }
+    return str(jobs_collection.insert_one(job).inserted_id)
+
+def claim_job(worker_id, lease_seconds=60, scan=20):
+    now = datetime.utcnow()
+
+    # Jobs whose worker died mid-run go back on the queue
+    jobs_collection.update_many(
+        {'status': 'running', 'lease_until': {'$lt': now}},
+        {'$set': {'status': 'queued'}, '$unset': {'worker': '', 'lease_until': ''}}
+    )
+
+    # Users with a job running or waiting out a retry cannot start another,
+    # so their queued jobs are left out instead of crowding the oldest ones
+    busy = jobs_collection.distinct('user', {'$or': [
+        {'status': 'running'},
+        {'status': 'queued', 'available_at': {'$gt': now}}
+    ]})
+    candidates = jobs_collection.find(
+        {'status': 'queued', 'available_at': {'$lte': now}, 'user': {'$nin': busy}},
+        {'_id': 1, 'user': 1}
+    ).sort([('created_at', ASCENDING), ('_id', ASCENDING)])
+
+    # Only each user's first candidate can be their oldest unfinished job;
+    # check up to `scan` users
+    checked = set()
+    for candidate in candidates:
+        if candidate['user'] in checked:
+            continue
+        if len(checked) >= scan:
+            break
+        checked.add(candidate['user'])
+
+        # Per-user ordering: only the user's oldest unfinished job may run
+        oldest = jobs_collection.find_one(
+            {'user': candidate['user'], 'status': {'$in': ['queued', 'running']}},
+            {'_id': 1},
+            sort=[('created_at', ASCENDING), ('_id', ASCENDING)]
+        )
+        if not oldest or oldest['_id'] != candidate['_id']:
+            continue
+
+        job = jobs_collection.find_one_and_update(
+            {'_id': candidate['_id'], 'status': 'queued'},
+            {
+                '$set': {
+                    'status': 'running',
+                    'worker': worker_id,
+                    'lease_until': now + timedelta(seconds=lease_seconds)
+                },
+                '$inc': {'attempts': 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        if job:
+            return job
+    return None
+
+def save_job_result(job_id, result):
+    jobs_collection.update_one({'_id': job_id}, {'$set': {'result': result}})
+
+def complete_job(job_id):
+    jobs_collection.update_one(
+        {'_id': job_id},
+        {'$set': {'status': 'done', 'finished_at': datetime.utcnow()}, '$unset': {'lease_until': ''}}
+    )
+
+def fail_job(job_id, error, retry_delay=None):
+    # Without a retry delay the job is dead-lettered and stops blocking the user's queue
+    update = {'last_error': error}
+    if retry_delay is None:
+        update.update({'status': 'dead', 'finished_at': datetime.utcnow()})
+    else:
+        update.update({'status': 'queued', 'available_at': datetime.utcnow() + timedelta(seconds=retry_delay)})
+    jobs_collection.update_one({'_id': job_id}, {'$set': update, '$unset': {'worker': '', 'lease_until': ''}})
+
+def get_dead_jobs(limit=50):
+    return list(jobs_collection.find({'status': 'dead'}).sort('finished_at', -1).limit(limit))
+
+def requeue_dead_jobs():
+    return jobs_collection.update_many(
+        {'status': 'dead'},
+        {'$set': {'status': 'queued', 'attempts': 0, 'available_at': datetime.utcnow()}}
+    ).modified_count
+
+def ensure_indexes(force=False):
+    global _indexes_ready
+    if _indexes_ready and not force:
+        return []
+
+    failed = []
+    for collection_name, keys, options in INDEXES:
+        try:
+            get_db()[collection_name].create_index(keys, **options)
+        except OperationFailure as e:
+            # IndexOptionsConflict: the TTL changed since the index was built
+            if e.code == 85 and 'expireAfterSeconds' in options:
+                get_db().command(
+                    'collMod', collection_name,
+                    index={'keyPattern': dict(keys), 'expireAfterSeconds': options['expireAfterSeconds']}
+                )
+            else:
+                log.error("index creation failed", extra=fields(collection=collection_name, keys=str(keys), error=str(e)))
+                failed.append((collection_name, keys))
+
+    _indexes_ready = not failed
+    return failed
+
+# Representative shape of every query the app issues, used to check query plans
+def _query_shapes():
+    month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    phones = ['910000000000']
+    return [
+        ('user_mappings', {'phone_numbers': phones[0]}),
+        ('user_mappings', {'phone_numbers': {'$in': phones}}),
+        ('user_mappings', {'user_id': 'x'}),
+        ('expenses', {'user': {'$in': [f"whatsapp:+{phones[0]}"]}}),
+        ('expenses', {
+            'user': {'$in': [f"whatsapp:+{phones[0]}"]},
+            'created_at': {'$gte': month_start, '$lt': month_start + timedelta(days=31)}
+        }),
+        ('expenses', {
+            'user': {'$in': [f"whatsapp:+{phones[0]}"]},
+            '$or': [{'created_at': None, '_id': {'$gt': ObjectId()}}, {'created_at': {'$ne': None}}]
+        }),
+        ('groups', {'name': 'x'}),
+        ('groups', {'members': {'$in': phones + [f"+{phones[0]}"]}}),
+        ('group_expenses', {'group': 'x', 'seq': {'$gt': 0}}),
+        ('group_expenses', {'group': 'x'}),
+        ('budgets', {'user_id': 'x'}),
+        ('monthly_rollups', {'user_id': 'x', 'month': month_start.strftime('%Y-%m')}),
+        ('monthly_rollups', {'user_id': 'x', 'month': {'$gte': month_start.strftime('%Y-%m')}}),
+        ('sessions', {'user': phones[0]}),
+        ('jobs', {'status': 'queued', 'available_at': {'$lte': month_start}, 'user': {'$nin': phones}}),
+        ('jobs', {'$or': [{'status': 'running'}, {'status': 'queued', 'available_at': {'$gt': month_start}}]}),
+        ('jobs', {'user': phones[0], 'status': {'$in': ['queued', 'running']}}),
+    ]
+
+def _plan_stages(plan):
+    stages = [plan.get('stage')]
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages += _plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        stages += _plan_stages(child)
+    return stages
+
+def check_health():
+    started = time.perf_counter()
+    try:
+        get_db().command('ping')
+        error = None
+    except PyMongoError as e:
+        error = str(e)
+    return {
+        'ok': error is None,
+        'error': error,
+        'ping_ms': round((time.perf_counter() - started) * 1000, 2),
+        'pid': os.getpid(),
+        'max_pool_size': MONGODB_OPTIONS['maxPoolSize'],
+        'pools': pool_stats.snapshot(),
+    }
+
+def verify_query_plans():
+    collscans = []
+    for collection_name, query in _query_shapes():
+        explain = get_db()[collection_name].find(query).explain()
+        winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+        if 'COLLSCAN' in _plan_stages(winning_plan):
+            collscans.append((collection_name, query))
+    return collscans
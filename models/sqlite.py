@@ -0,0 +1,932 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+
+from utils.cache import LRUCache
+from utils.helpers import normalize
+from utils.balance import ledger_increments, compute_group_ledger
+from utils.log import get_logger, fields
+from utils.metrics import observe_stage
+
+log = get_logger('db')
+
+# Load environment variables
+load_dotenv()
+
+# Embedded store for single-node deployments: one SQLite file in WAL mode, so
+# readers never block the writer and every multi-row change is one transaction
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'expensebot.db')
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 10))
+
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', 7 * 24 * 3600))
+MESSAGE_DEDUP_TTL_SECONDS = int(os.getenv('MESSAGE_DEDUP_TTL_SECONDS', 24 * 3600))
+INSIGHTS_CACHE_TTL_SECONDS = int(os.getenv('INSIGHTS_CACHE_TTL_SECONDS', 31 * 24 * 3600))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+# Indexed fields get their own columns; the rest of each document is stored
+# as JSON next to them
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS user_mappings ("
+    " user_id TEXT PRIMARY KEY, created_at TEXT NOT NULL, expense_version INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS user_phones (phone TEXT PRIMARY KEY, user_id TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS user_phones_user_id ON user_phones (user_id)",
+    "CREATE TABLE IF NOT EXISTS expenses ("
+    " id INTEGER PRIMARY KEY, user TEXT NOT NULL, created_at TEXT, category TEXT,"
+    " import_hash TEXT UNIQUE, payment_id TEXT UNIQUE, doc TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS expenses_user_created_at ON expenses (user, created_at, id)",
+    "CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY, doc TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS group_members ("
+    " member TEXT NOT NULL, group_name TEXT NOT NULL, PRIMARY KEY (member, group_name))",
+    "CREATE TABLE IF NOT EXISTS group_expenses ("
+    " group_name TEXT NOT NULL, seq INTEGER NOT NULL, created_at TEXT, category TEXT,"
+    " doc TEXT NOT NULL, PRIMARY KEY (group_name, seq))",
+    "CREATE TABLE IF NOT EXISTS sessions (user TEXT PRIMARY KEY, updated_at TEXT NOT NULL, data TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)",
+    "CREATE TABLE IF NOT EXISTS budgets (user_id TEXT PRIMARY KEY, doc TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS monthly_rollups ("
+    " user_id TEXT NOT NULL, month TEXT NOT NULL, category TEXT NOT NULL,"
+    " total REAL NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (user_id, month, category))",
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    " id INTEGER PRIMARY KEY, user TEXT NOT NULL, reply_to TEXT, kind TEXT NOT NULL, payload TEXT,"
+    " status TEXT NOT NULL, attempts INTEGER NOT NULL, worker TEXT, lease_until TEXT,"
+    " available_at TEXT, created_at TEXT NOT NULL, finished_at TEXT, last_error TEXT, result TEXT)",
+    "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at, created_at)",
+    "CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user, status, created_at)",
+    "CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, created_at, id)",
+    "CREATE TABLE IF NOT EXISTS payments (payment_id TEXT PRIMARY KEY, doc TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS processed_messages ("
+    " sid TEXT PRIMARY KEY, status TEXT NOT NULL, response TEXT, created_at TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS processed_messages_created_at ON processed_messages (created_at)",
+    "CREATE TABLE IF NOT EXISTS insights_cache (key TEXT PRIMARY KEY, text TEXT NOT NULL, created_at TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS insights_cache_created_at ON insights_cache (created_at)",
+]
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def _create_schema(conn):
+    global _schema_ready
+    with _schema_lock:
+        if not _schema_ready:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            _schema_ready = True
+
+def _conn():
+    # One connection per thread, opened again after a fork
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        directory = os.path.dirname(SQLITE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(SQLITE_PATH, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _create_schema(conn)
+        _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+def _execute(sql, params=(), many=False):
+    started = time.perf_counter()
+    try:
+        conn = _conn()
+        return conn.executemany(sql, params) if many else conn.execute(sql, params)
+    finally:
+        observe_stage(f"sqlite_{sql.split(None, 1)[0].lower()}", time.perf_counter() - started)
+
+@contextmanager
+def _transaction():
+    # BEGIN IMMEDIATE takes the write lock up front, so a read-modify-write
+    # inside cannot interleave with another writer; nested blocks join the outer one
+    conn = _conn()
+    if conn.in_transaction:
+        yield
+        return
+    _execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    _execute("COMMIT")
+
+def _ts(value):
+    # Fixed-width text sorts in time order, so range queries can use the indexes
+    return value.strftime("%Y-%m-%d %H:%M:%S.%f") if isinstance(value, datetime) else None
+
+def _dt(text):
+    return datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f") if text else None
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def _decode(obj):
+    if len(obj) == 1 and '$date' in obj:
+        return datetime.fromisoformat(obj['$date'])
+    return obj
+
+def _dumps(doc):
+    return json.dumps(doc, default=_encode, ensure_ascii=False, separators=(',', ':'))
+
+def _loads(text):
+    return json.loads(text, object_hook=_decode) if text is not None else None
+
+def _placeholders(values):
+    return ",".join("?" * len(values))
+
+# Phone -> identity cache shared by every lookup in this process
+_identity_cache = LRUCache(
+    maxsize=int(os.getenv('IDENTITY_CACHE_SIZE', 10000)),
+    ttl=int(os.getenv('IDENTITY_CACHE_TTL', 300))
+)
+
+def _cache_identity(identity):
+    _identity_cache.set(("user", identity["user_id"]), identity)
+    for phone in identity["phone_numbers"]:
+        _identity_cache.set(("phone", phone), identity)
+    return identity
+
+def _forget_identity(identity):
+    _identity_cache.pop(("user", identity["user_id"]))
+    for phone in identity["phone_numbers"]:
+        _identity_cache.pop(("phone", phone))
+
+def _load_identity(user_id):
+    rows = _execute("SELECT phone FROM user_phones WHERE user_id = ? ORDER BY rowid", (user_id,)).fetchall()
+    if not rows:
+        return None
+    return _cache_identity({"user_id": user_id, "phone_numbers": [row["phone"] for row in rows]})
+
+def _create_identity(normalized_phone):
+    user_id = uuid.uuid4().hex[:24]
+    with _transaction():
+        # A concurrent request may have claimed the phone first; theirs wins
+        if _execute(
+            "INSERT OR IGNORE INTO user_phones (phone, user_id) VALUES (?, ?)",
+            (normalized_phone, user_id)
+        ).rowcount:
+            _execute(
+                "INSERT INTO user_mappings (user_id, created_at) VALUES (?, ?)",
+                (user_id, _ts(datetime.utcnow()))
+            )
+    row = _execute("SELECT user_id FROM user_phones WHERE phone = ?", (normalized_phone,)).fetchone()
+    return row["user_id"]
+
+def resolve_identity(phone_number, create=True):
+    normalized_phone = normalize(phone_number)
+
+    identity = _identity_cache.get(("phone", normalized_phone))
+    if identity is not None:
+        return identity
+
+    row = _execute("SELECT user_id FROM user_phones WHERE phone = ?", (normalized_phone,)).fetchone()
+    if row:
+        return _load_identity(row["user_id"])
+    if not create:
+        return None
+    return _load_identity(_create_identity(normalized_phone))
+
+def resolve_many(phone_numbers, create=True):
+    normalized = {normalize(phone) for phone in phone_numbers}
+
+    resolved = {}
+    missing = []
+    for phone in normalized:
+        identity = _identity_cache.get(("phone", phone))
+        if identity is not None:
+            resolved[phone] = identity
+        else:
+            missing.append(phone)
+
+    for phone in missing:
+        identity = resolve_identity(phone, create)
+        if identity is not None:
+            resolved[phone] = identity
+    return resolved
+
+def get_identity_by_user_id(user_id):
+    identity = _identity_cache.get(("user", user_id))
+    if identity is not None:
+        return identity
+    return _load_identity(user_id)
+
+def identity_cache_stats():
+    return _identity_cache.stats()
+
+def get_user_id(phone_number):
+    return resolve_identity(phone_number)["user_id"]
+
+def add_phone_to_user(user_id, phone_number):
+    normalized_phone = normalize(phone_number)
+
+    identity = get_identity_by_user_id(user_id)
+    if identity and normalized_phone in identity["phone_numbers"]:
+        return False
+
+    _execute(
+        "INSERT OR IGNORE INTO user_phones (phone, user_id) VALUES (?, ?)",
+        (normalized_phone, user_id)
+    )
+    if identity:
+        _forget_identity(identity)
+    _identity_cache.pop(("phone", normalized_phone))
+    return True
+
+def _expense_row(expense):
+    return (
+        expense['user'], _ts(expense.get('created_at')), expense.get('category'),
+        expense.get('import_hash'), (expense.get('payment') or {}).get('payment_id'),
+        _dumps(expense)
+    )
+
+EXPENSE_COLUMNS = "expenses (user, created_at, category, import_hash, payment_id, doc) VALUES (?, ?, ?, ?, ?, ?)"
+
+def load_expenses():
+    return [_loads(row["doc"]) for row in _execute("SELECT doc FROM expenses ORDER BY id")]
+
+def save_expenses(expenses):
+    with _transaction():
+        _execute("DELETE FROM expenses")
+        _execute(f"INSERT INTO {EXPENSE_COLUMNS}", [_expense_row(e) for e in expenses], many=True)
+
+def _group_members(name, members):
+    _execute("DELETE FROM group_members WHERE group_name = ?", (name,))
+    _execute(
+        "INSERT OR IGNORE INTO group_members (member, group_name) VALUES (?, ?)",
+        [(normalize(member), name) for member in members], many=True
+    )
+
+def _write_group(group):
+    _execute("INSERT OR REPLACE INTO groups (name, doc) VALUES (?, ?)", (group['name'], _dumps(group)))
+    _group_members(group['name'], group.get('members', []))
+
+def load_groups():
+    return [_loads(row["doc"]) for row in _execute("SELECT doc FROM groups ORDER BY rowid")]
+
+def save_groups(groups):
+    with _transaction():
+        _execute("DELETE FROM groups")
+        _execute("DELETE FROM group_members")
+        for group in groups:
+            _write_group(group)
+
+def load_sessions():
+    return {row["user"]: _loads(row["data"]) for row in _execute("SELECT user, data FROM sessions")}
+
+def save_sessions(sessions):
+    now = _ts(datetime.utcnow())
+    with _transaction():
+        _execute("DELETE FROM sessions")
+        _execute(
+            "INSERT INTO sessions (user, updated_at, data) VALUES (?, ?, ?)",
+            [(user, now, _dumps(data)) for user, data in sessions.items()], many=True
+        )
+
+def _new_session():
+    return {"state": None, "temp": {}}
+
+def get_session(phone_number):
+    row = _execute("SELECT data, updated_at FROM sessions WHERE user = ?", (normalize(phone_number),)).fetchone()
+    if not row:
+        return _new_session()
+
+    # Expired sessions are only purged periodically, so check on read too
+    if datetime.utcnow() - _dt(row["updated_at"]) > timedelta(seconds=SESSION_TTL_SECONDS):
+        return _new_session()
+    return _loads(row["data"]) or _new_session()
+
+def save_session(phone_number, data):
+    _execute(
+        "INSERT INTO sessions (user, updated_at, data) VALUES (?, ?, ?)"
+        " ON CONFLICT (user) DO UPDATE SET updated_at = excluded.updated_at, data = excluded.data",
+        (normalize(phone_number), _ts(datetime.utcnow()), _dumps(data))
+    )
+
+def delete_session(phone_number):
+    _execute("DELETE FROM sessions WHERE user = ?", (normalize(phone_number),))
+
+def _apply_rollups(user_id, expenses):
+    # One upsert per (month, category) touched, however many expenses there are
+    increments = {}
+    for expense in expenses:
+        key = (expense['created_at'].strftime("%Y-%m"), expense.get('category', 'other'))
+        total, count = increments.get(key, (0, 0))
+        increments[key] = (total + expense['amount'], count + 1)
+
+    if not increments:
+        return
+    _execute(
+        "INSERT INTO monthly_rollups (user_id, month, category, total, count) VALUES (?, ?, ?, ?, ?)"
+        " ON CONFLICT (user_id, month, category)"
+        " DO UPDATE SET total = total + excluded.total, count = count + excluded.count",
+        [(user_id, month, category, total, count) for (month, category), (total, count) in increments.items()],
+        many=True
+    )
+    _execute("UPDATE user_mappings SET expense_version = expense_version + 1 WHERE user_id = ?", (user_id,))
+
+def get_expense_version(user_id):
+    row = _execute("SELECT expense_version FROM user_mappings WHERE user_id = ?", (user_id,)).fetchone()
+    return row["expense_version"] if row else 0
+
+def add_expense(expense):
+    add_expenses([expense])
+
+def add_expenses(expenses):
+    now = datetime.utcnow()
+    for expense in expenses:
+        expense['created_at'] = now
+    user_id = get_user_id(expenses[0]['user'])
+    with _transaction():
+        _execute(f"INSERT INTO {EXPENSE_COLUMNS}", [_expense_row(e) for e in expenses], many=True)
+        _apply_rollups(user_id, expenses)
+
+def import_expenses(user_id, expenses):
+    # Rows already imported hit the unique import_hash and are skipped; the
+    # rest of the batch goes in with its rollups in the same transaction
+    if not expenses:
+        return 0, 0
+    inserted = []
+    with _transaction():
+        for expense in expenses:
+            if _execute(f"INSERT OR IGNORE INTO {EXPENSE_COLUMNS}", _expense_row(expense)).rowcount:
+                inserted.append(expense)
+        _apply_rollups(user_id, inserted)
+    return len(inserted), len(expenses) - len(inserted)
+
+def _insert_group_expenses(name, expenses):
+    _execute(
+        "INSERT OR IGNORE INTO group_expenses (group_name, seq, created_at, category, doc) VALUES (?, ?, ?, ?, ?)",
+        [(name, e['seq'], _ts(e.get('created_at')), e.get('category'), _dumps(e)) for e in expenses],
+        many=True
+    )
+
+def add_group(group):
+    expenses = group.pop('expenses', [])
+    now = datetime.utcnow()
+    for seq, expense in enumerate(expenses, 1):
+        expense['group'] = group['name']
+        expense['seq'] = seq
+        expense.setdefault('created_at', now)
+    group.setdefault('created_at', now)
+    group['ledger'] = compute_group_ledger(group['members'], expenses)
+    group['expense_count'] = len(expenses)
+    group['version'] = len(expenses)
+    with _transaction():
+        _execute("INSERT INTO groups (name, doc) VALUES (?, ?)", (group['name'], _dumps(group)))
+        _group_members(group['name'], group['members'])
+        _insert_group_expenses(group['name'], expenses)
+
+def _read_group(name):
+    row = _execute("SELECT doc FROM groups WHERE name = ?", (name,)).fetchone()
+    return _loads(row["doc"]) if row else None
+
+def add_group_expense(group, expense, retries=3):
+    return add_group_expenses(group, [expense], retries)
+
+def add_group_expenses(group, expenses, retries=3):
+    # The write lock is held from the read to the insert, so the ledger
+    # increments and the new seqs can never race; there is nothing to retry
+    name = group['name']
+    with _transaction():
+        stored = _read_group(name)
+        if not stored:
+            return False
+        ledger = stored.setdefault('ledger', {})
+        for expense in expenses:
+            for key, amount in ledger_increments(stored['members'], expense['amount'], expense['paid_by']).items():
+                _, member, field = key.split('.')
+                entry = ledger.setdefault(member, {"paid": 0, "owed": 0})
+                entry[field] = entry.get(field, 0) + amount
+        first = (stored.get('version') or 0) + 1
+        stored['expense_count'] = stored.get('expense_count', 0) + len(expenses)
+        stored['version'] = first + len(expenses) - 1
+        _execute("UPDATE groups SET doc = ? WHERE name = ?", (_dumps(stored), name))
+
+        now = datetime.utcnow()
+        for seq, expense in enumerate(expenses, first):
+            expense['group'] = name
+            expense['seq'] = seq
+            expense.setdefault('created_at', now)
+        _insert_group_expenses(name, expenses)
+    group['version'] = stored['version']
+    return True
+
+def get_group_expenses(name, after_seq=0, limit=None):
+    sql = "SELECT doc FROM group_expenses WHERE group_name = ? AND seq > ? ORDER BY seq"
+    params = [name, after_seq]
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return [_loads(row["doc"]) for row in _execute(sql, params)]
+
+def get_group_expenses_page(name, after_seq=0, limit=20):
+    expenses = get_group_expenses(name, after_seq, limit + 1)
+    if len(expenses) > limit:
+        return expenses[:limit], expenses[limit - 1]['seq']
+    return expenses, None
+
+def _category_totals(table, where, params):
+    rows = _execute(
+        f"SELECT COALESCE(category, 'other') AS category, SUM(json_extract(doc, '$.amount')) AS total"
+        f" FROM {table} WHERE {where} GROUP BY 1",
+        params
+    )
+    return {row["category"]: row["total"] for row in rows}
+
+def get_group_category_totals(name):
+    return _category_totals('group_expenses', "group_name = ?", (name,))
+
+def migrate_group_expenses(name):
+    # Groups loaded from the old file layout still carry their expenses inline
+    with _transaction():
+        group = _read_group(name)
+        if not group or 'expenses' not in group:
+            return 0
+        expenses = group.pop('expenses')
+        for seq, expense in enumerate(expenses, 1):
+            expense['group'] = name
+            expense['seq'] = seq
+            expense.setdefault('created_at', group.get('created_at', datetime.utcnow()))
+        _insert_group_expenses(name, expenses)
+        group['ledger'] = compute_group_ledger(group['members'], expenses)
+        group['expense_count'] = len(expenses)
+        group['version'] = len(expenses)
+        _write_group(group)
+    return len(expenses)
+
+def _ledger_expenses(name):
+    return [_loads(row["doc"]) for row in _execute(
+        "SELECT doc FROM group_expenses WHERE group_name = ? ORDER BY seq", (name,)
+    )]
+
+def rebuild_group_ledger(name):
+    with _transaction():
+        group = _read_group(name)
+        if not group:
+            return None
+        expenses = _ledger_expenses(name)
+        group['ledger'] = compute_group_ledger(group['members'], expenses)
+        group['expense_count'] = len(expenses)
+        _execute("UPDATE groups SET doc = ? WHERE name = ?", (_dumps(group), name))
+    return group['ledger']
+
+def verify_group_ledger(name):
+    group = _read_group(name)
+    if not group:
+        return None
+    expenses = _ledger_expenses(name)
+    expected = compute_group_ledger(group['members'], expenses)
+    stored = group.get('ledger', {})
+    drift = {}
+    for member in set(expected) | set(stored):
+        want = expected.get(member, {"paid": 0, "owed": 0})
+        have = stored.get(member, {"paid": 0, "owed": 0})
+        if want.get("paid", 0) != have.get("paid", 0) or want.get("owed", 0) != have.get("owed", 0):
+            drift[member] = {"expected": want, "stored": have}
+    if group.get('expense_count', 0) != len(expenses):
+        drift['expense_count'] = {"expected": len(expenses), "stored": group.get('expense_count', 0)}
+    return drift
+
+def update_group(group_name, update_data):
+    with _transaction():
+        group = _read_group(group_name)
+        if not group:
+            return
+        group.update(update_data)
+        _write_group(group)
+
+def get_group_names():
+    return [row["name"] for row in _execute("SELECT name FROM groups")]
+
+def get_group_by_name(name):
+    group = _read_group(name)
+    if group and 'expenses' in group:
+        migrate_group_expenses(name)
+        group = _read_group(name)
+    return group
+
+def _user_filter(identity):
+    phone_numbers = [f"whatsapp:+{phone}" for phone in identity["phone_numbers"]]
+    return f"user IN ({_placeholders(phone_numbers)})", phone_numbers
+
+def get_user_expenses(user):
+    where, params = _user_filter(resolve_identity(user))
+    return [_loads(row["doc"]) for row in _execute(f"SELECT doc FROM expenses WHERE {where}", params)]
+
+# Pages follow the (user, created_at, id) index. NULLs sort first, so rows
+# saved before created_at existed come first and are paged on id alone; the
+# row value comparison is created_at > ? OR (created_at = ? AND id > ?), in a
+# form SQLite can seek on
+EXPENSE_PAGE_SQL = "SELECT id, created_at, doc FROM expenses WHERE {where} ORDER BY created_at, id LIMIT ?"
+AFTER_UNDATED = " AND ((created_at IS NULL AND id > ?) OR created_at IS NOT NULL)"
+AFTER_DATED = " AND (created_at, id) > (?, ?)"
+
+def get_user_expenses_page(user, after=None, limit=20):
+    where, params = _user_filter(resolve_identity(user))
+    if after and after["created_at"]:
+        where += AFTER_DATED
+        params += [after["created_at"], int(after["id"])]
+    elif after:
+        where += AFTER_UNDATED
+        params += [int(after["id"])]
+
+    rows = _execute(EXPENSE_PAGE_SQL.format(where=where), params + [limit + 1]).fetchall()
+
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = {"created_at": rows[-1]["created_at"] or "", "id": str(rows[-1]["id"])}
+    return [_loads(row["doc"]) for row in rows], next_after
+
+def _export_filter(start=None, end=None, category=None):
+    where, params = "", []
+    if start:
+        where += " AND created_at >= ?"
+        params.append(_ts(start))
+    if end:
+        where += " AND created_at < ?"
+        params.append(_ts(end))
+    if category:
+        # Categories are stored as typed, so match them case-insensitively
+        where += " AND category = ? COLLATE NOCASE"
+        params.append(category)
+    return where, params
+
+def _stream(sql, params, batch_size):
+    cursor = _execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield _loads(row["doc"])
+
+def iter_user_expenses(user, start=None, end=None, category=None, batch_size=EXPORT_BATCH_SIZE):
+    identity = resolve_identity(user, create=False)
+    if not identity:
+        return
+    where, params = _user_filter(identity)
+    extra, extra_params = _export_filter(start, end, category)
+    keys = ('amount', 'desc', 'category', 'created_at')
+    for expense in _stream(
+        f"SELECT doc FROM expenses WHERE {where}{extra} ORDER BY created_at, id",
+        params + extra_params, batch_size
+    ):
+        yield {key: expense[key] for key in keys if key in expense}
+
+def iter_user_group_expenses(user, start=None, end=None, category=None, batch_size=EXPORT_BATCH_SIZE):
+    extra, extra_params = _export_filter(start, end, category)
+    keys = ('group', 'amount', 'desc', 'category', 'created_at', 'added_by', 'paid_by')
+    for group in get_user_groups(user):
+        for expense in _stream(
+            f"SELECT doc FROM group_expenses WHERE group_name = ?{extra} ORDER BY seq",
+            [group['name']] + extra_params, batch_size
+        ):
+            yield {key: expense[key] for key in keys if key in expense}
+
+def get_user_groups(user):
+    # A sender whose identity has not been resolved yet can still be a member
+    identity = resolve_identity(user, create=False)
+    phones = identity["phone_numbers"] if identity else [normalize(user)]
+    groups = [_loads(row["doc"]) for row in _execute(
+        "SELECT doc FROM groups WHERE name IN"
+        f" (SELECT group_name FROM group_members WHERE member IN ({_placeholders(phones)}))"
+        " ORDER BY rowid",
+        phones
+    )]
+    for group in groups:
+        group.pop('expenses', None)
+    return groups
+
+def get_user_budget(user_id):
+    row = _execute("SELECT doc FROM budgets WHERE user_id = ?", (user_id,)).fetchone()
+    return _loads(row["doc"]) if row else None
+
+def set_user_budget(user_id, budget_data):
+    with _transaction():
+        budget = get_user_budget(user_id) or {"user_id": user_id}
+        budget.update(budget_data)
+        _execute("INSERT OR REPLACE INTO budgets (user_id, doc) VALUES (?, ?)", (user_id, _dumps(budget)))
+
+def month_bounds(month):
+    start = datetime.strptime(f"{month}-01", "%Y-%m-%d")
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+def get_user_category_totals(user):
+    # All-time totals, including rows saved before created_at existed
+    identity = resolve_identity(user, create=False)
+    if not identity:
+        return {}
+
+    where, params = _user_filter(identity)
+    return _category_totals('expenses', where, params)
+
+def get_category_totals(user_id, start, end):
+    identity = get_identity_by_user_id(user_id)
+    if not identity:
+        return {}
+
+    where, params = _user_filter(identity)
+    return _category_totals('expenses', f"{where} AND created_at >= ? AND created_at < ?", params + [_ts(start), _ts(end)])
+
+def get_monthly_rollup(user_id, month):
+    return {
+        row["category"]: row["total"]
+        for row in _execute(
+            "SELECT category, total FROM monthly_rollups WHERE user_id = ? AND month = ?", (user_id, month)
+        )
+        if row["total"]
+    }
+
+def get_monthly_trend(user_id, months=6):
+    first = datetime.utcnow().replace(day=1)
+    for _ in range(months - 1):
+        first = (first - timedelta(days=1)).replace(day=1)
+
+    trend = {}
+    for row in _execute(
+        "SELECT month, category, total FROM monthly_rollups WHERE user_id = ? AND month >= ? ORDER BY month",
+        (user_id, first.strftime("%Y-%m"))
+    ):
+        trend.setdefault(row["month"], {})[row["category"]] = row["total"]
+    return trend
+
+def get_user_budget_usage(user_id, month=None):
+    if month is None:
+        # Get current month's usage
+        month = datetime.utcnow().strftime("%Y-%m")
+
+    return get_monthly_rollup(user_id, month)
+
+def _raw_rollups(user_id=None):
+    where, params = "created_at IS NOT NULL", []
+    if user_id:
+        identity = get_identity_by_user_id(user_id)
+        if not identity:
+            return {}
+        user_where, params = _user_filter(identity)
+        where += f" AND {user_where}"
+
+    rows = _execute(
+        "SELECT user, substr(created_at, 1, 7) AS month, COALESCE(category, 'other') AS category,"
+        " SUM(json_extract(doc, '$.amount')) AS total, COUNT(*) AS count"
+        f" FROM expenses WHERE {where} GROUP BY 1, 2, 3",
+        params
+    ).fetchall()
+
+    # Checking must not write, so owners without a mapping are left out, not created
+    identities = resolve_many({row["user"] for row in rows}, create=False)
+    rollups = {}
+    for row in rows:
+        identity = identities.get(normalize(row["user"]))
+        if identity is None:
+            log.warning("expenses without a user mapping left out of rollups", extra=fields(user=row["user"]))
+            continue
+        key = (identity["user_id"], row["month"], row["category"])
+        total, count = rollups.get(key, (0, 0))
+        rollups[key] = (total + row["total"], count + row["count"])
+    return rollups
+
+def rebuild_monthly_rollups(user_id=None):
+    rollups = _raw_rollups(user_id)
+    with _transaction():
+        if user_id:
+            _execute("DELETE FROM monthly_rollups WHERE user_id = ?", (user_id,))
+            _execute("UPDATE user_mappings SET expense_version = expense_version + 1 WHERE user_id = ?", (user_id,))
+        else:
+            _execute("DELETE FROM monthly_rollups")
+            _execute("UPDATE user_mappings SET expense_version = expense_version + 1")
+        _execute(
+            "INSERT INTO monthly_rollups (user_id, month, category, total, count) VALUES (?, ?, ?, ?, ?)",
+            [(uid, month, category, total, count) for (uid, month, category), (total, count) in rollups.items()],
+            many=True
+        )
+    return len(rollups)
+
+def check_monthly_rollups(user_id=None):
+    expected = _raw_rollups(user_id)
+    sql, params = "SELECT user_id, month, category, total, count FROM monthly_rollups", ()
+    if user_id:
+        sql, params = sql + " WHERE user_id = ?", (user_id,)
+    stored = {
+        (row["user_id"], row["month"], row["category"]): (row["total"], row["count"])
+        for row in _execute(sql, params)
+    }
+
+    mismatches = []
+    for key in set(expected) | set(stored):
+        want = expected.get(key, (0, 0))
+        have = stored.get(key, (0, 0))
+        if abs(want[0] - have[0]) > 0.005 or want[1] != have[1]:
+            mismatches.append({'key': key, 'expected': want, 'stored': have})
+    return mismatches
+
+def get_cached_insights(key):
+    row = _execute(
+        "SELECT text FROM insights_cache WHERE key = ? AND created_at >= ?",
+        (key, _ts(datetime.utcnow() - timedelta(seconds=INSIGHTS_CACHE_TTL_SECONDS)))
+    ).fetchone()
+    return row["text"] if row else None
+
+def save_cached_insights(key, text):
+    _execute(
+        "INSERT OR REPLACE INTO insights_cache (key, text, created_at) VALUES (?, ?, ?)",
+        (key, text, _ts(datetime.utcnow()))
+    )
+
+def record_payment(payment):
+    _execute("INSERT INTO payments (payment_id, doc) VALUES (?, ?)", (payment['payment_id'], _dumps(payment)))
+
+def get_payment(payment_id):
+    row = _execute("SELECT doc FROM payments WHERE payment_id = ?", (payment_id,)).fetchone()
+    return _loads(row["doc"]) if row else None
+
+_purged_at = 0
+
+def _purge_expired():
+    # Stands in for Mongo's TTL indexes: drop stale rows at most once a minute
+    global _purged_at
+    if time.monotonic() - _purged_at < 60:
+        return
+    _purged_at = time.monotonic()
+    now = datetime.utcnow()
+    _execute("DELETE FROM processed_messages WHERE created_at < ?",
+             (_ts(now - timedelta(seconds=MESSAGE_DEDUP_TTL_SECONDS)),))
+    _execute("DELETE FROM sessions WHERE updated_at < ?",
+             (_ts(now - timedelta(seconds=SESSION_TTL_SECONDS)),))
+    _execute("DELETE FROM insights_cache WHERE created_at < ?",
+             (_ts(now - timedelta(seconds=INSIGHTS_CACHE_TTL_SECONDS)),))
+
+def claim_message(message_sid):
+    # Returns (True, None) if this call should process the message, otherwise
+    # (False, response) with the stored reply, or None while still in progress
+    _purge_expired()
+    if _execute(
+        "INSERT OR IGNORE INTO processed_messages (sid, status, created_at) VALUES (?, 'pending', ?)",
+        (message_sid, _ts(datetime.utcnow()))
+    ).rowcount:
+        return True, None
+    row = _execute("SELECT response FROM processed_messages WHERE sid = ?", (message_sid,)).fetchone()
+    return False, row["response"] if row else None
+
+def store_message_response(message_sid, response):
+    _execute(
+        "UPDATE processed_messages SET status = 'done', response = ? WHERE sid = ?",
+        (response, message_sid)
+    )
+
+def release_message(message_sid):
+    # Processing failed: let Twilio's retry run it again
+    _execute("DELETE FROM processed_messages WHERE sid = ? AND status = 'pending'", (message_sid,))
+
+def _job(row):
+    job = dict(row)
+    job['_id'] = job.pop('id')
+    job['payload'] = _loads(job['payload'])
+    job['result'] = _loads(job['result'])
+    for key in ('lease_until', 'available_at', 'created_at', 'finished_at'):
+        job[key] = _dt(job[key])
+    return job
+
+def enqueue_job(user, kind, payload):
+    now = _ts(datetime.utcnow())
+    return str(_execute(
+        "INSERT INTO jobs (user, reply_to, kind, payload, status, attempts, created_at, available_at)"
+        " VALUES (?, ?, ?, ?, 'queued', 0, ?, ?)",
+        (normalize(user), user, kind, _dumps(payload), now, now)
+    ).lastrowid)
+
+# Users with a job running or waiting out a retry cannot start another, so
+# their queued jobs are left out instead of crowding the oldest ones. Of the
+# rest, the oldest job that is also its user's oldest unfinished one runs next,
+# which keeps each user's jobs in order. The unary + keeps the planner on
+# jobs_queue, so it walks queued jobs oldest first and stops at the first match
+# instead of sorting every due job
+CLAIM_JOB_SQL = (
+    "SELECT id FROM jobs AS j WHERE status = 'queued' AND +available_at <= ?"
+    " AND user NOT IN (SELECT user FROM jobs WHERE status = 'running'"
+    "  UNION SELECT user FROM jobs WHERE status = 'queued' AND available_at > ?)"
+    " AND NOT EXISTS (SELECT 1 FROM jobs AS o WHERE o.user = j.user AND o.status IN ('queued', 'running')"
+    "  AND (o.created_at < j.created_at OR (o.created_at = j.created_at AND o.id < j.id)))"
+    " ORDER BY created_at, id LIMIT 1"
+)
+
+def claim_job(worker_id, lease_seconds=60, scan=20):
+    # `scan` only matters to the Mongo backend, which checks candidates one by one
+    now = datetime.utcnow()
+    with _transaction():
+        # Jobs whose worker died mid-run go back on the queue
+        _execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL, lease_until = NULL"
+            " WHERE status = 'running' AND lease_until < ?",
+            (_ts(now),)
+        )
+        row = _execute(CLAIM_JOB_SQL, (_ts(now), _ts(now))).fetchone()
+        if row is None:
+            return None
+
+        _execute(
+            "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1"
+            " WHERE id = ?",
+            (worker_id, _ts(now + timedelta(seconds=lease_seconds)), row["id"])
+        )
+        return _job(_execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+def save_job_result(job_id, result):
+    _execute("UPDATE jobs SET result = ? WHERE id = ?", (_dumps(result), job_id))
+
+def complete_job(job_id):
+    _execute(
+        "UPDATE jobs SET status = 'done', finished_at = ?, lease_until = NULL WHERE id = ?",
+        (_ts(datetime.utcnow()), job_id)
+    )
+
+def fail_job(job_id, error, retry_delay=None):
+    # Without a retry delay the job is dead-lettered and stops blocking the user's queue
+    now = datetime.utcnow()
+    if retry_delay is None:
+        sql, params = "status = 'dead', finished_at = ?", [_ts(now)]
+    else:
+        sql, params = "status = 'queued', available_at = ?", [_ts(now + timedelta(seconds=retry_delay))]
+    _execute(
+        f"UPDATE jobs SET {sql}, last_error = ?, worker = NULL, lease_until = NULL WHERE id = ?",
+        params + [error, job_id]
+    )
+
+def get_dead_jobs(limit=50):
+    return [_job(row) for row in _execute(
+        "SELECT * FROM jobs WHERE status = 'dead' ORDER BY finished_at DESC LIMIT ?", (limit,)
+    )]
+
+def requeue_dead_jobs():
+    return _execute(
+        "UPDATE jobs SET status = 'queued', attempts = 0, available_at = ? WHERE status = 'dead'",
+        (_ts(datetime.utcnow()),)
+    ).rowcount
+
+def ensure_indexes(force=False):
+    # The schema is created with the first connection; this only tidies up
+    global _schema_ready, _purged_at
+    if force:
+        _schema_ready = False
+        _purged_at = 0
+        _create_schema(_conn())
+    _purge_expired()
+    return []
+
+# Representative shape of every query the app issues, used to check query plans
+QUERY_SHAPES = [
+    ('user_phones', "SELECT user_id FROM user_phones WHERE phone = ?", ('x',)),
+    ('user_phones', "SELECT phone FROM user_phones WHERE user_id = ?", ('x',)),
+    ('expenses', EXPENSE_PAGE_SQL.format(where="user IN (?)"), ('x', 20)),
+    ('expenses', EXPENSE_PAGE_SQL.format(where="user IN (?)" + AFTER_DATED), ('x', 'a', 1, 20)),
+    ('expenses', EXPENSE_PAGE_SQL.format(where="user IN (?)" + AFTER_UNDATED), ('x', 1, 20)),
+    ('expenses', "SELECT doc FROM expenses WHERE user IN (?) AND created_at >= ? AND created_at < ?", ('x', 'a', 'b')),
+    ('groups', "SELECT doc FROM groups WHERE name = ?", ('x',)),
+    ('groups', "SELECT doc FROM groups WHERE name IN (SELECT group_name FROM group_members WHERE member IN (?))", ('x',)),
+    ('group_expenses', "SELECT doc FROM group_expenses WHERE group_name = ? AND seq > ? ORDER BY seq", ('x', 0)),
+    ('budgets', "SELECT doc FROM budgets WHERE user_id = ?", ('x',)),
+    ('monthly_rollups', "SELECT total FROM monthly_rollups WHERE user_id = ? AND month = ?", ('x', 'm')),
+    ('monthly_rollups', "SELECT total FROM monthly_rollups WHERE user_id = ? AND month >= ? ORDER BY month", ('x', 'm')),
+    ('sessions', "SELECT data FROM sessions WHERE user = ?", ('x',)),
+    ('jobs', CLAIM_JOB_SQL, ('x', 'x')),
+    ('jobs', "SELECT 1 FROM jobs AS o WHERE o.user = ? AND o.status IN ('queued', 'running')"
+             " AND (o.created_at < ? OR (o.created_at = ? AND o.id < ?))", ('x', 'a', 'a', 1)),
+]
+
+def verify_query_plans():
+    # A full scan, or a sort the index cannot provide, grows with the table
+    scans = []
+    for table, sql, params in QUERY_SHAPES:
+        for row in _conn().execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row["detail"]
+            if (detail.startswith("SCAN") and "INDEX" not in detail) or detail.startswith("USE TEMP B-TREE"):
+                scans.append((table, sql))
+                break
+    return scans
+
+def check_health():
+    started = time.perf_counter()
+    try:
+        journal_mode = _conn().execute("PRAGMA journal_mode").fetchone()[0]
+        error = None
+    except sqlite3.Error as e:
+        journal_mode, error = None, str(e)
+    return {
+        'ok': error is None,
+        'error': error,
+        'ping_ms': round((time.perf_counter() - started) * 1000, 2),
+        'pid': os.getpid(),
+        'path': SQLITE_PATH,
+        'journal_mode': journal_mode,
+    }
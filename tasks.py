@@ -0,0 +1,90 @@
+from utils.helpers import normalize
+from utils.chart import generate_pie_chart_from_totals, wait_for_chart
+from utils.balance import calculate_group_balances
+from utils.ai_insights import get_monthly_summary_and_suggestions
+from utils.razorpay_integration import process_group_expense_share
+from utils.jobs import job_handler
+from utils.metrics import span
+from models.data import (
+    resolve_many, get_group_by_name, get_user_category_totals,
+    get_group_category_totals, record_payment, get_payment
+)
+
+# Slow commands run here, on the job workers, and reply out of band
+
+CHART_FAILED = "❌ Could not draw your chart right now. Please try again in a moment."
+
+@job_handler("monthly_review")
+def monthly_review(user):
+    with span('insights'):
+        return get_monthly_summary_and_suggestions(user), None
+
+@job_handler("personal_chart")
+def personal_chart(user, base_url):
+    key = generate_pie_chart_from_totals(get_user_category_totals(user))
+    if not key:
+        return "❌ No personal data to chart.", None
+    # Only send a link that will work; a failed render would leave it a 404
+    if not wait_for_chart(key):
+        return CHART_FAILED, None
+    return "📊 Your Personal Spending Chart:", base_url + f"chart/{key}"
+
+@job_handler("group_chart")
+def group_chart(user, group_name, base_url):
+    totals = get_group_category_totals(group_name)
+    if not totals:
+        return f"📭 No expenses in group '{group_name}' to chart.", None
+    key = generate_pie_chart_from_totals(totals, f"Category‑wise Spending in {group_name}")
+    if not key:
+        return "❌ Could not generate chart.", None
+    if not wait_for_chart(key):
+        return CHART_FAILED, None
+    return f"📊 Spending Chart for group '{group_name}':", base_url + f"chart/{key}"
+
+@job_handler("pay_share", with_job_id=True)
+def pay_share(user, group_name, job_id):
+    grp = group_name
+    group = get_group_by_name(grp)
+    if not group:
+        return f"❌ No group named '{grp}'.", None
+
+    balances = calculate_group_balances(group)
+    if not balances:
+        return f"📭 No expenses in group '{grp}' to calculate balances.", None
+
+    user_balance = balances.get(normalize(user), 0)
+    if user_balance >= 0:
+        return f"✅ You don't owe anything in group '{grp}'.", None
+
+    amount_to_pay = abs(user_balance)
+    
+    # Find the person who is owed money (has positive balance)
+    creditors = {m: b for m, b in balances.items() if b > 0}
+    if not creditors:
+        return f"❌ No one to pay in group '{grp}'.", None
+
+    # Get the first creditor (person who is owed money)
+    creditor = next(iter(creditors))
+
+    # The payment is keyed by the job, so a retry after a crash between the
+    # charge and the reply finds it instead of charging again
+    payment_id = f"share_{job_id}"
+    payment = get_payment(payment_id)
+    if payment:
+        return f"✅ Payment processed: ₹{payment['amount']:.2f} sent to {creditor} for your share in group '{grp}'.", None
+
+    identities = resolve_many([user, creditor])
+    
+    # Process payment for the user's share
+    payment = process_group_expense_share(
+        expense={"desc": f"Share in {grp}", "category": "group_share"},
+        user_id=identities[normalize(user)]["user_id"],
+        share_amount=amount_to_pay,
+        recipient_id=identities[normalize(creditor)]["user_id"],
+        payment_id=payment_id
+    )
+    
+    if payment:
+        record_payment(payment)
+        return f"✅ Payment processed: ₹{amount_to_pay:.2f} sent to {creditor} for your share in group '{grp}'.", None
+    return f"❌ Failed to process payment for ₹{amount_to_pay:.2f}. Please try again.", None
@@ -0,0 +1,63 @@
+import pytest
+
+ALICE = 'whatsapp:+911111111111'
+BOB = 'whatsapp:+912222222222'
+
+BAD_AMOUNTS = ['nan', 'inf', '-inf', '-50', '0', 'abc']
+
+def personal(send):
+    send(ALICE, 'hi')
+    send(ALICE, 'personal')
+
+def group(send):
+    for body in ['hi', 'group', 'create group', 'trip', '+911111111111 +912222222222']:
+        send(ALICE, body)
+    assert 'trip' in send(ALICE, 'view groups')
+
+@pytest.mark.parametrize('amount', BAD_AMOUNTS)
+def test_personal_add_rejects_bad_amounts(store, send, amount):
+    personal(send)
+    assert 'Invalid amount' in send(ALICE, f'add {amount} chips food')
+    assert store.get_user_expenses(ALICE) == []
+    assert store.check_monthly_rollups() == []
+
+@pytest.mark.parametrize('amount', BAD_AMOUNTS)
+def test_group_add_rejects_bad_amounts(store, send, amount):
+    group(send)
+    assert 'Invalid amount' in send(ALICE, f'add trip {amount} dinner food +911111111111')
+    assert store.get_group_expenses('trip') == []
+    assert store.verify_group_ledger('trip') == {}
+
+@pytest.mark.parametrize('amount', ['nan', 'inf', '-5'])
+def test_batch_add_rejects_bad_amounts(store, send, amount):
+    personal(send)
+    assert 'Nothing was added' in send(ALICE, f'add 10 tea food\n{amount} chips food')
+    assert store.get_user_expenses(ALICE) == []
+
+def test_personal_add_records_expense(store, send):
+    personal(send)
+    assert '✅ Added ₹200.0 under Food' in send(ALICE, 'add 200 chips food')
+    assert [e['amount'] for e in store.get_user_expenses(ALICE)] == [200.0]
+
+def test_group_add_records_expense(store, send):
+    group(send)
+    assert '✅ Added ₹300.0' in send(ALICE, 'add trip 300 dinner food +912222222222')
+    assert [e['amount'] for e in store.get_group_expenses('trip')] == [300.0]
+    assert store.verify_group_ledger('trip') == {}
+
+def test_batch_add_stops_when_a_payment_fails(store, send, monkeypatch):
+    import handlers
+    payments = iter([{'payment_id': 'log_1'}, None])
+    monkeypatch.setattr(handlers, 'process_expense_payment', lambda expense, user_id: next(payments))
+
+    personal(send)
+    assert 'Failed to process payment' in send(ALICE, 'add 10 tea food\n20 chips food')
+    assert store.get_user_expenses(ALICE) == []
+
+def test_group_batch_add_stops_when_a_payment_fails(store, send, monkeypatch):
+    import handlers
+    group(send)
+    monkeypatch.setattr(handlers, 'process_expense_payment', lambda expense, user_id: None)
+
+    assert 'Failed to process payment' in send(ALICE, 'add trip\n300 dinner food +911111111111\n100 cab transport +912222222222')
+    assert store.get_group_expenses('trip') == []
@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip('starlette')
+pytest.importorskip('motor')
+pytest.importorskip('httpx')
+
+from starlette.testclient import TestClient
+
+import asgi
+
+def test_motor_client_is_created_at_startup_with_listeners(store, monkeypatch):
+    if store.__name__ != 'models.mongodb':
+        pytest.skip("the embedded store has no async client")
+    from models.mongodb import pool_stats
+    from utils.metrics import MongoCommandTimer
+
+    created = []
+
+    def motor_client(*args, **kwargs):
+        created.append(kwargs)
+        return real(*args, **kwargs)
+    real = asgi.AsyncIOMotorClient
+    monkeypatch.setattr(asgi, 'AsyncIOMotorClient', motor_client)
+
+    # Importing the app must not open a client a forking server would copy
+    assert asgi.mongo is None and asgi.db is None
+    with TestClient(asgi.app) as client:
+        assert client.get('/healthz').status_code == 200
+        assert asgi.db is not None
+        listeners = created[0]['event_listeners']
+        assert pool_stats in listeners
+        assert any(isinstance(listener, MongoCommandTimer) for listener in listeners)
+    assert len(created) == 1
+    assert asgi.mongo is None
+
+@pytest.mark.parametrize('header, status', [
+    (None, 200), ('"other"', 200), ('"{key}"', 304), ('W/"{key}"', 304), ('"other", "{key}"', 304), ('*', 304),
+])
+def test_chart_revalidation(store, monkeypatch, tmp_path, header, status):
+    from utils import chart
+    monkeypatch.setattr(chart, 'CHART_DIR', str(tmp_path / 'charts'))
+    key = chart.generate_pie_chart([{'amount': 10, 'category': 'food'}, {'amount': 5, 'category': 'bills'}])
+    assert chart.wait_for_chart(key)
+
+    headers = {'If-None-Match': header.format(key=key)} if header else {}
+    with TestClient(asgi.app) as client:
+        response = client.get(f'/chart/{key}', headers=headers)
+    assert response.status_code == status
+    assert response.headers['etag'] == f'"{key}"'
+    assert 'immutable' in response.headers['cache-control']
+    if status == 304:
+        assert response.content == b''
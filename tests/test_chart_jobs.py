@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import time
+
+import pytest
+
+import tasks
+from utils import chart, jobs
+from conftest import drain_jobs
+
+ALICE = 'whatsapp:+911111111111'
+
+@pytest.fixture
+def charts(store, monkeypatch, tmp_path):
+    monkeypatch.setattr(chart, 'CHART_DIR', str(tmp_path / 'charts'))
+    store.add_expense({'user': ALICE, 'amount': 120, 'desc': 'lunch', 'category': 'food'})
+    return chart
+
+def test_chart_job_sends_the_link_once_rendered(charts, outbox):
+    jobs.enqueue(ALICE, 'personal_chart', base_url='http://bot/')
+    drain_jobs()
+
+    [reply] = outbox
+    key = reply['media_url'].rsplit('/', 1)[1]
+    assert reply['media_url'] == f'http://bot/chart/{key}'
+    assert charts.touch_chart(key)
+
+def test_failed_render_sends_text_instead_of_a_dead_link(charts, outbox, monkeypatch):
+    def broken(*args):
+        raise RuntimeError("renderer crashed")
+    # A thread pool picks up the patched renderer; forked workers would not
+    pool = ThreadPoolExecutor(1)
+    monkeypatch.setattr(chart, '_get_pool', lambda: pool)
+    monkeypatch.setattr(chart, '_render', broken)
+
+    jobs.enqueue(ALICE, 'personal_chart', base_url='http://bot/')
+    drain_jobs()
+    pool.shutdown()
+
+    assert outbox == [{'to': ALICE, 'body': tasks.CHART_FAILED, 'media_url': None}]
+
+@pytest.fixture
+def thread_renders(charts, monkeypatch):
+    # Renders in a thread, writing the inputs instead of a picture
+    def render(cats, amts, title, path):
+        with open(path, 'w') as f:
+            f.write(title)
+        return path
+    pool = ThreadPoolExecutor(1)
+    monkeypatch.setattr(chart, '_get_pool', lambda: pool)
+    monkeypatch.setattr(chart, '_render', render)
+    yield charts
+    pool.shutdown()
+
+def test_stale_marker_is_rendered_again(thread_renders):
+    key = chart.chart_key({'food': 10}, 'Spending')
+    os.makedirs(chart.CHART_DIR)
+    marker = chart._marker_path(key)
+    with open(marker, 'w', encoding='utf-8') as f:
+        json.dump({'cats': ['food'], 'amts': [10], 'title': 'Spending'}, f)
+    assert chart.is_chart_pending(key)
+
+    # Left behind by a worker that died mid-render
+    old = time.time() - chart.CHART_RENDER_TIMEOUT - 1
+    os.utime(marker, (old, old))
+    assert not chart.is_chart_pending(key)
+
+    assert chart.wait_for_chart(key, timeout=5)
+    with open(chart.chart_path(key)) as f:
+        assert f.read() == 'Spending'
+
+def test_eviction_removes_least_recently_used_first(charts, monkeypatch):
+    os.makedirs(chart.CHART_DIR)
+    now = time.time()
+    for key, age in {'older': 40, 'old': 30, 'new': 10, 'newest': 0}.items():
+        path = chart.chart_path(key)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(path, (now - age, now - age))
+    monkeypatch.setattr(chart, 'CHART_CACHE_MAX_BYTES', 250)
+
+    chart._evict(keep=chart.chart_path('newest'))
+    assert sorted(os.listdir(chart.CHART_DIR)) == ['new.png', 'newest.png']
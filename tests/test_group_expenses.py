@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+from pymongo.errors import PyMongoError
+
+def failing_insert(store, monkeypatch):
+    # The expense insert fails after the first row has been written
+    if store.__name__ == 'models.sqlite':
+        insert = store._insert_group_expenses
+
+        def broken(name, expenses):
+            insert(name, expenses[:1])
+            raise sqlite3.OperationalError("disk I/O error")
+        monkeypatch.setattr(store, '_insert_group_expenses', broken)
+        return sqlite3.Error
+
+    # Patch this test's collection, not the process-wide lazy proxy
+    collection = store.group_expenses_collection._current()
+    insert_many = collection.insert_many
+
+    def broken(expenses, *args, **kwargs):
+        insert_many(expenses[:1], *args, **kwargs)
+        raise PyMongoError("connection reset")
+    monkeypatch.setattr(collection, 'insert_many', broken)
+    return PyMongoError
+
+def test_failed_insert_leaves_the_ledger_untouched(store, monkeypatch):
+    store.add_group({'name': 'trip', 'members': ['911111111111', '912222222222'],
+                     'expenses': [{'amount': 300, 'desc': 'dinner', 'category': 'food', 'paid_by': '911111111111'}]})
+    before = store.get_group_by_name('trip')
+
+    batch = [
+        {'amount': 100, 'desc': 'cab', 'category': 'transport', 'paid_by': '912222222222'},
+        {'amount': 50, 'desc': 'snacks', 'category': 'food', 'paid_by': '912222222222'},
+    ]
+    with monkeypatch.context() as patch:
+        with pytest.raises(failing_insert(store, patch)):
+            store.add_group_expenses(dict(before), batch)
+
+    after = store.get_group_by_name('trip')
+    assert after['ledger'] == before['ledger']
+    assert after['expense_count'] == 1
+    assert [e['desc'] for e in store.get_group_expenses('trip')] == ['dinner']
+    assert store.verify_group_ledger('trip') == {}
+
+    # The next write still goes through and keeps the ledger exact
+    assert store.add_group_expense(after, {'amount': 20, 'desc': 'tea', 'category': 'food', 'paid_by': '912222222222'})
+    assert [e['desc'] for e in store.get_group_expenses('trip')] == ['dinner', 'tea']
+    assert store.verify_group_ledger('trip') == {}
+
+def test_balances_list_the_latest_expenses(store, send):
+    store.add_group({'name': 'trip', 'members': ['+911111111111', '+912222222222'],
+                     'expenses': [{'amount': 10 + i, 'desc': f'item{i}', 'category': 'food', 'paid_by': '+911111111111'}
+                                  for i in range(25)]})
+    send('whatsapp:+911111111111', 'hi')
+    send('whatsapp:+911111111111', 'group')
+    body = send('whatsapp:+911111111111', 'view balances trip')
+
+    assert 'item24' in body and 'item5' in body
+    assert 'item4' not in body
+    assert '…and 5 earlier' in body
@@ -0,0 +1,53 @@
+import pytest
+
+import tasks
+from utils import jobs
+from conftest import drain_jobs
+
+ALICE = 'whatsapp:+911111111111'
+BOB = 'whatsapp:+912222222222'
+
+@pytest.fixture
+def charges(store, monkeypatch):
+    # Bob owes Alice half of a 300 dinner; record every charge attempt
+    store.add_group({'name': 'trip', 'members': ['+911111111111', '+912222222222'],
+                     'expenses': [{'amount': 300, 'desc': 'dinner', 'category': 'food', 'paid_by': '+911111111111'}]})
+    made = []
+    charge = tasks.process_group_expense_share
+
+    def counted(*args, **kwargs):
+        made.append(kwargs)
+        return charge(*args, **kwargs)
+    monkeypatch.setattr(tasks, 'process_group_expense_share', counted)
+    return made
+
+def test_pay_share_charges_once_per_job(store, charges):
+    first = tasks.pay_share(BOB, 'trip', job_id='42')
+    again = tasks.pay_share(BOB, 'trip', job_id='42')
+
+    assert first == again
+    assert '₹150.00 sent to' in first[0]
+    assert len(charges) == 1
+    assert store.get_payment('share_42')['amount'] == 150
+
+def test_retried_job_does_not_charge_again(store, charges, outbox, monkeypatch):
+    jobs.enqueue(BOB, 'pay_share', group_name='trip')
+    job = jobs.claim_job('w1')
+
+    # The worker dies after the charge but before the job result is stored
+    save_job_result = jobs.save_job_result
+
+    def crash(job_id, result):
+        raise RuntimeError("worker lost")
+    monkeypatch.setattr(jobs, 'save_job_result', crash)
+    jobs.run_job(job)
+    assert outbox == []
+
+    monkeypatch.setattr(jobs, 'save_job_result', save_job_result)
+    store.fail_job(job['_id'], 'worker lost', retry_delay=0)
+    drain_jobs()
+
+    assert len(charges) == 1
+    assert [m['body'] for m in outbox] == [
+        "✅ Payment processed: ₹150.00 sent to 911111111111 for your share in group 'trip'."
+    ]
@@ -0,0 +1,100 @@
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils.payment_gateway import CircuitBreaker, GatewayError, RazorpayGateway
+from utils.metrics import render_metrics
+
+class Gateway(BaseHTTPRequestHandler):
+    # Answers every request with the next status in `statuses`
+    statuses = []
+    calls = []
+
+    def _answer(self):
+        self.calls.append(self.command)
+        status = self.statuses.pop(0) if self.statuses else 200
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        body = b'{"id": "order_1"}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    Gateway.statuses, Gateway.calls = [], []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Gateway)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture
+def silent():
+    # Accepts connections and never answers, so reads time out
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    yield f"http://127.0.0.1:{sock.getsockname()[1]}"
+    sock.close()
+
+def gateway(base_url, **kwargs):
+    return RazorpayGateway('key', 'secret', base_url=base_url, connect_timeout=1, read_timeout=0.2,
+                           max_retries=2, backoff=0, breaker=CircuitBreaker(failure_threshold=100), **kwargs)
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_order_is_not_resent_after_a_5xx(server):
+    Gateway.statuses = [502, 200]
+    with pytest.raises(GatewayError):
+        gateway(server).create_order({'amount': 100})
+    assert Gateway.calls == ['POST']
+
+def test_order_is_not_resent_after_a_read_timeout(silent):
+    client = gateway(silent)
+    with pytest.raises(GatewayError):
+        client.create_order({'amount': 100})
+    assert client.metrics()['requests'] == 1
+
+def test_order_is_retried_when_the_connection_fails():
+    client = gateway(f"http://127.0.0.1:{closed_port()}")
+    with pytest.raises(GatewayError) as error:
+        client.create_order({'amount': 100})
+    assert error.value.retryable
+    assert client.metrics()['requests'] == 3
+
+def test_order_is_retried_after_429(server):
+    Gateway.statuses = [429, 200]
+    assert gateway(server).create_order({'amount': 100}) == {'id': 'order_1'}
+    assert Gateway.calls == ['POST', 'POST']
+
+def test_reads_are_retried_after_5xx(server):
+    Gateway.statuses = [503, 200]
+    assert gateway(server)._request('GET', '/v1/orders/order_1') == {'id': 'order_1'}
+    assert Gateway.calls == ['GET', 'GET']
+
+def test_gateway_figures_are_exported():
+    from utils import razorpay_integration
+    razorpay_integration.gateway._observe(0.25, failed=True)
+
+    text = render_metrics()
+    metrics = razorpay_integration.gateway_metrics()
+    assert f"expensebot_gateway_requests_total {metrics['requests']}" in text
+    assert f"expensebot_gateway_failures_total {metrics['failures']}" in text
+    assert "# TYPE expensebot_gateway_latency_seconds summary" in text
+    assert f"expensebot_gateway_latency_seconds_sum {metrics['latency_sum']}" in text
+    assert f'expensebot_gateway_breaker_state{{state="{metrics["breaker_state"]}"}} 1' in text
+    assert "expensebot_gateway_breaker_opened_total" in text
@@ -0,0 +1,11 @@
+import pytest
+
+def test_sqlite_queries_use_indexes(store):
+    if store.__name__ != 'models.sqlite':
+        pytest.skip("mongomock has no query planner; see test_mongo_queries_use_indexes")
+    assert store.verify_query_plans() == []
+
+def test_mongo_queries_use_indexes(mongo_server):
+    assert mongo_server.ensure_indexes(force=True) == []
+    collscans = mongo_server.verify_query_plans()
+    assert collscans == [], f"COLLSCAN: {collscans}"
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+ALICE = 'whatsapp:+911111111111'
+
+def seed(store, count, offset=0):
+    # `count` expenses for Alice and as many for other users, spread over a year
+    user_id = store.get_user_id(ALICE)
+    now = datetime.utcnow()
+    rows = [{'user': ALICE, 'amount': 10 + i % 50, 'desc': 'item', 'category': ('food', 'transport', 'bills')[i % 3],
+             'created_at': now - timedelta(days=i % 365), 'import_hash': f'a{offset + i}'} for i in range(count)]
+    store.import_expenses(user_id, rows)
+    for n in range(5):
+        other = f'whatsapp:+9199000000{n:02d}'
+        store.import_expenses(store.get_user_id(other), [
+            dict(row, user=other, import_hash=f'{n}-{row["import_hash"]}') for row in rows[:count // 5]
+        ])
+
+def round_trips(send, db_ops):
+    # Round trips of 'view budget' then 'back', starting from the personal menu
+    trips = {}
+    for body in ('view budget', 'back'):
+        del db_ops[:]
+        send(ALICE, body)
+        trips[body] = list(db_ops)
+    send(ALICE, 'hi')
+    send(ALICE, 'personal')
+    return trips
+
+def test_budget_and_back_cost_the_same_round_trips_at_any_size(store, send, db_ops):
+    send(ALICE, 'hi')
+    send(ALICE, 'personal')
+    send(ALICE, 'set budget')
+    send(ALICE, 'food 1000 transport 200')
+
+    seed(store, 10)
+    small = round_trips(send, db_ops)
+
+    seed(store, 1000, offset=10)
+    large = round_trips(send, db_ops)
+
+    assert large == small
+    # Message claim, session load and save, reply storage, plus the budget
+    # and this month's rollup for 'view budget'
+    assert len(small['view budget']) <= 8
+    assert len(small['back']) <= 4
@@ -0,0 +1,34 @@
+from utils.router import Command, Router
+
+def handlers(router):
+    @router.route("menu", r"add[^\n]*\n.*")
+    def add_batch(ctx, cmd, reply):
+        pass
+
+    @router.route("menu", r"add(\s.*)?")
+    def add(ctx, cmd, reply):
+        pass
+
+    @router.fallback("menu")
+    def help(ctx, cmd, reply):
+        pass
+    return add_batch, add, help
+
+def test_first_registered_pattern_wins():
+    router = Router()
+    add_batch, add, help = handlers(router)
+
+    assert router.resolve("menu", Command("add\n120 tea food")) is add_batch
+    assert router.resolve("menu", Command("ADD 120 tea food")) is add
+    assert router.resolve("menu", Command("added")) is help
+    assert router.resolve("other", Command("add 1 x y")) is None
+
+def test_routes_added_later_are_matched():
+    router = Router()
+    add_batch, add, help = handlers(router)
+    assert router.resolve("menu", Command("view all")) is help
+
+    @router.route("menu", r"view all")
+    def view_all(ctx, cmd, reply):
+        pass
+    assert router.resolve("menu", Command("view all")) is view_all
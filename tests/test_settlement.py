@@ -0,0 +1,47 @@
+import random
+
+from utils import settlement
+from utils.settlement import MAX_EXACT_MEMBERS, plan_settlements
+
+# Greedy starts with C -> D and needs 4 transfers; {B, D} and {A, C, E} settle in 3
+UNEVEN = {'A': 2, 'B': -3, 'C': -4, 'D': 3, 'E': 2}
+
+def settle(balances, transfers):
+    paise = settlement._to_paise(balances)
+    for debtor, creditor, amount in transfers:
+        assert amount > 0
+        paise[debtor] += amount
+        paise[creditor] -= amount
+    return paise
+
+def random_balances(n, seed):
+    rng = random.Random(seed)
+    amounts = [rng.randint(-5000, 5000) for _ in range(n - 1)]
+    balances = {f'm{i}': amount / 100 for i, amount in enumerate(amounts)}
+    balances[f'm{n - 1}'] = -sum(amounts) / 100
+    return balances
+
+def test_every_balance_ends_at_zero():
+    for seed in range(20):
+        balances = random_balances(8, seed)
+        for exact in (False, True):
+            transfers = plan_settlements(balances, exact=exact)
+            assert set(settle(balances, transfers).values()) <= {0}
+            assert len(transfers) <= len(balances) - 1
+
+def test_exact_finds_the_fewest_transfers():
+    assert len(plan_settlements(UNEVEN)) == 4
+    assert len(plan_settlements(UNEVEN, exact=True)) == 3
+
+def test_disjoint_pairs_settle_separately():
+    balances = {'A': 5, 'B': -5, 'C': 3, 'D': -3, 'E': 7, 'F': -7}
+    transfers = plan_settlements(balances, exact=True)
+    assert sorted(transfers) == [('B', 'A', 500), ('D', 'C', 300), ('F', 'E', 700)]
+
+def test_large_groups_fall_back_to_greedy(monkeypatch):
+    balances = random_balances(MAX_EXACT_MEMBERS + 1, 0)
+    monkeypatch.setattr(settlement, '_zero_sum_partition', None)
+    assert plan_settlements(balances, exact=True) == plan_settlements(balances)
+
+def test_exhausted_time_budget_falls_back_to_greedy():
+    assert plan_settlements(UNEVEN, exact=True, time_budget=-1) == plan_settlements(UNEVEN)
@@ -0,0 +1,59 @@
+from utils import statement_import
+
+ALICE = 'whatsapp:+911111111111'
+
+# Two coffees at the same shop on the same day, with no reference or balance column
+STATEMENT = """Date,Narration,Debit,Credit
+15/01/2024,STARBUCKS MG ROAD,250.00,
+15/01/2024,STARBUCKS MG ROAD,250.00,
+16/01/2024,UBER TRIP,180.00,
+16/01/2024,SALARY,,50000.00
+"""
+
+def test_identical_rows_are_separate_expenses(store):
+    first = statement_import.import_statement(ALICE, STATEMENT.splitlines(keepends=True))
+    again = statement_import.import_statement(ALICE, STATEMENT.splitlines(keepends=True))
+
+    assert (first['imported'], first['duplicates']) == (3, 0)
+    assert (again['imported'], again['duplicates']) == (0, 3)
+    assert sorted(e['amount'] for e in store.get_user_expenses(ALICE)) == [180, 250, 250]
+
+def test_repeats_are_numbered_within_each_day():
+    lines = STATEMENT.splitlines(keepends=True)[:3] + ["16/01/2024,STARBUCKS MG ROAD,250.00,\n"] * 2
+    fingerprints = [fields['fingerprint'] for _, fields, _ in statement_import.parse_statement(lines)]
+    assert [len(f) for f in fingerprints] == [5, 6, 5, 6]
+    assert fingerprints[1][-1] == fingerprints[3][-1] == 2
+
+def test_overlapping_export_only_adds_new_rows(store):
+    statement_import.import_statement(ALICE, STATEMENT.splitlines(keepends=True)[:3])
+    result = statement_import.import_statement(ALICE, STATEMENT.splitlines(keepends=True))
+    assert (result['imported'], result['duplicates']) == (1, 2)
+
+def test_cli_creates_indexes_before_importing(store, monkeypatch, tmp_path, capsys):
+    calls = []
+    ensure_indexes = statement_import.ensure_indexes
+    import_statement = statement_import.import_statement
+
+    def ensure(*args, **kwargs):
+        calls.append('ensure_indexes')
+        return ensure_indexes(*args, **kwargs)
+
+    def run(*args, **kwargs):
+        calls.append('import')
+        return import_statement(*args, **kwargs)
+    monkeypatch.setattr(statement_import, 'ensure_indexes', ensure)
+    monkeypatch.setattr(statement_import, 'import_statement', run)
+    path = tmp_path / 'statement.csv'
+    path.write_text(STATEMENT)
+
+    assert statement_import.main(['--user', '+911111111111', str(path)]) == 0
+    assert calls == ['ensure_indexes', 'import']
+    assert 'Imported 3 expense(s)' in capsys.readouterr().out
+
+def test_cli_refuses_to_import_without_indexes(store, monkeypatch, tmp_path):
+    monkeypatch.setattr(statement_import, 'ensure_indexes', lambda *args, **kwargs: [('expenses', 'import_hash')])
+    path = tmp_path / 'statement.csv'
+    path.write_text(STATEMENT)
+
+    assert statement_import.main(['--user', '+911111111111', str(path)]) == 1
+    assert store.get_user_expenses(ALICE) == []
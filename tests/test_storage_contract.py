@@ -0,0 +1,239 @@
+from datetime import datetime, timedelta
+
+ALICE = 'whatsapp:+911111111111'
+BOB = 'whatsapp:+912222222222'
+
+def expense(amount, category='food', user=ALICE, desc='item'):
+    return {'user': user, 'amount': amount, 'desc': desc, 'category': category}
+
+def test_identity_is_stable_and_shared_across_phones(store):
+    user_id = store.get_user_id(ALICE)
+    assert store.get_user_id('+91 11111 11111') == user_id
+    assert store.add_phone_to_user(user_id, '913333333333')
+    assert not store.add_phone_to_user(user_id, '913333333333')
+    assert store.get_user_id('whatsapp:+913333333333') == user_id
+
+    resolved = store.resolve_many([ALICE, BOB])
+    assert resolved['911111111111']['user_id'] == user_id
+    assert resolved['912222222222']['user_id'] != user_id
+    assert store.resolve_identity('919999999999', create=False) is None
+
+def test_session_round_trip(store):
+    assert store.get_session(ALICE) == {'state': None, 'temp': {}}
+    store.save_session(ALICE, {'state': 'personal', 'temp': {'page': 2}})
+    assert store.get_session(ALICE) == {'state': 'personal', 'temp': {'page': 2}}
+    store.delete_session(ALICE)
+    assert store.get_session(ALICE)['state'] is None
+
+def test_expenses_update_rollups_and_version(store):
+    user_id = store.get_user_id(ALICE)
+    version = store.get_expense_version(user_id)
+    store.add_expense(expense(200))
+    store.add_expenses([expense(50, 'transport'), expense(25)])
+
+    assert sorted(e['amount'] for e in store.get_user_expenses(ALICE)) == [25, 50, 200]
+    assert store.get_expense_version(user_id) > version
+
+    month = datetime.utcnow().strftime('%Y-%m')
+    assert store.get_monthly_rollup(user_id, month) == {'food': 225, 'transport': 50}
+    assert store.get_user_budget_usage(user_id) == {'food': 225, 'transport': 50}
+    assert store.get_user_category_totals(ALICE) == {'food': 225, 'transport': 50}
+    assert store.get_user_category_totals('919999999999') == {}
+    start, end = store.month_bounds(month)
+    assert store.get_category_totals(user_id, start, end) == {'food': 225, 'transport': 50}
+    assert store.check_monthly_rollups(user_id) == []
+
+def test_rebuild_rollups_matches_incremental_totals(store):
+    user_id = store.get_user_id(ALICE)
+    store.add_expenses([expense(10), expense(20, 'bills')])
+    before = store.get_monthly_rollup(user_id, datetime.utcnow().strftime('%Y-%m'))
+    version = store.get_expense_version(user_id)
+
+    assert store.rebuild_monthly_rollups(user_id) == 2
+    assert store.get_monthly_rollup(user_id, datetime.utcnow().strftime('%Y-%m')) == before
+    assert store.get_expense_version(user_id) > version
+
+def forget_mappings(store):
+    # Leaves expenses whose owner has no user mapping, as a partial restore would
+    if store.__name__ == 'models.sqlite':
+        store._execute("DELETE FROM user_phones")
+        store._execute("DELETE FROM user_mappings")
+    else:
+        store.user_mappings_collection.delete_many({})
+    store._identity_cache.clear()
+
+def test_checking_rollups_creates_no_mappings(store):
+    store.add_expense(expense(10, user=BOB))
+    forget_mappings(store)
+
+    # The orphaned expense is left out, so its stored rollup shows as a mismatch
+    assert [m['expected'] for m in store.check_monthly_rollups()] == [(0, 0)]
+    assert store.resolve_identity(BOB, create=False) is None
+
+def test_import_skips_rows_already_imported(store):
+    user_id = store.get_user_id(ALICE)
+    day = datetime(2024, 1, 15)
+    rows = [dict(expense(100), created_at=day, import_hash=f'h{i}') for i in range(3)]
+    assert store.import_expenses(user_id, rows) == (3, 0)
+
+    again = [dict(expense(100), created_at=day, import_hash=f'h{i}') for i in range(4)]
+    assert store.import_expenses(user_id, again) == (1, 3)
+    assert store.get_monthly_rollup(user_id, '2024-01') == {'food': 400}
+
+def test_user_expense_pages_cover_every_row_once(store):
+    store.add_expenses([expense(i) for i in range(1, 8)])
+    seen, after = [], None
+    while True:
+        page, after = store.get_user_expenses_page(ALICE, after, limit=3)
+        seen += [e['amount'] for e in page]
+        if after is None:
+            break
+    assert sorted(seen) == list(range(1, 8))
+
+def add_legacy_expenses(store, expenses):
+    # Rows written before expenses carried created_at
+    if store.__name__ == 'models.sqlite':
+        store._execute(f"INSERT INTO {store.EXPENSE_COLUMNS}", [store._expense_row(e) for e in expenses], many=True)
+    else:
+        store.expenses_collection.insert_many(expenses)
+
+def test_user_expense_pages_include_rows_without_created_at(store):
+    add_legacy_expenses(store, [expense(i) for i in range(1, 6)])
+    store.add_expenses([expense(i) for i in range(6, 9)])
+    seen, after = [], None
+    while True:
+        page, after = store.get_user_expenses_page(ALICE, after, limit=2)
+        seen += [e['amount'] for e in page]
+        if after is None:
+            break
+    assert seen == list(range(1, 9))
+
+def test_group_ledger_and_paging(store):
+    store.add_group({'name': 'trip', 'members': ['911111111111', '912222222222'], 'created_by': ALICE,
+                     'expenses': [{'amount': 300, 'desc': 'dinner', 'category': 'food', 'paid_by': '911111111111'}]})
+    group = store.get_group_by_name('trip')
+    assert store.add_group_expenses(group, [
+        {'amount': 100, 'desc': 'cab', 'category': 'transport', 'paid_by': '912222222222'},
+        {'amount': 50, 'desc': 'snacks', 'category': 'food', 'paid_by': '912222222222'},
+    ])
+    assert store.add_group_expense(group, {'amount': 10, 'desc': 'tip', 'category': 'food', 'paid_by': '911111111111'})
+    assert not store.add_group_expense({'name': 'nope', 'members': ['911111111111']}, {'amount': 1, 'paid_by': '911111111111'})
+
+    assert [e['seq'] for e in store.get_group_expenses('trip')] == [1, 2, 3, 4]
+    page, after = store.get_group_expenses_page('trip', limit=3)
+    assert [e['seq'] for e in page] == [1, 2, 3]
+    assert [e['seq'] for e in store.get_group_expenses('trip', after_seq=after)] == [4]
+
+    assert store.get_group_category_totals('trip') == {'food': 360, 'transport': 100}
+    assert store.verify_group_ledger('trip') == {}
+    ledger = store.get_group_by_name('trip')['ledger']
+    # Ledgers are kept in paise
+    assert ledger['911111111111'] == {'paid': 31000, 'owed': 23000}
+    assert store.get_group_names() == ['trip']
+    store.get_user_id(BOB)
+    assert [g['name'] for g in store.get_user_groups(BOB)] == ['trip']
+
+def test_budget_merges_updates(store):
+    user_id = store.get_user_id(ALICE)
+    assert store.get_user_budget(user_id) is None
+    store.set_user_budget(user_id, {'categories': {'food': 1000}})
+    store.set_user_budget(user_id, {'total': 1500})
+    budget = store.get_user_budget(user_id)
+    assert budget['categories'] == {'food': 1000} and budget['total'] == 1500
+
+def test_message_claims_are_exclusive(store):
+    assert store.claim_message('SM1') == (True, None)
+    assert store.claim_message('SM1') == (False, None)
+    store.store_message_response('SM1', '<Response/>')
+    assert store.claim_message('SM1') == (False, '<Response/>')
+
+    assert store.claim_message('SM2') == (True, None)
+    store.release_message('SM2')
+    assert store.claim_message('SM2') == (True, None)
+
+def test_jobs_run_in_order_per_user_and_dead_letter(store):
+    first = store.enqueue_job(ALICE, 'monthly_review', {})
+    store.enqueue_job(ALICE, 'monthly_review', {})
+
+    job = store.claim_job('w1')
+    assert str(job['_id']) == first and job['attempts'] == 1
+    # The user's second job waits until the first one finishes
+    assert store.claim_job('w2') is None
+
+    store.fail_job(job['_id'], 'boom')
+    assert [str(j['_id']) for j in store.get_dead_jobs()] == [first]
+
+    second = store.claim_job('w1')
+    store.save_job_result(second['_id'], {'body': 'ok', 'media_url': None})
+    store.complete_job(second['_id'])
+    assert store.claim_job('w1') is None
+
+    assert store.requeue_dead_jobs() == 1
+    assert str(store.claim_job('w1')['_id']) == first
+
+def test_job_retry_waits_for_its_delay(store):
+    store.enqueue_job(ALICE, 'monthly_review', {})
+    job = store.claim_job('w1')
+    store.fail_job(job['_id'], 'flaky', retry_delay=60)
+    assert store.claim_job('w1') is None
+
+def test_payments_are_recorded_once(store):
+    store.record_payment({'payment_id': 'pay_1', 'amount': 10, 'created_at': datetime.utcnow()})
+    try:
+        store.record_payment({'payment_id': 'pay_1', 'amount': 10})
+    except Exception:
+        pass
+    else:
+        raise AssertionError("duplicate payment_id was accepted")
+
+def test_shared_insights_cache(store):
+    assert store.get_cached_insights('u:2024-01:1') is None
+    store.save_cached_insights('u:2024-01:1', 'review')
+    assert store.get_cached_insights('u:2024-01:1') == 'review'
+
+def test_export_streams_filtered_rows(store):
+    user_id = store.get_user_id(ALICE)
+    store.import_expenses(user_id, [
+        dict(expense(10), created_at=datetime(2024, 1, 1), import_hash='a'),
+        dict(expense(20, 'Transport'), created_at=datetime(2024, 1, 2), import_hash='b'),
+        dict(expense(30), created_at=datetime(2024, 2, 1), import_hash='c'),
+    ])
+    rows = list(store.iter_user_expenses(ALICE, start=datetime(2024, 1, 1), end=datetime(2024, 1, 1) + timedelta(days=31)))
+    assert [r['amount'] for r in rows] == [10, 20]
+    assert [r['amount'] for r in store.iter_user_expenses(ALICE, category='transport')] == [20]
+    assert list(store.iter_user_expenses('919999999999')) == []
+
+def test_health(store):
+    assert store.check_health()['ok']
+
+def test_groups_are_listed_before_the_member_is_resolved(store):
+    # Identities are resolved lazily, so a member may not have one yet
+    store.add_group({'name': 'trip', 'members': ['+911111111111', '+912222222222']})
+    assert store.resolve_identity(BOB, create=False) is None
+    assert [g['name'] for g in store.get_user_groups(BOB)] == ['trip']
+
+def test_busy_user_does_not_block_other_users(store):
+    for _ in range(30):
+        store.enqueue_job(ALICE, 'monthly_review', {})
+    bob_job = store.enqueue_job(BOB, 'monthly_review', {})
+
+    first = store.claim_job('w1')
+    assert first['user'] == '911111111111'
+    # Alice's other 29 jobs wait for the first, but must not hide Bob's
+    assert str(store.claim_job('w2')['_id']) == bob_job
+    assert store.claim_job('w3') is None
+
+def test_user_waiting_out_a_retry_does_not_block_others(store):
+    for _ in range(25):
+        store.enqueue_job(ALICE, 'monthly_review', {})
+    bob_job = store.enqueue_job(BOB, 'monthly_review', {})
+
+    first = store.claim_job('w1')
+    store.fail_job(first['_id'], 'flaky', retry_delay=60)
+    assert str(store.claim_job('w1')['_id']) == bob_job
+    assert store.claim_job('w1') is None
+
+def test_payments_can_be_looked_up(store):
+    assert store.get_payment('share_1') is None
+    store.record_payment({'payment_id': 'share_1', 'amount': 12.5})
+    assert store.get_payment('share_1')['amount'] == 12.5
@@ -0,0 +1,127 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _connection(store):
+    if store.__name__ == 'models.sqlite':
+        return store._conn()
+    return store.get_client()
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_forked_child_opens_its_own_connection(store):
+    parent = _connection(store)
+    store.get_session('whatsapp:+911111111111')
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            child = _connection(store)
+            # The child must not reuse the parent's sockets or file handle
+            ok = child is not parent and _connection(store) is child
+            store.get_session('whatsapp:+911111111111')
+            os.write(write_end, b'1' if ok else b'0')
+        except BaseException:
+            os.write(write_end, b'E')
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end, 1)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    assert result == b'1'
+    assert _connection(store) is parent
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_forked_child_starts_its_own_log_listener():
+    from utils import log
+    log.get_logger('test')
+    parent, records = log._listener, log._handler.queue
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ok = (log._listener is not parent and log._listener._thread.is_alive()
+                  and log._handler.queue is not records)
+            log._listener.stop()
+            os.write(write_end, b'1' if ok else b'0')
+        except BaseException:
+            os.write(write_end, b'E')
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end, 1)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    assert result == b'1'
+    assert log._listener is parent and log._handler.queue is records
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _post(url, data):
+    body = urllib.parse.urlencode(data).encode()
+    with urllib.request.urlopen(url, body, timeout=30) as response:
+        return response.status
+
+def _get(url):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return json.loads(response.read())
+
+def test_multi_worker_server_against_mongod(mongo_server, tmp_path):
+    # gunicorn --preload imports the app once and then forks the workers,
+    # which is exactly when an eagerly created client would be shared
+    pytest.importorskip('gunicorn')
+    port = _free_port()
+    env = dict(
+        os.environ,
+        STORAGE_BACKEND='mongo', MONGODB_URI=mongo_server.MONGODB_URI, MONGODB_DB=mongo_server.MONGODB_DB,
+        MESSENGER='fake', JOB_WORKERS='1', CHART_CACHE_DIR=str(tmp_path / 'charts'),
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--preload', '-w', '4', '-b', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(100):
+            try:
+                _get(f'{base}/healthz')
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        users = [f'whatsapp:+9188000000{n:02d}' for n in range(20)]
+        script = ['hi', 'personal'] + [f'add {n} item food' for n in range(1, 6)]
+
+        def conversation(user):
+            return [
+                _post(f'{base}/webhook', {'From': user, 'Body': body, 'MessageSid': f'{user}-{i}'})
+                for i, body in enumerate(script)
+            ]
+        with ThreadPoolExecutor(len(users)) as pool:
+            statuses = [s for result in pool.map(conversation, users) for s in result]
+        assert set(statuses) == {200}
+
+        pids = {_get(f'{base}/healthz')['pid'] for _ in range(40)}
+        assert len(pids) > 1
+    finally:
+        server.terminate()
+        server.wait(10)
+
+    for user in users:
+        assert sorted(e['amount'] for e in mongo_server.get_user_expenses(user)) == [1, 2, 3, 4, 5]
+    assert mongo_server.check_monthly_rollups() == []
@@ -3,40 +3,54 @@ import os
 import json
 import random
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
-from models.mongodb import get_user_expenses
+from datetime import datetime
+from utils.cache import LRUCache
+from models.data import (
+    get_user_id, get_monthly_rollup, get_expense_version,
+    get_cached_insights, save_cached_insights
+)
 
 # Load environment variables
 load_dotenv()
 
+# Reviews are keyed on the user's expense version, which every write to their
+# rollups bumps, so an entry is never stale and needs no expiry of its own
+_insights_cache = LRUCache(maxsize=int(os.getenv('INSIGHTS_CACHE_SIZE', 10000)))
+# Also keep them in the database so every worker process can reuse them
+INSIGHTS_CACHE_SHARED = os.getenv('INSIGHTS_CACHE_SHARED', '').lower() in ('1', 'true', 'yes')
+
 def get_monthly_summary_and_suggestions(user: str) -> str:
-    # Get user's expenses for the current month
-    expenses = get_user_expenses(user)
-    
-    current_month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    next_month = (current_month + timedelta(days=32)).replace(day=1)
-    
-    monthly_expenses = [
-        e for e in expenses 
-        if isinstance(e.get("created_at"), datetime) and 
-        current_month <= e["created_at"] < next_month
-    ]
+    user_id = get_user_id(user)
+    current_month = datetime.utcnow().strftime("%Y-%m")
+    key = f"{user_id}:{current_month}:{get_expense_version(user_id)}"
+
+    summary = _insights_cache.get(key)
+    if summary is None and INSIGHTS_CACHE_SHARED:
+        summary = get_cached_insights(key)
+    if summary is None:
+        summary = _monthly_summary(user_id, current_month, key)
+        if INSIGHTS_CACHE_SHARED:
+            save_cached_insights(key, summary)
+    _insights_cache.set(key, summary)
+    return summary
+
+def _monthly_summary(user_id, month, key):
+    # Get user's category totals for the month
+    category_totals = get_monthly_rollup(user_id, month)
     
-    if not monthly_expenses:
+    if not category_totals:
         return "No expenses recorded for this month yet."
     
-    total_spent = sum(e["amount"] for e in monthly_expenses)
-    category_totals = {}
-    for expense in monthly_expenses:
-        category = expense.get("category", "other")
-        category_totals[category] = category_totals.get(category, 0) + expense["amount"]
+    total_spent = sum(category_totals.values())
     
     # Sort categories by amount spent
     sorted_categories = sorted(category_totals.items(), key=lambda x: x[1], reverse=True)
     
-    return generate_structured_insights(total_spent, sorted_categories)
+    # Templates are picked with the cache key as the seed, so a cached review
+    # reads exactly like one computed again from the same data
+    return generate_structured_insights(total_spent, sorted_categories, random.Random(key))
 
-def generate_structured_insights(total_spent, sorted_categories):
+def generate_structured_insights(total_spent, sorted_categories, rng=random):
     
     top_category, top_amount = sorted_categories[0]
     
@@ -57,7 +71,7 @@ def generate_structured_insights(total_spent, sorted_categories):
         f"• You've allocated the most funds to {top_category} with ₹{top_amount:.2f} ({category_percentages[top_category]}% of total)",
         f"• {top_category.title()} is your biggest expense category at ₹{top_amount:.2f} ({category_percentages[top_category]}% of total)"
     ]
-    response += random.choice(top_spending_descriptions) + "\n"
+    response += rng.choice(top_spending_descriptions) + "\n"
     
     # Add second highest category if available
     if len(sorted_categories) > 1:
@@ -67,14 +81,14 @@ def generate_structured_insights(total_spent, sorted_categories):
             f"• {second_category.title()} follows with ₹{second_amount:.2f} ({category_percentages[second_category]}% of total)",
             f"• You've spent ₹{second_amount:.2f} on {second_category} ({category_percentages[second_category]}% of total)"
         ]
-        response += random.choice(second_descriptions) + "\n"
+        response += rng.choice(second_descriptions) + "\n"
     
     total_spending_descriptions = [
         f"• You've spent a total of ₹{total_spent:.2f} this month",
         f"• Your monthly expenses total ₹{total_spent:.2f}",
         f"• This month's total spending is ₹{total_spent:.2f}"
     ]
-    response += random.choice(total_spending_descriptions) + "\n\n"
+    response += rng.choice(total_spending_descriptions) + "\n\n"
     
     response += "💰 Money-Saving Suggestions:\n"
     
@@ -89,7 +103,7 @@ def generate_structured_insights(total_spent, sorted_categories):
             "• Explore more affordable dining options",
             "• Use cashback apps for food purchases"
         ]
-        suggestions.extend(random.sample(food_suggestions, 2))
+        suggestions.extend(rng.sample(food_suggestions, 2))
     elif top_category == "transport":
         transport_suggestions = [
             "• Explore public transportation options",
@@ -98,7 +112,7 @@ def generate_structured_insights(total_spent, sorted_categories):
             "• Plan your trips to minimize fuel consumption",
             "• Consider cycling or walking for short distances"
         ]
-        suggestions.extend(random.sample(transport_suggestions, 2))
+        suggestions.extend(rng.sample(transport_suggestions, 2))
     elif top_category == "shopping":
         shopping_suggestions = [
             "• Wait for sales before making purchases",
@@ -107,7 +121,7 @@ def generate_structured_insights(total_spent, sorted_categories):
             "• Consider buying in bulk for frequently used items",
             "• Look for cashback and reward programs"
         ]
-        suggestions.extend(random.sample(shopping_suggestions, 2))
+        suggestions.extend(rng.sample(shopping_suggestions, 2))
     elif top_category == "entertainment" or top_category == "fun":
         entertainment_suggestions = [
             "• Look for free or low-cost entertainment options",
@@ -116,7 +130,7 @@ def generate_structured_insights(total_spent, sorted_categories):
             "• Find local community events and activities",
             "• Consider hosting gatherings at home instead of going out"
         ]
-        suggestions.extend(random.sample(entertainment_suggestions, 2))
+        suggestions.extend(rng.sample(entertainment_suggestions, 2))
     else:
         generic_suggestions = [
             f"• Consider setting a monthly budget for {top_category} activities",
@@ -125,7 +139,7 @@ def generate_structured_insights(total_spent, sorted_categories):
             f"• Set specific spending limits for {top_category}",
             f"• Track your {top_category} spending more closely"
         ]
-        suggestions.extend(random.sample(generic_suggestions, 2))
+        suggestions.extend(rng.sample(generic_suggestions, 2))
     
     general_suggestions = [
         "• Track small expenses to avoid accumulation",
@@ -134,7 +148,7 @@ def generate_structured_insights(total_spent, sorted_categories):
         "• Use cash for discretionary spending to stay within budget",
         "• Consider using a budgeting app to track expenses"
     ]
-    suggestions.extend(random.sample(general_suggestions, 1))
+    suggestions.extend(rng.sample(general_suggestions, 1))
     
     for suggestion in suggestions:
         response += suggestion + "\n"
@@ -153,7 +167,7 @@ def generate_structured_insights(total_spent, sorted_categories):
         f"• Optimizing {top_category} spending by {savings_percentage}% could save you ₹{potential_savings:.2f} monthly",
         f"• A {savings_percentage}% reduction in {top_category} expenses would save you ₹{potential_savings:.2f} per month"
     ]
-    response += random.choice(optimization_descriptions)
+    response += rng.choice(optimization_descriptions)
     
     return response
 
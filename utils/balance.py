@@ -1,6 +1,47 @@
 from utils.helpers import normalize
 
+def to_paise(amount):
+    return int(round(amount * 100))
+
+def split_paise(amount_paise, members):
+    # Equal split in whole paise; the first members absorb the remainder
+    share, remainder = divmod(amount_paise, len(members))
+    return {
+        normalize(member): share + (1 if i < remainder else 0)
+        for i, member in enumerate(members)
+    }
+
+def ledger_increments(members, amount, paid_by):
+    amount_paise = to_paise(amount)
+    increments = {f"ledger.{normalize(paid_by)}.paid": amount_paise}
+    for member, owed in split_paise(amount_paise, members).items():
+        increments[f"ledger.{member}.owed"] = owed
+    return increments
+
+def compute_group_ledger(members, expenses):
+    ledger = {normalize(member): {"paid": 0, "owed": 0} for member in members}
+    for expense in expenses:
+        amount_paise = to_paise(expense["amount"])
+        paid_by = normalize(expense.get("paid_by", expense.get("added_by")))
+        ledger.setdefault(paid_by, {"paid": 0, "owed": 0})["paid"] += amount_paise
+        for member, owed in split_paise(amount_paise, members).items():
+            ledger[member]["owed"] += owed
+    return ledger
+
+def group_total(group):
+    return sum(entry.get("paid", 0) for entry in group.get("ledger", {}).values()) / 100
+
 def calculate_group_balances(group):
+    if "ledger" in group:
+        if not group.get("expense_count"):
+            return None
+        balances = {}
+        for member in group["members"]:
+            entry = group["ledger"].get(normalize(member), {})
+            balances[normalize(member)] = (entry.get("paid", 0) - entry.get("owed", 0)) / 100
+        return balances
+
+    # Groups created before the ledger existed: walk the expenses
     if not group.get("expenses"):
         return None
     
@@ -20,4 +61,4 @@ def calculate_group_balances(group):
     for member in balances:
         balances[member] = payments[member] - equal_share
     
-    return balances 
\ No newline at end of file
+    return balances
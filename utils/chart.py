@@ -1,16 +1,86 @@
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
 
-def generate_pie_chart(expenses, title="Category‑wise Spending"):
-    totals = {}
-    for e in expenses:
-        totals[e["category"]] = totals.get(e["category"], 0) + e["amount"]
-    cats, amts = list(totals.keys()), list(totals.values())
-    if not cats:
+from utils.log import get_logger, fields
+from utils.metrics import current_labels, labelled, observe_stage
+
+log = get_logger('chart')
+
+# Rendered charts are stored under a hash of their inputs and evicted least
+# recently used first once the directory grows past the size limit
+CHART_DIR = os.getenv('CHART_CACHE_DIR', os.path.join("static", "charts"))
+CHART_CACHE_MAX_BYTES = int(os.getenv('CHART_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+
+# Rendering happens in worker processes that import matplotlib once, so neither
+# importing this module nor answering the webhook pays for it
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 2))
+CHART_RENDER_TIMEOUT = float(os.getenv('CHART_RENDER_TIMEOUT', 10))
+
+_pool = None
+_pool_pid = None
+_pending = {}
+_lock = threading.Lock()
+
+# Keys are content hashes, so a chart never changes once rendered
+CHART_KEY_RE = re.compile(r"[0-9a-f]{32}")
+CHART_MAX_AGE = 365 * 24 * 3600
+
+def chart_key(totals, title):
+    payload = json.dumps(
+        {"title": title, "totals": sorted((c, round(a, 2)) for c, a in totals.items())},
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+def chart_path(key):
+    return os.path.join(CHART_DIR, f"{key}.png")
+
+def touch_chart(key):
+    try:
+        os.utime(chart_path(key))
+        return True
+    except FileNotFoundError:
         return False
 
+def _evict(keep):
+    entries = []
+    for name in os.listdir(CHART_DIR):
+        if not name.endswith(".png"):
+            continue
+        path = os.path.join(CHART_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CHART_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+
+def _render(cats, amts, title, path):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
     def make_autopct(vals):
         def my_autopct(pct):
             total = sum(vals)
@@ -18,11 +88,141 @@ def generate_pie_chart(expenses, title="Category‑wise Spending"):
             return f"₹{val} ({pct:.1f}%)"
         return my_autopct
 
-    plt.figure(figsize=(6,6))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    fig = plt.figure(figsize=(6,6))
     plt.pie(amts, labels=cats, autopct=make_autopct(amts), startangle=140)
     plt.title(title)
     plt.tight_layout()
-    os.makedirs("static", exist_ok=True)
-    plt.savefig("static/chart.png")
-    plt.close()
-    return True 
\ No newline at end of file
+    fig.savefig(tmp_path, format="png")
+    plt.close(fig)
+
+    # Publish atomically so a concurrent reader never sees a partial file
+    os.replace(tmp_path, path)
+    return path
+
+def _get_pool():
+    global _pool, _pool_pid
+    # A pool inherited through fork belongs to the parent; start a fresh one
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(max_workers=CHART_WORKERS, initializer=_init_worker)
+        _pool_pid = os.getpid()
+    return _pool
+
+def _marker_path(key):
+    return chart_path(key) + ".pending"
+
+def _claim_stale_marker(key):
+    # A marker older than the render timeout was left by a worker that died
+    # mid-render. Whoever removes it gets the render inputs it holds back, so
+    # only one process re-submits; None if the marker is fresh or unreadable
+    path = _marker_path(key)
+    try:
+        if time.time() - os.stat(path).st_mtime <= CHART_RENDER_TIMEOUT:
+            return None
+        with open(path, encoding="utf-8") as f:
+            inputs = f.read()
+        os.remove(path)
+    except FileNotFoundError:
+        return None
+    try:
+        inputs = json.loads(inputs)
+        return dict(zip(inputs["cats"], inputs["amts"])), inputs["title"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _on_rendered(key):
+    # Render time is measured from submission and labelled like the submitter
+    labels = current_labels()
+    submitted = time.perf_counter()
+
+    def callback(future):
+        with labelled(*labels):
+            observe_stage('chart_render', time.perf_counter() - submitted)
+        with _lock:
+            _pending.pop(key, None)
+        try:
+            os.remove(_marker_path(key))
+        except FileNotFoundError:
+            pass
+        error = future.exception()
+        if error:
+            log.error("chart render failed", extra=fields(chart=key, error=str(error)))
+        else:
+            _evict(keep=future.result())
+    return callback
+
+def submit_chart(totals, title="Category‑wise Spending"):
+    cats, amts = list(totals.keys()), list(totals.values())
+    if not cats:
+        return None
+
+    key = chart_key(totals, title)
+    if touch_chart(key):
+        return key
+
+    future = None
+    with _lock:
+        if key not in _pending:
+            # Lets other worker processes know this chart is on its way, and
+            # holds the inputs so it can be rendered again if this one dies
+            os.makedirs(CHART_DIR, exist_ok=True)
+            with open(_marker_path(key), "w", encoding="utf-8") as f:
+                json.dump({"cats": cats, "amts": amts, "title": title}, f, ensure_ascii=False)
+            callback = _on_rendered(key)
+            future = _get_pool().submit(_render, cats, amts, title, chart_path(key))
+            _pending[key] = future
+    if future is not None:
+        # Outside the lock: a future that has already finished runs the callback right here
+        future.add_done_callback(callback)
+    return key
+
+def wait_for_chart(key, timeout=CHART_RENDER_TIMEOUT):
+    if touch_chart(key):
+        return True
+
+    with _lock:
+        future = _pending.get(key)
+    if future is not None:
+        try:
+            future.result(timeout=timeout)
+        except TimeoutError:
+            return False
+        except Exception:
+            return False
+        return touch_chart(key)
+
+    stale = _claim_stale_marker(key)
+    if stale is not None:
+        submit_chart(*stale)
+        return wait_for_chart(key, timeout)
+
+    # Being rendered by another worker process: poll until it shows up, or
+    # until the marker goes away because the render failed
+    deadline = time.monotonic() + timeout
+    while os.path.exists(_marker_path(key)) and time.monotonic() < deadline:
+        time.sleep(0.1)
+        if touch_chart(key):
+            return True
+    # The render may have finished between the checks above
+    return touch_chart(key)
+
+def is_chart_pending(key):
+    with _lock:
+        if key in _pending:
+            return True
+    try:
+        return time.time() - os.stat(_marker_path(key)).st_mtime <= CHART_RENDER_TIMEOUT
+    except FileNotFoundError:
+        return False
+
+def generate_pie_chart(expenses, title="Category‑wise Spending"):
+    totals = {}
+    for e in expenses:
+        totals[e["category"]] = totals.get(e["category"], 0) + e["amount"]
+    return generate_pie_chart_from_totals(totals, title)
+
+def generate_pie_chart_from_totals(totals, title="Category‑wise Spending"):
+    # Returns the chart key right away; the image appears when rendering finishes
+    return submit_chart(totals, title)
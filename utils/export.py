@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+from models.data import iter_user_expenses, iter_user_group_expenses
+
+EXPORT_FIELDS = ['scope', 'group', 'date', 'amount', 'desc', 'category', 'paid_by', 'added_by']
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+# Rows are written out in chunks of this many to keep per-yield overhead low
+ROWS_PER_CHUNK = 500
+
+def parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+def export_rows(user, start=None, end=None, category=None, scope='all'):
+    # 'end' is the last day included
+    end = end + timedelta(days=1) if end else None
+    if scope in ('all', 'personal'):
+        for expense in iter_user_expenses(user, start, end, category):
+            yield _row('personal', expense)
+    if scope in ('all', 'group'):
+        for expense in iter_user_group_expenses(user, start, end, category):
+            yield _row('group', expense)
+
+def _row(scope, expense):
+    created_at = expense.get('created_at')
+    return {
+        'scope': scope,
+        'group': expense.get('group'),
+        'date': created_at.isoformat() if created_at else None,
+        'amount': expense.get('amount'),
+        'desc': expense.get('desc'),
+        'category': expense.get('category'),
+        'paid_by': expense.get('paid_by'),
+        'added_by': expense.get('added_by'),
+    }
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def to_ndjson(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row, ensure_ascii=False))
+        if len(chunk) == ROWS_PER_CHUNK:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    if chunk:
+        yield "\n".join(chunk) + "\n"
+
+def render(rows, fmt):
+    return to_csv(rows) if fmt == 'csv' else to_ndjson(rows)
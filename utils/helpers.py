@@ -12,4 +12,26 @@ def load_json(path, default):
 
 def save_json(path, data):
     with open(path, "w") as f:
-        json.dump(data, f, indent=2) 
\ No newline at end of file
+        json.dump(data, f, indent=2)
+
+# Twilio rejects WhatsApp message bodies longer than this
+MESSAGE_LIMIT = 1600
+
+def chunk_message(lines, limit=MESSAGE_LIMIT):
+    chunks, current, size = [], [], 0
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        extra = len(line) + (1 if current else 0)
+        if current and size + extra > limit:
+            chunks.append("\n".join(current))
+            current, size, extra = [], 0, len(line)
+        current.append(line)
+        size += extra
+    if current:
+        chunks.append("\n".join(current))
+    return chunks or [""]
@@ -0,0 +1,111 @@
+import os
+import random
+import threading
+import time
+import uuid
+
+from models.data import enqueue_job, claim_job, save_job_result, complete_job, fail_job
+from utils.messaging import get_messenger
+from utils.log import get_logger, fields
+from utils.metrics import labelled, span
+
+log = get_logger('jobs')
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 120))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 0.5))
+
+_handlers = {}
+_wants_job_id = set()
+_workers = []
+_workers_pid = None
+_stop = threading.Event()
+_start_lock = threading.Lock()
+
+def job_handler(kind, with_job_id=False):
+    # with_job_id: the handler also gets job_id=..., a key that stays the
+    # same across retries, e.g. to make a payment idempotent
+    def register(func):
+        _handlers[kind] = func
+        if with_job_id:
+            _wants_job_id.add(kind)
+        return func
+    return register
+
+def enqueue(user, kind, **payload):
+    if kind not in _handlers:
+        raise ValueError(f"No handler registered for job kind '{kind}'")
+    return enqueue_job(user, kind, payload)
+
+def _retry_delay(attempts):
+    return min(300, 2 ** attempts) * random.uniform(0.5, 1.5)
+
+def run_job(job):
+    with labelled(job['kind'], 'job'), span('job'):
+        _run_job(job)
+
+def _run_job(job):
+    try:
+        # The result is stored before delivery so a failed send is retried
+        # without repeating the handler's side effects (e.g. a payment)
+        result = job.get('result')
+        if result is None:
+            extra = {'job_id': str(job['_id'])} if job['kind'] in _wants_job_id else {}
+            body, media_url = _handlers[job['kind']](job['reply_to'], **job['payload'], **extra)
+            result = {'body': body, 'media_url': media_url}
+            save_job_result(job['_id'], result)
+
+        get_messenger().send(job['reply_to'], result['body'], result.get('media_url'))
+        complete_job(job['_id'])
+    except Exception as e:
+        error = f"{type(e).__name__}: {str(e)}"
+        log.error("job failed", exc_info=True, extra=fields(job=str(job['_id']), kind=job['kind'], attempts=job['attempts']))
+        if job['attempts'] >= JOB_MAX_ATTEMPTS or job['kind'] not in _handlers:
+            fail_job(job['_id'], error)
+        else:
+            fail_job(job['_id'], error, retry_delay=_retry_delay(job['attempts']))
+
+def work(worker_id, stop=_stop):
+    while not stop.is_set():
+        try:
+            job = claim_job(worker_id, lease_seconds=JOB_LEASE_SECONDS)
+        except Exception as e:
+            log.error("could not claim job", extra=fields(error=str(e)))
+            job = None
+        if job is None:
+            stop.wait(JOB_POLL_INTERVAL)
+            continue
+        run_job(job)
+
+def start_workers(count=JOB_WORKERS):
+    global _workers, _workers_pid
+    with _start_lock:
+        # Threads do not survive a fork, so each process starts its own
+        if _workers_pid == os.getpid():
+            return _workers
+        _stop.clear()
+        _workers = []
+        for i in range(count):
+            worker_id = f"{os.getpid()}-{i}-{uuid.uuid4().hex[:6]}"
+            thread = threading.Thread(target=work, args=(worker_id,), name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            _workers.append(thread)
+        _workers_pid = os.getpid()
+        return _workers
+
+def stop_workers(timeout=5):
+    _stop.set()
+    for thread in _workers:
+        thread.join(timeout)
+
+if __name__ == "__main__":
+    import tasks  # noqa: F401  registers the job handlers
+
+    start_workers()
+    print(f"Running {JOB_WORKERS} job worker(s). Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_workers()
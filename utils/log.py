@@ -0,0 +1,80 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from datetime import datetime
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+_listener = None
+_handler = None
+_configure_lock = threading.Lock()
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Render the traceback now, while it still exists, but keep it out of
+        # the message so the JSON formatter can put it in its own field
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def _start_listener():
+    global _listener
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=False)
+    _listener.start()
+    return records
+
+def _after_fork_in_child():
+    # The listener thread does not survive a fork, so each child starts its own
+    # on a fresh queue; records the parent had not written yet stay the parent's
+    global _configure_lock
+    _configure_lock = threading.Lock()
+    _handler.queue = _start_listener()
+
+def _configure():
+    # Requests only put records on a queue; one background thread formats and
+    # writes them, so a slow stderr never holds up a reply
+    global _handler
+    _handler = _QueueHandler(_start_listener())
+    atexit.register(lambda: _listener.stop())
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+    root = logging.getLogger('expensebot')
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(_handler)
+    root.propagate = False
+
+def get_logger(name):
+    with _configure_lock:
+        if _listener is None:
+            _configure()
+    return logging.getLogger(f'expensebot.{name}')
+
+def fields(**values):
+    # Structured key/values for a log call: log.info("msg", extra=fields(user=...))
+    return {'fields': values}
@@ -0,0 +1,53 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+class Messenger:
+    def send(self, to, body, media_url=None):
+        raise NotImplementedError
+
+class TwilioMessenger(Messenger):
+    def __init__(self, account_sid=None, auth_token=None, from_number=None):
+        from twilio.rest import Client
+
+        self.client = Client(
+            account_sid or os.getenv('TWILIO_ACCOUNT_SID'),
+            auth_token or os.getenv('TWILIO_AUTH_TOKEN')
+        )
+        self.from_number = from_number or os.getenv('TWILIO_WHATSAPP_FROM')
+
+    def send(self, to, body, media_url=None):
+        params = {'from_': self.from_number, 'to': to, 'body': body}
+        if media_url:
+            params['media_url'] = [media_url]
+        message = self.client.messages.create(**params)
+        return message.sid
+
+class FakeMessenger(Messenger):
+    # Records outgoing messages instead of calling Twilio; used for local runs and tests
+    def __init__(self):
+        self.outbox = []
+        self._lock = threading.Lock()
+
+    def send(self, to, body, media_url=None):
+        with self._lock:
+            self.outbox.append({'to': to, 'body': body, 'media_url': media_url})
+            return f"fake_{len(self.outbox)}"
+
+_messenger = None
+
+def get_messenger():
+    global _messenger
+    if _messenger is None:
+        if os.getenv('MESSENGER', 'twilio').lower() == 'fake':
+            _messenger = FakeMessenger()
+        else:
+            _messenger = TwilioMessenger()
+    return _messenger
+
+def set_messenger(messenger):
+    global _messenger
+    _messenger = messenger
@@ -0,0 +1,191 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+# Upper bounds in seconds, from in-memory lookups up to slow external calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    # Cumulative-bucket histogram rendered in the Prometheus text format
+
+    def __init__(self, name, documentation, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(key, list(counts), count, total) for key, (counts, count, total) in self._series.items()]
+        for key, counts, count, total in sorted(series):
+            labels = [_label(name, value) for name, value in zip(self.labelnames, key)]
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(labels + [_label('le', bound)])} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_labels(labels + [_label('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+        return "\n".join(lines)
+
+def _label(name, value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{name}="{value}"'
+
+def _labels(labels):
+    return "{" + ",".join(labels) + "}"
+
+REQUEST_SECONDS = Histogram(
+    'expensebot_request_seconds', "Time to handle one webhook message",
+    ['command', 'state']
+)
+STAGE_SECONDS = Histogram(
+    'expensebot_stage_seconds', "Time spent in each stage of handling a message or job",
+    ['stage', 'command', 'state']
+)
+
+# The command/state being handled on this thread, used to label nested spans
+_current = threading.local()
+
+def current_labels():
+    return getattr(_current, 'command', ''), getattr(_current, 'state', '')
+
+def set_labels(command=None, state=None):
+    if command is not None:
+        _current.command = command
+    if state is not None:
+        _current.state = state
+
+@contextmanager
+def labelled(command, state):
+    previous = current_labels()
+    set_labels(command, state)
+    try:
+        yield
+    finally:
+        set_labels(*previous)
+
+def observe_stage(stage, seconds):
+    command, state = current_labels()
+    STAGE_SECONDS.observe(seconds, stage=stage, command=command, state=state)
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def timed(stage):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class MongoCommandTimer(monitoring.CommandListener):
+    # pymongo reports commands on the thread that issued them, so the
+    # request's command/state labels are still in place here
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe_stage(f"mongo_{event.command_name}", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        observe_stage(f"mongo_{event.command_name}", event.duration_micros / 1e6)
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    # Live connection counts per server, for the health probe
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def _bump(self, event, field, by=1):
+        address = "%s:%s" % event.address
+        with self._lock:
+            stats = self._servers.setdefault(address, {
+                'open': 0, 'in_use': 0, 'checkout_failures': 0, 'cleared': 0
+            })
+            stats[field] += by
+
+    def snapshot(self):
+        with self._lock:
+            return {address: dict(stats) for address, stats in self._servers.items()}
+
+    def pool_created(self, event):
+        self._bump(event, 'open', 0)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._bump(event, 'cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._bump(event, 'open')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._bump(event, 'open', -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._bump(event, 'checkout_failures')
+
+    def connection_checked_out(self, event):
+        self._bump(event, 'in_use')
+
+    def connection_checked_in(self, event):
+        self._bump(event, 'in_use', -1)
+
+# Functions returning extra metric families for /metrics, e.g. the payment
+# gateway's counters, which live outside this module
+_collectors = []
+
+def register_collector(collect):
+    _collectors.append(collect)
+    return collect
+
+def render_metric(name, kind, documentation, samples):
+    # One metric family; samples are (name suffix, labels dict, value)
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for suffix, labels, value in samples:
+        label_text = _labels([_label(k, v) for k, v in labels.items()]) if labels else ""
+        lines.append(f"{name}{suffix}{label_text} {value}")
+    return "\n".join(lines)
+
+def render_metrics():
+    families = [h.render() for h in (REQUEST_SECONDS, STAGE_SECONDS)]
+    families += [collect() for collect in _collectors]
+    return "\n".join(families) + "\n"
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
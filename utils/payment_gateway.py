@@ -0,0 +1,173 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+class GatewayError(Exception):
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+class CircuitOpenError(GatewayError):
+    pass
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.opened_total = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                # Let a single trial call through to probe the gateway
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened_total += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+# Methods that can be sent twice without doing the work twice
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+def _never_sent(error):
+    # True if the connection could not be opened, so the gateway cannot have
+    # seen the request; after a read timeout or a dropped connection it may have
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+class RazorpayGateway:
+    def __init__(self, key_id, key_secret, base_url=None, connect_timeout=3.0, read_timeout=10.0,
+                 max_retries=2, backoff=0.2, pool_size=10, breaker=None):
+        self.base_url = (base_url or 'https://api.razorpay.com').rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        # One pooled session per process keeps TLS connections to the gateway warm
+        self.session = requests.Session()
+        self.session.auth = (key_id, key_secret)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._metrics_lock = threading.Lock()
+        self._metrics = {
+            'requests': 0,
+            'failures': 0,
+            'rejected': 0,
+            'latency_count': 0,
+            'latency_sum': 0.0,
+            'latency_max': 0.0
+        }
+
+    def _observe(self, elapsed, failed):
+        with self._metrics_lock:
+            self._metrics['requests'] += 1
+            self._metrics['latency_count'] += 1
+            self._metrics['latency_sum'] += elapsed
+            self._metrics['latency_max'] = max(self._metrics['latency_max'], elapsed)
+            if failed:
+                self._metrics['failures'] += 1
+
+    def _request(self, method, path, payload=None):
+        if not self.breaker.allow():
+            with self._metrics_lock:
+                self._metrics['rejected'] += 1
+            raise CircuitOpenError("Payment gateway circuit is open")
+
+        # A POST that may have reached the gateway is not sent again, or a
+        # slow order creation could turn into two orders
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, self.base_url + path, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = GatewayError(str(e), retryable=idempotent or _never_sent(e))
+            else:
+                if response.status_code < 500 and response.status_code != 429:
+                    self._observe(time.monotonic() - start, failed=False)
+                    # A 4xx means the gateway is healthy, it rejected this request
+                    self.breaker.record_success()
+                    if response.status_code >= 400:
+                        raise GatewayError(f"Gateway rejected request: {response.status_code} {response.text}")
+                    return response.json()
+                # A 429 is refused before any work is done, so it is always safe to repeat
+                last_error = GatewayError(
+                    f"Gateway returned {response.status_code}",
+                    retryable=idempotent or response.status_code == 429
+                )
+
+            self._observe(time.monotonic() - start, failed=True)
+            self.breaker.record_failure()
+            if not last_error.retryable or attempt == self.max_retries or not self.breaker.allow():
+                break
+            time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+        raise last_error
+
+    def create_order(self, order_data):
+        return self._request('POST', '/v1/orders', order_data)
+
+    def metrics(self):
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics['breaker_state'] = self.breaker.state
+        metrics['breaker_opened_total'] = self.breaker.opened_total
+        return metrics
+
+def gateway_from_env():
+    return RazorpayGateway(
+        key_id=os.getenv('RAZORPAY_KEY_ID'),
+        key_secret=os.getenv('RAZORPAY_KEY_SECRET'),
+        base_url=os.getenv('RAZORPAY_BASE_URL'),
+        connect_timeout=float(os.getenv('RAZORPAY_CONNECT_TIMEOUT', 3)),
+        read_timeout=float(os.getenv('RAZORPAY_READ_TIMEOUT', 10)),
+        max_retries=int(os.getenv('RAZORPAY_MAX_RETRIES', 2)),
+        pool_size=int(os.getenv('RAZORPAY_POOL_SIZE', 10)),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv('RAZORPAY_BREAKER_THRESHOLD', 5)),
+            reset_timeout=float(os.getenv('RAZORPAY_BREAKER_RESET', 30))
+        )
+    )
@@ -1,9 +1,15 @@
-import razorpay
 import os
 from dotenv import load_dotenv
 import json
+import uuid
 from datetime import datetime
 
+from utils.payment_gateway import gateway_from_env, CircuitOpenError
+from utils.log import get_logger, fields
+from utils.metrics import timed, register_collector, render_metric
+
+log = get_logger('payments')
+
 # Load environment variables
 load_dotenv()
 
@@ -13,30 +19,57 @@ RAZORPAY_KEY_SECRET = os.getenv('RAZORPAY_KEY_SECRET')
 
 # Check if credentials are available
 if not RAZORPAY_KEY_ID or not RAZORPAY_KEY_SECRET:
-    print("Warning: Razorpay credentials not found in environment variables")
-    print("Using mock payment processing for testing purposes")
+    log.warning("Razorpay credentials not found in environment variables, using mock payment processing")
 
-# Initialize Razorpay client
-try:
-    client = razorpay.Client(
-        auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET)
-    )
-    RAZORPAY_AVAILABLE = True
-except Exception as e:
-    print(f"Error initializing Razorpay client: {str(e)}")
-    print("Using mock payment processing for testing purposes")
-    RAZORPAY_AVAILABLE = False
+# Pooled gateway client with timeouts, retries and a circuit breaker
+gateway = gateway_from_env()
+RAZORPAY_AVAILABLE = bool(RAZORPAY_KEY_ID and RAZORPAY_KEY_SECRET)
+
+def gateway_metrics():
+    return gateway.metrics()
+
+BREAKER_STATES = ('closed', 'open', 'half_open')
+
+@register_collector
+def render_gateway_metrics():
+    metrics = gateway_metrics()
+    return "\n".join([
+        render_metric('expensebot_gateway_requests_total', 'counter',
+                      "Calls made to the payment gateway, retries included", [('', {}, metrics['requests'])]),
+        render_metric('expensebot_gateway_failures_total', 'counter',
+                      "Gateway calls that failed, timed out or returned 5xx/429", [('', {}, metrics['failures'])]),
+        render_metric('expensebot_gateway_rejected_total', 'counter',
+                      "Gateway calls refused locally while the circuit was open", [('', {}, metrics['rejected'])]),
+        render_metric('expensebot_gateway_latency_seconds', 'summary', "Payment gateway call latency", [
+            ('_count', {}, metrics['latency_count']),
+            ('_sum', {}, metrics['latency_sum']),
+        ]),
+        render_metric('expensebot_gateway_latency_max_seconds', 'gauge',
+                      "Slowest payment gateway call since the process started", [('', {}, metrics['latency_max'])]),
+        render_metric('expensebot_gateway_breaker_state', 'gauge', "1 for the circuit breaker's current state", [
+            ('', {'state': state}, int(metrics['breaker_state'] == state)) for state in BREAKER_STATES
+        ]),
+        render_metric('expensebot_gateway_breaker_opened_total', 'counter',
+                      "Times the gateway circuit breaker has opened", [('', {}, metrics['breaker_opened_total'])]),
+    ])
+
+def _new_id(prefix):
+    # Random suffix keeps ids unique even for several payments in the same second
+    return f"{prefix}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}"
 
-def create_payment(amount, currency='INR', description=None, user_id=None, recipient_id=None):
+@timed('payment')
+def create_payment(amount, currency='INR', description=None, user_id=None, recipient_id=None, payment_id=None):
+    # A caller-chosen payment_id makes a retried payment recognisable: it is
+    # kept as the payment's id and sent to Razorpay as the order receipt
     
     # Convert amount to paise (Razorpay expects amount in smallest currency unit)
     amount_in_paise = int(amount * 100)
     
     # If Razorpay is not available, use mock payment processing
     if not RAZORPAY_AVAILABLE:
-        print(f"Mock payment processing: ₹{amount} for {description}")
-        payment_id = f"mock_pay_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{user_id}"
-        order_id = f"mock_order_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{user_id}"
+        log.info("mock payment", extra=fields(amount=amount, description=description))
+        payment_id = payment_id or _new_id("mock_pay")
+        order_id = _new_id("mock_order")
         
         return {
             'payment_id': payment_id,
@@ -60,14 +93,16 @@ def create_payment(amount, currency='INR', description=None, user_id=None, recip
             'description': description
         }
     }
+    if payment_id:
+        order_data['receipt'] = payment_id
     
     try:
         # Create order
-        order = client.order.create(data=order_data)
+        order = gateway.create_order(order_data)
         
         # In test mode, we'll simulate a successful payment
         # In production, this would redirect to Razorpay payment page
-        payment_id = f"pay_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{user_id}"
+        payment_id = payment_id or _new_id("pay")
         
         return {
             'payment_id': payment_id,
@@ -80,11 +115,14 @@ def create_payment(amount, currency='INR', description=None, user_id=None, recip
             'to_user': recipient_id
         }
     except Exception as e:
-        print(f"Error creating payment: {str(e)}")
-        # If there's an error with Razorpay, fall back to mock payment processing
-        print("Falling back to mock payment processing")
-        payment_id = f"mock_pay_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{user_id}"
-        order_id = f"mock_order_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{user_id}"
+        if isinstance(e, CircuitOpenError):
+            # Fail fast while the gateway is known to be down
+            log.warning("payment gateway circuit is open, falling back to mock payment")
+        else:
+            # If there's an error with Razorpay, fall back to mock payment processing
+            log.error("payment failed, falling back to mock payment", extra=fields(error=str(e)))
+        payment_id = payment_id or _new_id("mock_pay")
+        order_id = _new_id("mock_order")
         
         return {
             'payment_id': payment_id,
@@ -120,17 +158,18 @@ def verify_payment(payment_id):
             'verified': True
         }
     except Exception as e:
-        print(f"Error verifying payment: {str(e)}")
+        log.error("payment verification failed", extra=fields(error=str(e)))
         return None
 
+@timed('payment')
 def process_expense_payment(expense, user_id):
     description = f"Expense: {expense.get('desc', 'Unknown')} - {expense.get('category', 'Uncategorized')}"
     
-    payment_id = f"log_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{user_id}"
+    payment_id = _new_id("log")
     
     payment = {
         'payment_id': payment_id,
-        'order_id': f"log_order_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{user_id}",
+        'order_id': _new_id("log_order"),
         'amount': expense['amount'],
         'currency': 'INR',
         'status': 'logged',
@@ -150,14 +189,15 @@ def process_expense_payment(expense, user_id):
     
     return payment
 
-def process_group_expense_share(expense, user_id, share_amount, recipient_id=None):
+def process_group_expense_share(expense, user_id, share_amount, recipient_id=None, payment_id=None):
     description = f"Group Expense Share: {expense.get('desc', 'Unknown')} - {expense.get('category', 'Uncategorized')}"
     
     payment = create_payment(
         amount=share_amount,
         description=description,
         user_id=user_id,
-        recipient_id=recipient_id
+        recipient_id=recipient_id,
+        payment_id=payment_id
     )
     
     if payment:
@@ -0,0 +1,86 @@
+import re
+
+from twilio.twiml.messaging_response import MessagingResponse
+
+from utils.helpers import chunk_message
+
+class Command:
+    # An incoming message, parsed once and shared by every handler
+
+    def __init__(self, text):
+        self.text = (text or "").strip()
+        self.lower = self.text.lower()
+        self.parts = self.text.split()
+
+    def arg(self, index, default=None):
+        return self.parts[index] if len(self.parts) > index else default
+
+class Reply:
+    def __init__(self):
+        self.resp = MessagingResponse()
+        self.msg = self.resp.message()
+
+    def body(self, text):
+        self.msg.body(text)
+
+    def lines(self, lines):
+        chunks = chunk_message(lines)
+        self.msg.body(chunks[0])
+        for chunk in chunks[1:]:
+            self.resp.message(chunk)
+
+    def to_twiml(self):
+        return str(self.resp)
+
+class Router:
+    # (state, compiled pattern) -> handler; patterns are tried in registration
+    # order against the lowercased message and must match it entirely
+
+    def __init__(self):
+        self._routes = {}
+        self._matchers = {}
+        self._fallbacks = {}
+        self._default = None
+
+    def route(self, state, pattern):
+        compiled = re.compile(pattern, re.DOTALL)
+
+        def register(handler):
+            self._routes.setdefault(state, []).append((compiled, handler))
+            self._matchers.pop(state, None)
+            return handler
+        return register
+
+    def _matcher(self, state):
+        # One alternation per state, so a message costs a single regex match.
+        # Alternatives are tried left to right, which keeps registration order;
+        # the named group wraps its pattern, so it is the last one to close
+        matcher = self._matchers.get(state)
+        if matcher is None:
+            routes = self._routes.get(state, ())
+            matcher = self._matchers[state] = re.compile(
+                "|".join(f"(?P<r{i}>{pattern.pattern})" for i, (pattern, _) in enumerate(routes)),
+                re.DOTALL
+            ) if routes else False
+        return matcher
+
+    def fallback(self, state):
+        def register(handler):
+            self._fallbacks[state] = handler
+            return handler
+        return register
+
+    def default(self, handler):
+        # Used for states nothing is registered for
+        self._default = handler
+        return handler
+
+    def resolve(self, state, cmd):
+        matcher = self._matcher(state)
+        match = matcher.fullmatch(cmd.lower) if matcher else None
+        if match:
+            return self._routes[state][int(match.lastgroup[1:])][1]
+        return self._fallbacks.get(state, self._default)
+
+    def dispatch(self, state, ctx, cmd, reply):
+        return self.resolve(state, cmd)(ctx, cmd, reply)
@@ -0,0 +1,93 @@
+import heapq
+import time
+
+from utils.balance import to_paise
+
+# Above this many non-settled members the exact solver is not attempted
+MAX_EXACT_MEMBERS = 12
+
+def _to_paise(balances):
+    return {member: to_paise(balance) for member, balance in balances.items() if to_paise(balance) != 0}
+
+def _greedy(paise):
+    # Always match the largest debtor with the largest creditor; every transfer
+    # settles at least one of them, so n members need at most n-1 transfers
+    creditors = [(-amount, member) for member, amount in paise.items() if amount > 0]
+    debtors = [(amount, member) for member, amount in paise.items() if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        credit, debt = -credit, -debt
+        amount = min(credit, debt)
+        transfers.append((debtor, creditor, amount))
+        if credit > amount:
+            heapq.heappush(creditors, (-(credit - amount), creditor))
+        if debt > amount:
+            heapq.heappush(debtors, (-(debt - amount), debtor))
+    return transfers
+
+def _zero_sum_partition(members, amounts, deadline):
+    # dp[mask] = most disjoint zero-sum subsets the members in mask split into;
+    # n members then settle in n - dp[full] transfers
+    n = len(members)
+    full = (1 << n) - 1
+    sums = [0] * (full + 1)
+    dp = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        if not (mask - 1) & 0x3FF and time.monotonic() > deadline:
+            return None
+        low = mask & -mask
+        i = low.bit_length() - 1
+        sums[mask] = sums[mask ^ low] + amounts[i]
+        best = 0
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            if dp[mask ^ bit] > best:
+                best = dp[mask ^ bit]
+            rest ^= bit
+        dp[mask] = best + (1 if sums[mask] == 0 else 0)
+
+    # Peel members off in an order whose prefix sums hit zero at every subset boundary
+    order = []
+    mask = full
+    while mask:
+        target = dp[mask] - (1 if sums[mask] == 0 else 0)
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            if dp[mask ^ bit] == target:
+                break
+            rest ^= bit
+        order.append(bit.bit_length() - 1)
+        mask ^= bit
+    order.reverse()
+
+    subsets, current, running = [], [], 0
+    for i in order:
+        current.append(members[i])
+        running += amounts[i]
+        if running == 0:
+            subsets.append(current)
+            current = []
+    if current:
+        subsets.append(current)
+    return subsets
+
+def plan_settlements(balances, exact=False, time_budget=0.5):
+    paise = _to_paise(balances)
+
+    if exact and 1 < len(paise) <= MAX_EXACT_MEMBERS:
+        members = sorted(paise)
+        subsets = _zero_sum_partition(members, [paise[m] for m in members], time.monotonic() + time_budget)
+        if subsets is not None:
+            transfers = []
+            for subset in subsets:
+                transfers.extend(_greedy({m: paise[m] for m in subset}))
+            return transfers
+
+    return _greedy(paise)
@@ -0,0 +1,205 @@
+import argparse
+import csv
+import hashlib
+import io
+import os
+import re
+import sys
+from collections import Counter
+from datetime import datetime
+
+from utils.helpers import normalize
+from models.data import ensure_indexes, get_user_id, import_expenses
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+
+# Bank and UPI exports name the same columns differently
+DATE_COLUMNS = ('date', 'txn date', 'transaction date', 'value date', 'posting date')
+DESC_COLUMNS = ('description', 'narration', 'details', 'particulars', 'remarks', 'transaction details')
+AMOUNT_COLUMNS = ('amount', 'amount (inr)', 'transaction amount')
+DEBIT_COLUMNS = ('debit', 'withdrawal', 'withdrawal amt.', 'withdrawal amount', 'debit amount', 'dr')
+CREDIT_COLUMNS = ('credit', 'deposit', 'deposit amt.', 'deposit amount', 'credit amount', 'cr')
+REF_COLUMNS = ('reference', 'ref no', 'ref no.', 'chq./ref.no.', 'utr', 'transaction id', 'upi ref no')
+TYPE_COLUMNS = ('type', 'dr/cr', 'cr/dr', 'transaction type')
+BALANCE_COLUMNS = ('balance', 'closing balance', 'available balance')
+
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d/%m/%y', '%d-%m-%y', '%d %b %Y', '%d-%b-%Y', '%d %b %y')
+
+CATEGORY_KEYWORDS = {
+    'food': ('swiggy', 'zomato', 'restaurant', 'cafe', 'dominos', 'pizza', 'mcdonald', 'starbucks', 'bigbasket', 'blinkit', 'zepto', 'grocery'),
+    'transport': ('uber', 'ola', 'rapido', 'metro', 'irctc', 'fuel', 'petrol', 'fastag', 'indigo', 'airline'),
+    'shopping': ('amazon', 'flipkart', 'myntra', 'ajio', 'meesho', 'nykaa'),
+    'bills': ('electricity', 'recharge', 'airtel', 'jio', 'vodafone', 'broadband', 'bescom', 'gas', 'water bill', 'insurance'),
+    'entertainment': ('netflix', 'spotify', 'hotstar', 'prime video', 'bookmyshow', 'pvr', 'inox'),
+    'health': ('pharmacy', 'apollo', 'medplus', 'hospital', 'clinic', 'pharmeasy', '1mg'),
+    'rent': ('rent', 'nobroker'),
+}
+
+# Keywords must start a word so 'ola' does not match 'cola' or 'rent' 'current'
+_CATEGORY_PATTERNS = [
+    (category, re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keywords) + r")"))
+    for category, keywords in CATEGORY_KEYWORDS.items()
+]
+
+def categorize(desc):
+    text = desc.lower()
+    for category, pattern in _CATEGORY_PATTERNS:
+        if pattern.search(text):
+            return category
+    return 'other'
+
+def _pick(row, names):
+    for name in names:
+        value = row.get(name)
+        if value is not None and value.strip():
+            return value.strip()
+    return None
+
+def _parse_amount(value):
+    if value is None:
+        return None
+    value = value.replace(',', '').replace('₹', '').replace('INR', '').strip()
+    if value.endswith(('Dr', 'DR')):
+        value = '-' + value[:-2].strip()
+    elif value.endswith(('Cr', 'CR')):
+        value = value[:-2].strip()
+    return float(value) if value else None
+
+def _parse_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognised date {value!r}")
+
+def _debit_amount(record):
+    # Money out of the account, or None for credits
+    debit = _parse_amount(_pick(record, DEBIT_COLUMNS))
+    if debit is not None:
+        return abs(debit) or None
+    if _parse_amount(_pick(record, CREDIT_COLUMNS)):
+        return None
+    raw = _pick(record, AMOUNT_COLUMNS)
+    amount = _parse_amount(raw)
+    if not amount:
+        return None
+    # Without a type column every amount is spending, unless marked 'Cr'
+    kind = _pick(record, TYPE_COLUMNS) or ('credit' if raw.lower().endswith('cr') else 'debit')
+    return abs(amount) if kind.lower() in ('debit', 'dr', 'paid', 'sent') else None
+
+def import_hash(user_id, row):
+    # Identifies a statement line across repeated imports of overlapping exports
+    key = "|".join([user_id] + [str(part) for part in row])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def parse_statement(lines):
+    # Yields (line_no, expense fields or None, error); credits and blank rows yield nothing
+    reader = csv.reader(lines)
+    header = None
+    seen, seen_date = Counter(), None
+    for row in reader:
+        if header is None:
+            if row and any(cell.strip() for cell in row):
+                header = [cell.strip().lower() for cell in row]
+            continue
+        if not any(cell.strip() for cell in row):
+            continue
+        record = dict(zip(header, row))
+        try:
+            debit = _debit_amount(record)
+            if debit is None:
+                continue
+            date_s = _pick(record, DATE_COLUMNS)
+            if date_s is None:
+                raise ValueError("Missing date")
+            created_at = _parse_date(date_s)
+        except ValueError as e:
+            yield reader.line_num, None, str(e)
+            continue
+
+        desc = _pick(record, DESC_COLUMNS) or 'imported'
+        fingerprint = (
+            date_s, f"{debit:.2f}", desc,
+            _pick(record, REF_COLUMNS), _pick(record, BALANCE_COLUMNS)
+        )
+        # Two identical lines (same day, amount and payee, no reference or
+        # balance) are two payments; number the repeats in file order so the
+        # second one is not taken for a re-import of the first. Statements
+        # list each day's lines together, so only the current day is counted
+        if fingerprint[3] is None and fingerprint[4] is None:
+            if date_s != seen_date:
+                seen.clear()
+                seen_date = date_s
+            seen[fingerprint] += 1
+            if seen[fingerprint] > 1:
+                fingerprint += (seen[fingerprint],)
+        yield reader.line_num, {
+            'amount': debit,
+            'desc': desc,
+            'category': categorize(desc),
+            'created_at': created_at,
+            'fingerprint': fingerprint,
+        }, None
+
+def import_statement(user, lines, batch_size=IMPORT_BATCH_SIZE):
+    # Only one batch is held in memory, so file size does not matter
+    user_id = get_user_id(user)
+    owner = f"whatsapp:+{normalize(user)}"
+    summary = {'imported': 0, 'duplicates': 0, 'errors': 0, 'error_lines': []}
+
+    batch = []
+
+    def flush():
+        inserted, duplicates = import_expenses(user_id, batch)
+        summary['imported'] += inserted
+        summary['duplicates'] += duplicates
+        batch.clear()
+
+    for line_no, fields, error in parse_statement(lines):
+        if error:
+            summary['errors'] += 1
+            if len(summary['error_lines']) < 20:
+                summary['error_lines'].append({'line': line_no, 'error': error})
+            continue
+        batch.append({
+            'user': owner,
+            'amount': fields['amount'],
+            'desc': fields['desc'],
+            'category': fields['category'],
+            'created_at': fields['created_at'],
+            'source': 'import',
+            'import_hash': import_hash(user_id, fields['fingerprint']),
+        })
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return summary
+
+def text_stream(binary):
+    # utf-8-sig drops the byte order mark Excel puts on CSV exports
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', errors='replace', newline='')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a bank/UPI CSV statement as personal expenses")
+    parser.add_argument('--user', required=True, help="phone number the expenses belong to, e.g. +919876543210")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument('path')
+    args = parser.parse_args(argv)
+
+    # Duplicates are caught by the unique index on import_hash, so it must exist first
+    failed = ensure_indexes()
+    if failed:
+        print(f"{len(failed)} index(es) could not be created; not importing.")
+        return 1
+
+    with open(args.path, 'rb') as f:
+        result = import_statement(args.user, text_stream(f), batch_size=args.batch_size)
+    print(f"Imported {result['imported']} expense(s), skipped {result['duplicates']} duplicate(s), {result['errors']} unreadable row(s).")
+    for item in result['error_lines']:
+        print(f"  line {item['line']}: {item['error']}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())